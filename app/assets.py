@@ -0,0 +1,213 @@
+"""
+Static asset pipeline: python -m app.assets build copies every file of static/ to static/build/ under a content-hashed
+name (experiment.3f2a9c01b7d4.js), rewrites the url(...) references of the stylesheets to the hashed names, writes
+gzip and brotli (if the brotli package is installed) variants of the text files and a manifest.json mapping each
+file to its hashed name.
+
+Templates link assets with asset_url('experiment.js'). Once the build exists, the hashed files are served from
+/assets/ with Cache-Control: immutable and the precompressed variant the browser accepts; without a build,
+asset_url falls back to the plain static files.
+
+The Rubik web fonts are vendored in static/vendor/fonts/ with their @font-face rules in static/fonts.css;
+python -m app.assets vendor regenerates them from the pinned font package (jQuery is vendored in static/vendor/).
+"""
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import re
+import shutil
+import sys
+import urllib.request
+import zipfile
+from flask import request, send_from_directory, url_for
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'static')
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+# files worth compressing
+COMPRESSIBLE = ('.js', '.css', '.svg', '.json', '.txt', '.html', '.map')
+# web fonts of the vendor command: Rubik 2.300 (SIL Open Font License 1.1, from the google/fonts repository) as
+# packaged on PyPI by fontpkg, pinned by hash. The weights used by the stylesheets are cut from its variable font.
+FONT_PACKAGE = ('https://files.pythonhosted.org/packages/aa/e1/'
+                '3c0c371d2f2174da67a79605516dc2c5be9a2e1fd34a6521aaedef68f372/fontpkg_rubik-2.300-py3-none-any.whl',
+                '3ccc6fd3555759415c5919d90ebf22d2831925545bba50ac300dea9288ca47a4')
+FONT_FILE = 'fontpkg_rubik/files/Rubik[wght].ttf'
+FONT_LICENSE = 'fontpkg_rubik/LICENSE'
+FONT_FAMILY = 'Rubik'
+FONT_WEIGHTS = (400, 700)
+# characters kept in the fonts (the latin subset of Google Fonts)
+FONT_UNICODE_RANGE = ('U+0000-00FF, U+0131, U+0152-0153, U+02BB-02BC, U+02C6, U+02DA, U+02DC, U+0304, U+0308, U+0329, '
+                      'U+2000-206F, U+20AC, U+2122, U+2191, U+2193, U+2212, U+2215, U+FEFF, U+FFFD')
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+def hashed_name(path:str, content:bytes) -> str:
+    root, extension = os.path.splitext(path)
+    return '{}.{}{}'.format(root, hashlib.sha256(content).hexdigest()[:12], extension)
+
+def rewrite_css(css:str, path:str, manifest:dict) -> str:
+    """
+    Point the relative url(...) references of a stylesheet at the hashed names of the files they refer to
+    """
+    def replace(match):
+        url = match.group(2)
+        target = os.path.normpath(os.path.join(os.path.dirname(path), url)).replace(os.sep, '/')
+        if target not in manifest:
+            return match.group(0)
+        relative = os.path.relpath(manifest[target], os.path.dirname(path) or '.').replace(os.sep, '/')
+        return 'url({0}{1}{0})'.format(match.group(1), relative)
+    return CSS_URL.sub(replace, css)
+
+def compress(path:str, content:bytes) -> None:
+    """
+    Write the gzip and brotli variants of a file next to it, when they are smaller
+    """
+    variants = [('.gz', gzip.compress(content, 9, mtime=0))]
+    try:
+        import brotli
+        variants.append(('.br', brotli.compress(content, quality=11)))
+    except ImportError:
+        pass
+    for suffix, compressed in variants:
+        if len(compressed) < len(content):
+            with open(path+suffix, 'wb') as f:
+                f.write(compressed)
+
+def build(static_dir:str=STATIC_DIR) -> dict:
+    """
+    Build the fingerprinted copy of the static files and return the manifest
+    """
+    output_dir = os.path.join(static_dir, BUILD_DIR)
+    tmp_dir = output_dir+'.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    paths = []
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) not in (output_dir, tmp_dir))
+        for name in sorted(files):
+            if not name.startswith('.'):
+                paths.append(os.path.relpath(os.path.join(root, name), static_dir).replace(os.sep, '/'))
+    # stylesheets last, as they refer to the hashed names of the other files
+    paths.sort(key=lambda path: path.endswith('.css'))
+    manifest = {}
+    for path in paths:
+        with open(os.path.join(static_dir, path), 'rb') as f:
+            content = f.read()
+        if path.endswith('.css'):
+            content = rewrite_css(content.decode(), path, manifest).encode()
+        manifest[path] = hashed_name(path, content)
+        output = os.path.join(tmp_dir, manifest[path])
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, 'wb') as f:
+            f.write(content)
+        if path.endswith(COMPRESSIBLE):
+            compress(output, content)
+    with open(os.path.join(tmp_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    # swap the new build in
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(tmp_dir, output_dir)
+    return manifest
+
+def vendor(static_dir:str=STATIC_DIR) -> list:
+    """
+    Write the web fonts (see FONT_PACKAGE) as latin woff2 files to static/vendor/fonts/, along with their license, and
+    their @font-face rules to static/fonts.css. Needs the fonttools and brotli packages.
+    """
+    from fontTools.subset import Options, Subsetter, parse_unicodes
+    from fontTools.ttLib import TTFont
+    from fontTools.varLib.instancer import instantiateVariableFont
+    url, sha256 = FONT_PACKAGE
+    with urllib.request.urlopen(url, timeout=30) as response:
+        package = response.read()
+    if hashlib.sha256(package).hexdigest() != sha256:
+        raise ValueError('Unexpected content for {}'.format(url))
+    with zipfile.ZipFile(io.BytesIO(package)) as archive:
+        font = archive.read(FONT_FILE)
+        license = archive.read(FONT_LICENSE)
+    font_dir = os.path.join(static_dir, 'vendor', 'fonts')
+    os.makedirs(font_dir, exist_ok=True)
+    with open(os.path.join(font_dir, 'OFL.txt'), 'wb') as f:
+        f.write(license)
+    rules = []
+    names = []
+    for weight in FONT_WEIGHTS:
+        name = 'vendor/fonts/{}-{}.woff2'.format(FONT_FAMILY.lower(), weight)
+        names.append(name)
+        instance = instantiateVariableFont(TTFont(io.BytesIO(font)), {'wght': weight}, updateFontNames=True)
+        options = Options()
+        options.flavor = 'woff2'
+        subsetter = Subsetter(options)
+        subsetter.populate(unicodes=parse_unicodes(FONT_UNICODE_RANGE.replace(' ', '')))
+        subsetter.subset(instance)
+        instance.flavor = 'woff2'
+        # keep the modification time of the source, so that the files only change with the package
+        instance.recalcTimestamp = False
+        instance.save(os.path.join(static_dir, name))
+        rules.append("@font-face {{\n    font-family: '{}';\n    font-style: normal;\n    font-weight: {};\n"
+                     "    font-display: swap;\n    src: url('{}') format('woff2');\n"
+                     "    unicode-range: {};\n}}\n".format(FONT_FAMILY, weight, name, FONT_UNICODE_RANGE))
+    with open(os.path.join(static_dir, 'fonts.css'), 'w') as f:
+        f.write('/* Web fonts served from static/vendor/fonts (written by python -m app.assets vendor) */\n\n')
+        f.write('\n'.join(rules))
+    return names
+
+class Assets:
+
+    def __init__(self, app=None, static_dir:str=STATIC_DIR, max_age:int=365*24*3600) -> None:
+        """
+        Serve the built assets of static_dir from /assets/ and provide asset_url to the templates
+        """
+        self.static_dir = static_dir
+        self.build_dir = os.path.join(static_dir, BUILD_DIR)
+        self.max_age = max_age
+        self.manifest = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        manifest_path = os.path.join(self.build_dir, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+        app.add_url_rule('/assets/<path:filename>', 'assets', self.serve)
+        app.add_template_global(self.url, 'asset_url')
+
+    def url(self, filename:str) -> str:
+        """
+        URL of a static file: its fingerprinted copy if the assets were built, the file itself otherwise
+        """
+        if filename in self.manifest:
+            return url_for('assets', filename=self.manifest[filename])
+        return url_for('static', filename=filename)
+
+    def serve(self, filename:str):
+        """
+        Send a built asset (never changes, so it is cached for good), precompressed if the browser accepts it
+        """
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        encodings = request.headers.get('Accept-Encoding', '')
+        encoding = None
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if candidate in encodings and os.path.exists(os.path.join(self.build_dir, filename+suffix)):
+                encoding = candidate
+                filename += suffix
+                break
+        response = send_from_directory(self.build_dir, filename, mimetype=mimetype, max_age=self.max_age)
+        response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(self.max_age)
+        response.vary.add('Accept-Encoding')
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+if __name__ == "__main__":
+    # python -m app.assets build|vendor
+    if sys.argv[1:] == ['build']:
+        manifest = build()
+        print('Built {} assets into {}.'.format(len(manifest), os.path.normpath(os.path.join(STATIC_DIR, BUILD_DIR))))
+    elif sys.argv[1:] == ['vendor']:
+        print('Vendored {}.'.format(', '.join(vendor())))
+    else:
+        print('Usage: python -m app.assets build|vendor')
+        sys.exit(1)
@@ -0,0 +1,304 @@
+import heapq
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from .sqlite import SQLiteDatabase
+
+logger = logging.getLogger(__name__)
+
+class AssignmentScheduler:
+
+    def __init__(self, task_ids:list, stats:object=None, quotas:dict=None, timeout:float=3600) -> None:
+        """
+        Base class for the schedulers that assign tasks to participants, always picking the least filled task the
+        participant has not played yet. A task's fill is its number of complete plus in-flight (reserved) sessions,
+        whether or not it has a quota (a maximum number of sessions); tasks whose fill reaches their quota are not
+        assigned. Complete sessions are seeded from the study statistics (see StudyStats) the first time the scheduler
+        is used in a process. Reservations not finished within timeout seconds are released.
+        """
+        self.task_ids = [int(task_id) for task_id in task_ids]
+        self.stats = stats
+        self.quotas = {int(task_id): quota for task_id, quota in (quotas or {}).items()}
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def ensure(self) -> None:
+        """
+        Seed the counts from the database (once per process)
+        """
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            completed = self.stats.completed_sessions(self.task_ids) if self.stats is not None else {}
+            self.seed({task_id: completed.get(task_id, 0) for task_id in self.task_ids})
+            self.pid = os.getpid()
+
+    def seed(self, completed:dict) -> None:
+        """
+        Set the complete sessions of every task (with the lock held)
+        """
+        raise NotImplementedError
+
+    def assign(self, uniqueID:str, exclude:set=frozenset()) -> int:
+        """
+        Reserve the least filled task not in exclude for the participant and return it, or None if every task was
+        played or is full. A participant holding a reservation gets the same task again.
+        """
+        raise NotImplementedError
+
+    def reserve(self, uniqueID:str, task_id:int) -> None:
+        """
+        Reserve a given task for the participant (e.g. when a session is resumed), unless already reserved
+        """
+        raise NotImplementedError
+
+    def finish(self, uniqueID:str, task_id:int, complete:bool) -> None:
+        """
+        Release the reservation of the participant, counting the session as complete if it was
+        """
+        raise NotImplementedError
+
+    def counts(self) -> dict:
+        """
+        Get the (complete, in-flight) sessions of every task
+        """
+        raise NotImplementedError
+
+class MemoryScheduler(AssignmentScheduler):
+
+    def __init__(self, task_ids:list, stats:object=None, quotas:dict=None, timeout:float=3600) -> None:
+        """
+        Keep the counts in the memory of this process (only works with a single worker), with the tasks that are not
+        full in a heap ordered by fill. Updating a task pushes a new entry and leaves the old one to be skipped.
+        """
+        super().__init__(task_ids, stats, quotas, timeout)
+        self.completed = {}
+        self.in_flight = {}
+        # task id -> its live heap entry (fill, tiebreak, task id)
+        self.entries = {}
+        self.heap = []
+        # uniqueID -> (expiry, task id), soonest expiry first
+        self.reservations = OrderedDict()
+
+    def seed(self, completed:dict) -> None:
+        self.completed = dict(completed)
+        self.in_flight = {task_id: 0 for task_id in completed}
+        self.entries = {}
+        self.heap = []
+        self.reservations.clear()
+        for task_id in completed:
+            self.push(task_id)
+
+    def push(self, task_id:int) -> None:
+        """
+        Put a task back in the heap with its current fill (with the lock held)
+        """
+        sessions = self.completed[task_id]+self.in_flight[task_id]
+        quota = self.quotas.get(task_id)
+        if quota is not None and sessions >= quota:
+            self.entries.pop(task_id, None)
+            return
+        # ties are broken at random
+        entry = (sessions, random.random(), task_id)
+        self.entries[task_id] = entry
+        heapq.heappush(self.heap, entry)
+        # drop the stale entries once they outnumber the live ones
+        if len(self.heap) > 2*len(self.entries)+16:
+            self.heap = list(self.entries.values())
+            heapq.heapify(self.heap)
+
+    def expire(self) -> None:
+        """
+        Release the reservations past their expiry (with the lock held)
+        """
+        now = time.monotonic()
+        while len(self.reservations) > 0:
+            uniqueID, (expiry, task_id) = next(iter(self.reservations.items()))
+            if expiry > now:
+                break
+            del self.reservations[uniqueID]
+            logger.info('Reservation of task %d for %s timed out', task_id, uniqueID)
+            self.in_flight[task_id] -= 1
+            self.push(task_id)
+
+    def add_reservation(self, uniqueID:str, task_id:int) -> None:
+        self.reservations[uniqueID] = (time.monotonic()+self.timeout, task_id)
+        self.in_flight[task_id] += 1
+        self.push(task_id)
+
+    def release(self, uniqueID:str) -> None:
+        reservation = self.reservations.pop(uniqueID, None)
+        if reservation is not None:
+            self.in_flight[reservation[1]] -= 1
+            self.push(reservation[1])
+
+    def assign(self, uniqueID:str, exclude:set=frozenset()) -> int:
+        self.ensure()
+        with self.lock:
+            self.expire()
+            reservation = self.reservations.get(uniqueID)
+            if reservation is not None:
+                if reservation[1] not in exclude:
+                    return reservation[1]
+                self.release(uniqueID)
+            skipped = []
+            task_id = None
+            while len(self.heap) > 0:
+                entry = heapq.heappop(self.heap)
+                if self.entries.get(entry[2]) is not entry:
+                    # stale entry of a task updated since
+                    continue
+                if entry[2] in exclude:
+                    skipped.append(entry)
+                    continue
+                task_id = entry[2]
+                break
+            for entry in skipped:
+                heapq.heappush(self.heap, entry)
+            if task_id is None:
+                return None
+            self.add_reservation(uniqueID, task_id)
+            return task_id
+
+    def reserve(self, uniqueID:str, task_id:int) -> None:
+        self.ensure()
+        with self.lock:
+            if task_id in self.completed and uniqueID not in self.reservations:
+                self.add_reservation(uniqueID, task_id)
+
+    def finish(self, uniqueID:str, task_id:int, complete:bool) -> None:
+        self.ensure()
+        with self.lock:
+            self.release(uniqueID)
+            if complete and task_id in self.completed:
+                self.completed[task_id] += 1
+                self.push(task_id)
+
+    def counts(self) -> dict:
+        self.ensure()
+        with self.lock:
+            self.expire()
+            return {task_id: (self.completed[task_id], self.in_flight[task_id]) for task_id in self.completed}
+
+class SQLiteScheduler(AssignmentScheduler):
+
+    def __init__(self, task_ids:list, stats:object=None, quotas:dict=None, timeout:float=3600,
+                 path:str=None) -> None:
+        """
+        Keep the counts and reservations in a SQLite database in WAL mode shared by every worker process on the host,
+        with the tasks indexed by (open, fill) so that the least filled open task is found with an index lookup
+        """
+        super().__init__(task_ids, stats, quotas, timeout)
+        self.database = SQLiteDatabase(path)
+        conn = self.database.connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS assignment_tasks ("
+            "task_id INTEGER PRIMARY KEY, completed INTEGER, in_flight INTEGER, quota INTEGER, "
+            "open INTEGER, fill INTEGER, tiebreak REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS assignment_tasks_fill ON assignment_tasks (open, fill, tiebreak)")
+        conn.execute("CREATE TABLE IF NOT EXISTS assignment_reservations (uid TEXT PRIMARY KEY, task_id INTEGER, expires REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS assignment_reservations_expires ON assignment_reservations (expires)")
+
+    def refresh(self, conn:sqlite3.Connection, task_ids:list) -> None:
+        """
+        Recompute the fill of tasks, and whether they are still open, after their counts changed
+        """
+        conn.executemany(
+            "UPDATE assignment_tasks SET "
+            "fill = completed+in_flight, "
+            "open = (quota IS NULL OR completed+in_flight < quota), "
+            "tiebreak = ABS(RANDOM())/9.3e18 WHERE task_id = ?", [(int(task_id),) for task_id in task_ids])
+
+    def seed(self, completed:dict) -> None:
+        with self.database.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO assignment_tasks (task_id, completed, in_flight, quota) VALUES (?, ?, 0, ?) "
+                "ON CONFLICT (task_id) DO UPDATE SET completed = excluded.completed, quota = excluded.quota",
+                [(task_id, count, self.quotas.get(task_id)) for task_id, count in completed.items()])
+            placeholders = ', '.join('?'*len(completed))
+            conn.execute("DELETE FROM assignment_tasks WHERE task_id NOT IN ({})".format(placeholders), list(completed))
+            self.refresh(conn, list(completed))
+
+    def expire(self, conn:sqlite3.Connection) -> None:
+        """
+        Release the reservations past their expiry
+        """
+        expired = conn.execute("SELECT uid, task_id FROM assignment_reservations WHERE expires <= ?",
+                               (time.time(),)).fetchall()
+        if len(expired) == 0:
+            return
+        for uniqueID, task_id in expired:
+            logger.info('Reservation of task %d for %s timed out', task_id, uniqueID)
+        self.release(conn, [uniqueID for uniqueID, _ in expired])
+
+    def release(self, conn:sqlite3.Connection, uniqueIDs:list) -> None:
+        rows = conn.execute("SELECT task_id FROM assignment_reservations WHERE uid IN ({})".format(
+            ', '.join('?'*len(uniqueIDs))), uniqueIDs).fetchall()
+        conn.executemany("DELETE FROM assignment_reservations WHERE uid = ?", [(uniqueID,) for uniqueID in uniqueIDs])
+        conn.executemany("UPDATE assignment_tasks SET in_flight = MAX(in_flight-1, 0) WHERE task_id = ?", rows)
+        self.refresh(conn, [task_id for task_id, in rows])
+
+    def add_reservation(self, conn:sqlite3.Connection, uniqueID:str, task_id:int) -> None:
+        conn.execute("INSERT INTO assignment_reservations (uid, task_id, expires) VALUES (?, ?, ?)",
+                     (uniqueID, task_id, time.time()+self.timeout))
+        conn.execute("UPDATE assignment_tasks SET in_flight = in_flight+1 WHERE task_id = ?", (task_id,))
+        self.refresh(conn, [task_id])
+
+    def assign(self, uniqueID:str, exclude:set=frozenset()) -> int:
+        self.ensure()
+        with self.database.transaction() as conn:
+            self.expire(conn)
+            row = conn.execute("SELECT task_id FROM assignment_reservations WHERE uid = ?", (uniqueID,)).fetchone()
+            if row is not None:
+                if row[0] not in exclude:
+                    return row[0]
+                self.release(conn, [uniqueID])
+            excluded = [int(task_id) for task_id in exclude]
+            row = conn.execute(
+                "SELECT task_id FROM assignment_tasks WHERE open = 1 AND task_id NOT IN ({}) "
+                "ORDER BY fill, tiebreak LIMIT 1".format(', '.join('?'*len(excluded))), excluded).fetchone()
+            if row is None:
+                return None
+            self.add_reservation(conn, uniqueID, row[0])
+            return row[0]
+
+    def reserve(self, uniqueID:str, task_id:int) -> None:
+        self.ensure()
+        with self.database.transaction() as conn:
+            known = conn.execute("SELECT 1 FROM assignment_tasks WHERE task_id = ?", (int(task_id),)).fetchone()
+            reserved = conn.execute("SELECT 1 FROM assignment_reservations WHERE uid = ?", (uniqueID,)).fetchone()
+            if known is not None and reserved is None:
+                self.add_reservation(conn, uniqueID, int(task_id))
+
+    def finish(self, uniqueID:str, task_id:int, complete:bool) -> None:
+        self.ensure()
+        with self.database.transaction() as conn:
+            self.release(conn, [uniqueID])
+            if complete:
+                conn.execute("UPDATE assignment_tasks SET completed = completed+1 WHERE task_id = ?", (int(task_id),))
+                self.refresh(conn, [task_id])
+
+    def counts(self) -> dict:
+        self.ensure()
+        with self.database.transaction() as conn:
+            self.expire(conn)
+            return {task_id: (completed, in_flight) for task_id, completed, in_flight in
+                    conn.execute("SELECT task_id, completed, in_flight FROM assignment_tasks ORDER BY task_id")}
+
+def make_scheduler(kind:str, task_ids:list, stats:object=None, quotas:dict=None, timeout:float=3600,
+                   path:str=None) -> AssignmentScheduler:
+    """
+    Create the assignment scheduler: 'memory' (default) or 'sqlite', matching the experiment store
+    """
+    if kind == 'sqlite':
+        return SQLiteScheduler(task_ids, stats, quotas, timeout, path)
+    elif kind in (None, '', 'memory'):
+        return MemoryScheduler(task_ids, stats, quotas, timeout)
+    raise ValueError('Unknown assignment scheduler: {}'.format(kind))
@@ -0,0 +1,168 @@
+import logging
+import os
+import re
+import threading
+import time
+from pymongo import MongoClient, monitoring
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+class DatabaseUnavailable(RuntimeError):
+    """
+    The MongoDB database is not configured or cannot be reached
+    """
+    pass
+
+def client_settings(environ:dict=os.environ) -> dict:
+    """
+    MongoClient options from the environment: pool size, timeouts, write concern and driver retries
+    """
+    settings = {
+        'maxPoolSize': int(environ.get('MONGO_MAX_POOL_SIZE', 50)),
+        'minPoolSize': int(environ.get('MONGO_MIN_POOL_SIZE', 0)),
+        'maxIdleTimeMS': int(environ.get('MONGO_MAX_IDLE_TIME_MS', 300000)),
+        'serverSelectionTimeoutMS': int(environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+        'connectTimeoutMS': int(environ.get('MONGO_CONNECT_TIMEOUT_MS', 5000)),
+        'socketTimeoutMS': int(environ.get('MONGO_SOCKET_TIMEOUT_MS', 30000)),
+        'waitQueueTimeoutMS': int(environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 10000)),
+        'retryWrites': environ.get('MONGO_RETRY_WRITES', 'true').lower() in ('1', 'true', 'yes'),
+        'retryReads': environ.get('MONGO_RETRY_READS', 'true').lower() in ('1', 'true', 'yes'),
+    }
+    write_concern = environ.get('MONGO_WRITE_CONCERN')
+    if write_concern:
+        settings['w'] = int(write_concern) if write_concern.isdigit() else write_concern
+    if environ.get('MONGO_JOURNAL'):
+        settings['journal'] = environ.get('MONGO_JOURNAL').lower() in ('1', 'true', 'yes')
+    return settings
+
+def redact(url:str) -> str:
+    """
+    Hide the credentials of a MongoDB URL for logging
+    """
+    return re.sub(r'//[^@/]*@', '//***@', url or 'localhost')
+
+class PoolStats(monitoring.ConnectionPoolListener):
+
+    def __init__(self) -> None:
+        """
+        Connection pool statistics of the clients this listener is given to
+        """
+        self.lock = threading.Lock()
+        self.counts = {'open': 0, 'checked_out': 0, 'created': 0, 'closed': 0, 'checkouts': 0,
+                       'checkout_failures': 0, 'cleared': 0}
+
+    def add(self, **changes) -> None:
+        with self.lock:
+            for name, change in changes.items():
+                self.counts[name] += change
+
+    def reset(self) -> None:
+        """
+        Forget the connections of a previous process (after fork)
+        """
+        with self.lock:
+            self.counts = dict.fromkeys(self.counts, 0)
+
+    def pool_created(self, event) -> None:
+        pass
+
+    def pool_ready(self, event) -> None:
+        pass
+
+    def pool_cleared(self, event) -> None:
+        self.add(cleared=1)
+
+    def pool_closed(self, event) -> None:
+        pass
+
+    def connection_created(self, event) -> None:
+        self.add(open=1, created=1)
+
+    def connection_ready(self, event) -> None:
+        pass
+
+    def connection_closed(self, event) -> None:
+        self.add(open=-1, closed=1)
+
+    def connection_check_out_started(self, event) -> None:
+        pass
+
+    def connection_check_out_failed(self, event) -> None:
+        self.add(checkout_failures=1)
+
+    def connection_checked_out(self, event) -> None:
+        self.add(checked_out=1, checkouts=1)
+
+    def connection_checked_in(self, event) -> None:
+        self.add(checked_out=-1)
+
+class MongoDatabase:
+
+    def __init__(self, url:str, dbname:str, settings:dict=None, listeners:list=(), retries:int=3,
+                 backoff:float=0.5) -> None:
+        """
+        Stand-in for a pymongo database that connects on first use, once per process: a client created before a fork
+        (e.g. by gunicorn --preload) is never used by the forked workers, which each create their own. Connecting is
+        retried retries times, waiting backoff seconds and doubling the wait after each failure.
+        """
+        self._url = url
+        self._dbname = dbname
+        self._settings = settings if settings is not None else client_settings()
+        self._listeners = list(listeners)
+        self._retries = retries
+        self._backoff = backoff
+        self._db = None
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # clients created by the current process
+        self.clients_created = 0
+
+    def connect(self) -> object:
+        """
+        Get the database of this process, connecting on first use
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # counts inherited from the parent process do not apply to this one
+                    for listener in self._listeners:
+                        if isinstance(listener, PoolStats):
+                            listener.reset()
+                    self._client = self.create_client()
+                    self._db = self._client[self._dbname]
+                    self._pid = os.getpid()
+                    self.clients_created = 1
+        return self._db
+
+    def create_client(self) -> MongoClient:
+        if not self._dbname:
+            raise DatabaseUnavailable('MONGO_DBNAME is not set.')
+        delay = self._backoff
+        for attempt in range(self._retries+1):
+            logger.info('Connecting to the database at %s (process %d)', redact(self._url), os.getpid())
+            client = None
+            try:
+                client = MongoClient(self._url, event_listeners=self._listeners, **self._settings)
+                client.admin.command('ping')
+                return client
+            except PyMongoError as e:
+                if client is not None:
+                    client.close()
+                if attempt == self._retries:
+                    raise DatabaseUnavailable('Cannot connect to the database at {}: {}'.format(redact(self._url), e)) from e
+                logger.warning('Error connecting to the database (%s), retrying in %.1f s', e, delay)
+                time.sleep(delay)
+                delay *= 2
+
+    @property
+    def client(self) -> MongoClient:
+        self.connect()
+        return self._client
+
+    def __getitem__(self, name:str) -> object:
+        return self.connect()[name]
+
+    def __getattr__(self, name:str) -> object:
+        return getattr(self.connect(), name)
@@ -1,16 +1,26 @@
 import numpy as np
-import pandas as pd
 import os
 import hashlib
-from datetime import datetime
+import logging
+from .tasks import TaskRegistry, TASKS
+from .trials import TrialLog, TIMING_FIELDS
+from .storage import CollectionStorage
+from .writebehind import WriteBehindQueue
+from .db import DatabaseUnavailable
+from .stats import StudyStats
 
 # load environment variables
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 class Experiment:
 
+    __slots__ = ('max_trials', 'min_trials', 'naive_trials', 'current_trial', 'log', 'ready', 'current_points',
+                 'debug', 'db')
+
     def __init__(self, 
                  max_trials:int,
                  min_trials:int,
@@ -18,14 +28,13 @@ class Experiment:
                  db:object,
                  debug:bool=False) -> None:
         """
-        Initialize an experiment with a trial and state_info tracker
+        Initialize an experiment with a trial and trial log
         """
         self.max_trials = max_trials
         self.min_trials = min_trials
         self.naive_trials = naive_trials
         self.current_trial = 0
-        self.state_info = []
-        self.responses = []
+        self.log = TrialLog(max_trials)
         self.ready = False
         self.current_points = 0
         self.debug = debug
@@ -36,48 +45,48 @@ class Experiment:
         Reset the experiment
         """
         self.current_trial = 0
-        self.state_info = []
-        self.responses = []
+        self.log = TrialLog(self.max_trials)
         self.ready = False
         self.current_points = 0
     
 class MultiLevelMarkov(Experiment):
 
+    __slots__ = ('task_id', 'state_labels', 'state_transitions', 'current_state', 'current_lr', 'n_states')
+
     def __init__(self,
                  task_id:int,
                  max_trials:int,
                  min_trials:int,
                  naive_trials:int,
                  db:object,
-                 debug:bool=False) -> None:
+                 debug:bool=False,
+                 registry:TaskRegistry=None) -> None:
         """
         Setup Turner-Hermundstad MultiLevel Markov experiments
         """
         super().__init__(max_trials, min_trials, naive_trials, db, debug)
 
-        directory = "./data/df_topset_mirror.pkl"
-
         # create task id
         self.task_id = task_id
 
-        # load using pandas
+        # get the task from the process-wide registry
+        if registry is None:
+            registry = TASKS
         try:
-            self.taskDB = pd.read_pickle(directory)
+            task = registry.get(self.task_id)
         except:
-            print('Error loading task database. Please check.')
+            logger.exception('Error loading task database. Please check.')
             return
         
         # find the task in the database
-        if self.task_id in self.taskDB.index:
-            self.current_task = self.taskDB.loc[self.task_id]['task']
+        if task is not None:
+            self.state_labels, self.state_transitions = task
             self.current_state = -1
             self.current_lr = 0 #np.random.choice(2)
             self.ready = True
-            self.n_states = len(self.current_task[0])
-            self.state_labels = np.array(self.current_task[0], dtype=np.int32)
-            self.state_transitions = np.array(self.current_task[1],dtype=np.int32)
+            self.n_states = len(self.state_labels)
         else:
-            print('Task not found. Please check.')
+            logger.error('Task %s not found. Please check.', self.task_id)
             return
     
     def reset(self) -> None:
@@ -99,78 +108,93 @@ class MultiLevelMarkov(Experiment):
 
         # print(f"Looking at trial {self.current_trial}.")
 
-        # check if still in naive state
-        if self.current_state < 0 and self.current_trial < self.naive_trials-1:
-            state_A = -1
-            state_B = -1
-            reward_A = 0
-            reward_B = 0
-        elif self.current_state < 0 and self.current_trial == self.naive_trials-1:
-            state_A = 0
-            state_B = 0
-            reward_A = 0
-            reward_B = 0
-        else:
-            # get the next states
-            state_A, state_B = self.state_transitions[self.current_state]
-            # get the rewards
-            reward_A = int(self.state_labels[state_A]*100)
-            reward_B = int(self.state_labels[state_B]*100)
+        state_A, state_B, reward_A, reward_B = self.trial_options(self.current_state, self.current_trial)
         
-        if len(self.state_info)==0 or self.state_info[-1]['trial'] != self.current_trial:
-            self.state_info.append({
-                'trial': self.current_trial,
-                'state': self.current_state,
-                'state_A': state_A,
-                'state_B': state_B,
-                'reward_A': reward_A,
-                'reward_B': reward_B,
-                'lr': self.current_lr
-            })
+        self.log.present(self.current_trial, self.current_state, state_A, state_B, reward_A, reward_B, self.current_lr)
 
         # if self.current_lr == 0:
         return ('A',reward_A,'B',reward_B)
         # else:
         #     return ('B',reward_B,'A',reward_A)
     
+    def trial_options(self, state:int, trial:int)->(int,int,int,int):
+        """
+        Get the next states and rewards offered on a trial started in a given state. Returns (state_A, state_B, reward_A, reward_B)
+        """
+        # check if still in naive state
+        if state < 0 and trial < self.naive_trials-1:
+            return (-1,-1,0,0)
+        elif state < 0 and trial == self.naive_trials-1:
+            return (0,0,0,0)
+        # get the next states
+        state_A, state_B = self.state_transitions[state]
+        # get the rewards
+        reward_A = int(self.state_labels[state_A]*100)
+        reward_B = int(self.state_labels[state_B]*100)
+        return (state_A, state_B, reward_A, reward_B)
+
+    def next_state(self, state:int, trial:int, response:str)->int:
+        """
+        Get the state reached after responding on a trial started in a given state
+        """
+        if trial+1 < self.naive_trials:
+            return -1
+        elif trial+1 == self.naive_trials:
+            return 0
+        if response == 'A':
+            return self.state_transitions[state][0]
+        else:
+            return self.state_transitions[state][1]
+
     def update_state(self, response:str)->None:
         """
         Update the state based on the response
         """
         if not self.ready: return
 
-        if self.current_trial < self.naive_trials:
-            # print('starting naive trial')
-            self.current_state = -1
-            return
-        elif self.current_trial == self.naive_trials:
-            self.current_state = 0
-            return
-        
-        # print('starting normal trial')
-        if response == 'A':
-            self.current_state = self.state_transitions[self.current_state][0]
-        else:
-            self.current_state = self.state_transitions[self.current_state][1]
+        # the trial counter has already moved on to the next trial
+        self.current_state = self.next_state(self.current_state, self.current_trial-1, response)
 
         return
-    
-    def record_response(self, response:str, reward:int)->None:
+
+    def lookahead(self, depth:int)->dict:
         """
-        Record the response and reward for the current trial
+        Get the tree of upcoming trials up to depth levels deep, starting at the current trial. Nodes are stored
+        in heap order: the children of node i are 2i+1 (response A) and 2i+2 (response B).
         """
         if not self.ready: return
-        self.responses.append({
+        levels = max(0, min(depth, self.max_trials-self.current_trial))
+        n_nodes = 2**levels-1
+        states = np.zeros(n_nodes, dtype=np.int32)
+        rewards_A = np.zeros(n_nodes, dtype=np.int32)
+        rewards_B = np.zeros(n_nodes, dtype=np.int32)
+        if n_nodes > 0:
+            states[0] = self.current_state
+        for i in range(n_nodes):
+            trial = self.current_trial + int(np.log2(i+1))
+            _, _, rewards_A[i], rewards_B[i] = self.trial_options(states[i], trial)
+            if 2*i+2 < n_nodes:
+                states[2*i+1] = self.next_state(states[i], trial, 'A')
+                states[2*i+2] = self.next_state(states[i], trial, 'B')
+        return {
             'trial': self.current_trial,
-            'response': response,
-            'reward': reward,
-            'time': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        })
+            'levels': levels,
+            'state': states.tolist(),
+            'reward_A': rewards_A.tolist(),
+            'reward_B': rewards_B.tolist(),
+        }
+    
+    def record_response(self, response:str, reward:int, time:str=None)->None:
+        """
+        Record the response and reward for the current trial (at the current time unless given)
+        """
+        if not self.ready: return
+        self.log.record(self.current_trial, response, reward, time)
         # resample the next state
         self.current_lr = 0 #np.random.choice(2)
         self.current_points += reward
         
-        print(f"Trial {self.current_trial} completed.")
+        logger.debug("Trial %d completed.", self.current_trial)
         self.current_trial += 1
 
         # update the state
@@ -178,49 +202,102 @@ class MultiLevelMarkov(Experiment):
 
         return
     
-    def write_to_database(self, uniqueID:str)->None:
+    def replay(self, documents:list)->int:
+        """
+        Replay trials that were already written to the database (e.g. by a worker that has since died).
+        Stops at the first trial that does not follow on or does not match the task. Returns the number of trials replayed.
+        """
+        n_replayed = 0
+        for document in documents:
+            if document['trial'] != self.current_trial:
+                break
+            left_string, left_reward, right_string, right_reward = self.get_next_trial()
+            if left_string is None:
+                break
+            if (document['response'], document['reward']) not in ((left_string, left_reward), (right_string, right_reward)):
+                logger.warning('Trial %d does not match the task, stopping the replay.', document['trial'])
+                break
+            self.record_response(document['response'], document['reward'], document['time'])
+            self.log.set_timings(document['trial'], **{field: document[field] for field in TIMING_FIELDS
+                                                       if document.get(field) is not None})
+            n_replayed += 1
+        return n_replayed
+
+    def to_state(self)->dict:
         """
-        Write the data to the database after creating a collection for the uniqueID+'_'+task_id
+        Get a compact, serializable copy of the experiment (task id, settings, current state, trial, points and the trial log)
+        """
+        return {
+            'task_id': int(self.task_id),
+            'max_trials': self.max_trials,
+            'min_trials': self.min_trials,
+            'naive_trials': self.naive_trials,
+            'debug': int(self.debug),
+            'current_state': int(self.current_state),
+            'current_trial': self.current_trial,
+            'current_points': int(self.current_points),
+            'log': self.log.to_bytes(),
+        }
+
+    @classmethod
+    def from_state(cls, state:dict, db:object, registry:TaskRegistry=None)->'MultiLevelMarkov':
+        """
+        Rebuild an experiment from the output of to_state
+        """
+        experiment = cls(state['task_id'], state['max_trials'], state['min_trials'], state['naive_trials'],
+                         db, debug=bool(state['debug']), registry=registry)
+        experiment.current_state = state['current_state']
+        experiment.current_trial = state['current_trial']
+        experiment.current_points = state['current_points']
+        experiment.log = TrialLog.from_bytes(state['log'], experiment.max_trials, experiment.current_trial)
+        return experiment
+
+    def write_to_database(self, uniqueID:str, writer:WriteBehindQueue=None, incomplete:bool=False,
+                          stats:StudyStats=None)->None:
+        """
+        Write the data to the database in a collection for the uniqueID+'_'+task_id. Trials already queued on the
+        write-behind writer are flushed and only the ones missing from the database are written here, along with the
+        page timings of the others. Raises
+        DatabaseUnavailable, leaving the session open, if the queued trials cannot be flushed.
+        With incomplete=True the session is closed as incomplete whatever the number of trials (e.g. when it was abandoned).
+        The closed session is added to the study statistics, if given.
         """
         # get the number of trials
-        n_trials = len(self.responses)
-        
-        # create a collection for the uniqueID+'_'+task_id
-        if n_trials < self.min_trials:
-            collection = self.db[uniqueID+'_'+str(self.task_id)+'_incomplete']
-        else:
-            collection = self.db[uniqueID+'_'+str(self.task_id)]
+        n_trials = len(self.log)
 
-        print("Writing to collection {}...".format(uniqueID))
+        logger.info("Writing to collection %s...", uniqueID)
         # make sure the number of trials is more than 0, if not, return
         if n_trials == 0:
-            print("No trials to write.")
+            logger.info("No trials to write.")
             return "no_trials"
-        entries = []
-        for i in range(n_trials):
-            # print(self.responses[i]['trial'], self.state_info[i]['trial'])
-            assert self.responses[i]['trial'] == self.state_info[i]['trial']
-            entry = {
-                'trial': int(self.responses[i]['trial']),
-                'state': int(self.state_info[i]['state']),
-                'response': str(self.responses[i]['response']),
-                'reward': int(self.responses[i]['reward']),
-                'time': str(self.responses[i]['time']),  
-            }
-            if self.debug:
-                entry+={
-                    'state_A': int(self.state_info[i]['state_A']), # debug only
-                    'state_B': int(self.state_info[i]['state_B']), # debug only
-                    'reward_A': int(self.state_info[i]['reward_A']), # debug only
-                    'reward_B': int(self.state_info[i]['reward_B']), # debug only
-                    'lr': int(self.state_info[i]['lr']), # debug only
-                }
-            entries.append(entry)
-        # write to the database
-        collection.insert_many(entries)
-        print("Done.")
+        if writer is not None:
+            if not writer.flush():
+                raise DatabaseUnavailable('Timed out writing the queued trials of {}'.format(uniqueID))
+            storage = writer.storage
+        else:
+            storage = CollectionStorage(self.db)
+        # write the tail of the trials that did not make it to the database yet
+        persisted = storage.persisted_trials(uniqueID, self.task_id)
+        missing = [trial for trial in range(n_trials) if trial not in persisted]
+        storage.write(uniqueID, self.task_id, self.log.to_documents(self.debug, missing))
+        # and the page timings of the trials already written, whose own updates may have been queued on another
+        # worker and run before the trial was written
+        storage.update(uniqueID, self.task_id,
+                       self.log.timing_documents(sorted(trial for trial in persisted if 0 <= trial < n_trials)))
+        # close the collection as uniqueID+'_'+task_id (or uniqueID+'_'+task_id+'_incomplete')
+        complete = n_trials >= self.min_trials and not incomplete
+        storage.finalize(uniqueID, self.task_id, complete)
+        logger.debug("Done.")
+        if stats is not None:
+            try:
+                stats.record(self.task_id, complete, n_trials, self.current_points)
+            except Exception as e:
+                # the trials are safe, the statistics can be rebuilt from them
+                logger.warning('Error updating the study statistics for %s: %s', uniqueID, e)
+        if incomplete:
+            return "incomplete"
         if n_trials < self.min_trials:
-            print("Not enough trials to get reward.")
+            logger.info("Not enough trials to get reward.")
             return "not_enough_trials"
         # return the hash of the collection + secret key as confirmation
         hash_object = hashlib.sha256(str.encode(uniqueID+'_'+os.environ.get('SECRET_KEY')))
@@ -0,0 +1,77 @@
+import csv
+import io
+import tempfile
+import zlib
+from .trials import FIELDS, DEBUG_FIELDS, SERVER_TIMING_FIELDS, CLIENT_TIMING_FIELDS, TIMING_FIELDS
+
+# columns of the exported table
+EXPORT_FIELDS = ('collection', 'participant', 'task_id', 'status') + FIELDS + DEBUG_FIELDS + TIMING_FIELDS
+
+def iter_csv(documents, chunk_size:int=1<<16):
+    """
+    Turn trial documents into CSV text (with a header row), yielded in chunks of about chunk_size characters
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS, extrasaction='ignore')
+    writer.writeheader()
+    for document in documents:
+        writer.writerow(document)
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def iter_gzip(chunks):
+    """
+    Gzip a stream of text chunks on the fly
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+def iter_parquet(documents, batch_size:int=10000, chunk_size:int=1<<20):
+    """
+    Write trial documents to a Parquet file in row groups of batch_size trials and yield the file in chunks.
+    The file is built in a temporary file, so memory use does not grow with the number of trials. Needs pyarrow.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ('collection', pa.string()), ('participant', pa.string()), ('task_id', pa.int64()), ('status', pa.string()),
+        ('trial', pa.int32()), ('state', pa.int32()), ('response', pa.string()), ('reward', pa.int32()),
+        ('time', pa.string()),
+    ] + [(field, pa.int32()) for field in DEBUG_FIELDS]
+      + [(field, pa.int64()) for field in SERVER_TIMING_FIELDS]
+      + [(field, pa.float64()) for field in CLIENT_TIMING_FIELDS])
+
+    def write_batch(writer, batch):
+        writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+
+    with tempfile.TemporaryFile() as file:
+        with pq.ParquetWriter(file, schema) as writer:
+            batch = []
+            for document in documents:
+                batch.append(document)
+                if len(batch) >= batch_size:
+                    write_batch(writer, batch)
+                    batch = []
+            if len(batch) > 0:
+                write_batch(writer, batch)
+        file.seek(0)
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return False
+    return True
@@ -0,0 +1,158 @@
+import sys
+import time
+import threading
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from .storage import TRIAL_COLLECTION
+
+class ParticipantIndex:
+
+    def __init__(self, db:object, ttl:float=60) -> None:
+        """
+        Index of participants and of the tasks they played, kept in the participants (one document per uniqueID) and
+        assignments (one document per uniqueID and task, with the status of the session: 'live' while it is running,
+        then 'complete' or 'incomplete') collections, with an in-process cache of the played tasks refreshed after ttl
+        seconds
+        """
+        self.db = db
+        self.ttl = ttl
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.ready = False
+
+    def ensure(self) -> None:
+        """
+        Create the indexes, and fill the collections from the existing trial collections the first time
+        """
+        if self.ready:
+            return
+        with self.lock:
+            if self.ready:
+                return
+            self.db['assignments'].create_index([('participant', 1), ('task_id', 1)], unique=True)
+            if self.db['assignments'].estimated_document_count() == 0:
+                self.rebuild()
+            self.ready = True
+
+    def rebuild(self) -> int:
+        """
+        Fill the index from the names of the trial collections (scans every collection once) and from the sessions in
+        the consolidated trials collection. Returns the number of assignments found.
+        """
+        statuses = {}
+        def add(uniqueID, task_id, status):
+            # a live collection left over by a late write does not reopen a closed session
+            if statuses.get((uniqueID, task_id), 'live') == 'live':
+                statuses[(uniqueID, task_id)] = status
+        names = self.db.list_collection_names()
+        for name in names:
+            match = TRIAL_COLLECTION.match(name)
+            if match is not None:
+                add(match.group(1), int(match.group(2)), match.group(3)[1:] if match.group(3) else 'complete')
+        if 'trials' in names:
+            for group in self.db['trials'].aggregate([{'$group': {'_id': {'participant': '$participant', 'task_id': '$task_id',
+                                                                          'status': '$status'}}}]):
+                add(group['_id']['participant'], int(group['_id']['task_id']), group['_id']['status'])
+        participants = sorted({uniqueID for uniqueID, _ in statuses})
+        assignments = sorted(statuses)
+        # insert in batches, skipping the documents that already exist
+        for i in range(0, len(participants), 1000):
+            try:
+                self.db['participants'].insert_many([{'_id': uniqueID} for uniqueID in participants[i:i+1000]], ordered=False)
+            except BulkWriteError:
+                pass
+        for i in range(0, len(assignments), 1000):
+            try:
+                self.db['assignments'].insert_many([{'participant': uniqueID, 'task_id': task_id,
+                                                     'status': statuses[(uniqueID, task_id)]}
+                                                    for uniqueID, task_id in assignments[i:i+1000]], ordered=False)
+            except BulkWriteError:
+                pass
+        self.cache.clear()
+        return len(assignments)
+
+    def played_tasks(self, uniqueID:str) -> set:
+        """
+        Get the task ids the participant has already played (sessions that were closed)
+        """
+        self.ensure()
+        cached = self.cache.get(uniqueID)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        tasks = frozenset(document['task_id'] for document in
+                          self.db['assignments'].find({'participant': uniqueID, 'status': {'$ne': 'live'}},
+                                                      {'task_id': 1, '_id': 0}))
+        self.cache[uniqueID] = (time.monotonic()+self.ttl, tasks)
+        return tasks
+
+    def invalidate(self, uniqueID:str) -> None:
+        """
+        Drop the cached tasks of a participant (e.g. when a session starts, as the participant's tasks are about to change)
+        """
+        self.cache.pop(uniqueID, None)
+
+    def is_taken(self, uniqueID:str) -> bool:
+        """
+        Check if the uniqueID was already given out or used
+        """
+        self.ensure()
+        return self.db['participants'].find_one({'_id': uniqueID}, {'_id': 1}) is not None
+
+    def register(self, uniqueID:str) -> bool:
+        """
+        Reserve a new uniqueID. Returns False if it is already taken.
+        """
+        self.ensure()
+        try:
+            self.db['participants'].insert_one({'_id': uniqueID})
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def start_session(self, uniqueID:str, task_id:int) -> None:
+        """
+        Record that the participant started a session of a task (a session that was already closed stays closed)
+        """
+        self.ensure()
+        self.db['participants'].update_one({'_id': uniqueID}, {'$setOnInsert': {'_id': uniqueID}}, upsert=True)
+        self.db['assignments'].update_one({'participant': uniqueID, 'task_id': int(task_id)},
+                                          {'$setOnInsert': {'participant': uniqueID, 'task_id': int(task_id), 'status': 'live'}},
+                                          upsert=True)
+
+    def close_session(self, uniqueID:str, task_id:int, complete:bool) -> None:
+        """
+        Record that the participant played a task, closing its session as complete or incomplete
+        """
+        self.ensure()
+        self.db['participants'].update_one({'_id': uniqueID}, {'$setOnInsert': {'_id': uniqueID}}, upsert=True)
+        self.db['assignments'].update_one({'participant': uniqueID, 'task_id': int(task_id)},
+                                          {'$set': {'status': 'complete' if complete else 'incomplete'}}, upsert=True)
+        self.invalidate(uniqueID)
+
+    def cancel_session(self, uniqueID:str, task_id:int) -> None:
+        """
+        Forget a session that ended without any trials, so that the task can be played again
+        """
+        self.db['assignments'].delete_one({'participant': uniqueID, 'task_id': int(task_id), 'status': 'live'})
+
+    def live_task(self, uniqueID:str) -> int:
+        """
+        Task id of a session of the participant that was never closed (e.g. because its worker died), or None
+        """
+        self.ensure()
+        document = self.db['assignments'].find_one({'participant': uniqueID, 'status': 'live'}, {'task_id': 1, '_id': 0})
+        return None if document is None else document['task_id']
+
+    def is_closed(self, uniqueID:str, task_id:int) -> bool:
+        """
+        Whether the session of the participant on a task was closed
+        """
+        return self.db['assignments'].find_one({'participant': uniqueID, 'task_id': int(task_id), 'status': {'$ne': 'live'}},
+                                               {'_id': 1}) is not None
+
+if __name__ == "__main__":
+    # python -m app.index rebuild
+    if sys.argv[1:] != ['rebuild']:
+        print('Usage: python -m app.index rebuild')
+        sys.exit(1)
+    from .main import DB
+    print('Indexed {} sessions.'.format(ParticipantIndex(DB).rebuild()))
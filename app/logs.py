@@ -0,0 +1,43 @@
+import logging
+import threading
+import time
+
+class RateLimitFilter(logging.Filter):
+
+    def __init__(self, rate:int=10, interval:float=60) -> None:
+        """
+        Let through at most rate records with the same message template per interval seconds, so that a message
+        logged on every trial cannot flood the logs. The number of dropped records is added to the next one let through.
+        """
+        super().__init__()
+        self.rate = rate
+        self.interval = interval
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record:logging.LogRecord) -> bool:
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            start, count, dropped = self.windows.get(key, (now, 0, 0))
+            if now-start >= self.interval:
+                start, count = now, 0
+            if count >= self.rate:
+                self.windows[key] = (start, count, dropped+1)
+                return False
+            self.windows[key] = (start, count+1, 0)
+        if dropped > 0:
+            record.msg = '{} ({} similar messages suppressed)'.format(record.msg, dropped)
+        return True
+
+def configure_logging(level:str='INFO', rate:int=10, interval:float=60) -> None:
+    """
+    Log to stderr at the given level, rate limited per message template
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s'))
+    handler.addFilter(RateLimitFilter(rate, interval))
+    logger = logging.getLogger('app')
+    logger.handlers = [handler]
+    logger.setLevel(level.upper())
+    logger.propagate = False
@@ -1,5 +1,17 @@
-from flask import Flask, jsonify, render_template, request, redirect, Response
+from flask import Flask, jsonify, render_template, request, redirect, Response, stream_with_context, g
 from .experiments import MultiLevelMarkov
+from .store import make_store
+from .storage import make_storage
+from .writebehind import WriteBehindQueue
+from .index import ParticipantIndex
+from .optimal import OptimalReturns
+from .stats import StudyStats
+from .assignment import make_scheduler
+from .db import MongoDatabase, DatabaseUnavailable, PoolStats, client_settings
+from .assets import Assets
+from .export import iter_csv, iter_gzip, iter_parquet, parquet_available
+from .metrics import REGISTRY, REQUEST_LATENCY, MONGO_LATENCY, SESSION_LATENCY, TRIAL_LATENCY, REACTION_TIME, Gauge, MongoCommandTimer, TimedSessionInterface
+from .logs import configure_logging
 
 # add support for server-side sessions to identify different users
 from flask_session import Session
@@ -7,71 +19,75 @@ from flask import session
 
 # data manipulation
 import numpy as np
-import pandas as pd
 import os
+import hmac
+import math
+import time
+import logging
 
-# load environment variables and pymongo
+# load environment variables
 from dotenv import load_dotenv
-from pymongo import MongoClient
 
 # load the environment variables
 load_dotenv()
 
-# create a function to connect to the mongodb database
-def connect_to_db():
-    """
-    Connect to the mongodb database
-    """
-    try:
-        # get the mongodb credentials
-        mongodb_url = os.environ.get('MONGO_URL')
-        mongodb_dbname = os.environ.get('MONGO_DBNAME')
-
-        print('Connecting to the database at {}'.format(mongodb_url))
+# leveled logging, rate limited per message so that per-trial messages cannot flood the logs
+configure_logging(os.environ.get('LOG_LEVEL', 'INFO'),
+                  rate=int(os.environ.get('LOG_RATE_LIMIT', 10)),
+                  interval=float(os.environ.get('LOG_RATE_INTERVAL', 60)))
+logger = logging.getLogger(__name__)
 
-        # connect to the database
-        client = MongoClient(mongodb_url)
-        db = client[mongodb_dbname]
-        return db,client
-    except:
-        print('Error connecting to the database. Please check.')
+# connection pool statistics of this process
+mongo_pool = PoolStats()
 
-# connect to the database
-DB,client = connect_to_db()
+# connect to the mongodb database on first use, with one client per worker process (clients are not fork-safe)
+DB = MongoDatabase(os.environ.get('MONGO_URL'), os.environ.get('MONGO_DBNAME'), client_settings(os.environ),
+                   listeners=[MongoCommandTimer(MONGO_LATENCY), mongo_pool],
+                   retries=int(os.environ.get('MONGO_CONNECT_RETRIES', 3)),
+                   backoff=float(os.environ.get('MONGO_CONNECT_BACKOFF', 0.5)))
 
 # create the flask app
 app = Flask(__name__, template_folder='../templates',static_folder='../static')
-app.config['SESSION_TYPE'] = 'filesystem'
-app.config['SESSION_FILE_DIR'] = '/tmp/'
-app.config['SESSION_PERMANENT'] = True
 app.config['PERMANENT_SESSION_LIFETIME'] = 3600
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
-Session(app)
+# the session only holds the uniqueID, so by default it lives in a cookie signed with SECRET_KEY
+# (SESSION_BACKEND=filesystem keeps server-side session files in SESSION_FILE_DIR instead)
+if os.environ.get('SESSION_BACKEND', 'cookie') == 'filesystem':
+    app.config['SESSION_TYPE'] = 'filesystem'
+    app.config['SESSION_FILE_DIR'] = os.environ.get('SESSION_FILE_DIR', '/tmp/')
+    app.config['SESSION_PERMANENT'] = True
+    Session(app)
+# time loading and saving the sessions
+app.session_interface = TimedSessionInterface(app.session_interface, SESSION_LATENCY)
+# fingerprinted, precompressed static files (built by python -m app.assets build)
+assets = Assets(app)
 
 task_ids = [3151,13151]
+task_quotas = {} # most complete sessions per task id (tasks not listed have no limit)
 max_trials = 500
 min_trials = 30
 naive_trials = 5
 max_winnings = 15 # in dollars
 unit_winnings = max_winnings/(300*(max_trials-naive_trials)) # in dollars
+prefetch_depth = 6 # levels of upcoming trials sent to the client (0 to disable prefetching)
+max_prefetch_depth = 10
 
-def valid_tasks(uniqueID,db,all_task_ids):
-    """
-    Return a list of valid task ids for the user
-    """
-    already_played = []
-    # look through the collections in the database
-    collections = db.list_collection_names()
-    for collection in collections:
-        # check if the collection is for the user
-        if uniqueID == collection.split('_')[0]:
-            # get the task ids
-            already_played.append(int(collection.split('_')[1]))
-    if app.debug:
-        print("Already played: {}".format(already_played))
-    # remove the task ids from the list of all task ids
-    valid_tasks = [task_id for task_id in all_task_ids if task_id not in already_played]
-    return valid_tasks
+# most points that can be earned on each task, to report scores as a fraction of optimal
+optimal_returns = OptimalReturns(horizon=max_trials-naive_trials)
+
+def fraction_of_optimal(experiment):
+        """
+        Points earned so far as a fraction of the most that could have been earned in as many trials
+        """
+        fraction = optimal_returns.fraction(experiment.task_id, experiment.current_points,
+                                            experiment.current_trial-experiment.naive_trials)
+        return None if fraction is None else round(fraction,4)
+
+# per-task session counts, trial counts, points and payouts, updated as sessions are written
+study_stats = StudyStats(DB, unit_winnings, ttl=float(os.environ.get('STATS_CACHE_TTL', 10)))
+
+# index of participants and the tasks they already played
+participant_index = ParticipantIndex(DB, ttl=float(os.environ.get('INDEX_CACHE_TTL', 60)))
 
 def verify_uid(uniqueID):
     """
@@ -83,7 +99,133 @@ def verify_uid(uniqueID):
         return False
     return True
 
-experiments = {}
+# trials are written to the database in the background while the session is running, in one collection per
+# session or, with TRIAL_STORAGE=consolidated, in a single trials collection. Closing a session records it in the
+# participant index.
+trial_writer = WriteBehindQueue(make_storage(os.environ.get('TRIAL_STORAGE'), DB, participant_index),
+                                batch_size=int(os.environ.get('TRIAL_BATCH_SIZE', 50)),
+                                flush_interval=float(os.environ.get('TRIAL_FLUSH_INTERVAL', 5)))
+
+def evict_experiment(uniqueID, experiment):
+        """
+        Close the session of an experiment dropped from the store (abandoned, or to make room) as incomplete
+        """
+        confirmation = experiment.write_to_database(uniqueID, trial_writer, incomplete=True, stats=study_stats)
+        if confirmation == "no_trials":
+                participant_index.cancel_session(uniqueID, experiment.task_id)
+        assignments.finish(uniqueID, experiment.task_id, complete=False)
+
+# running experiments, shared between workers when EXPERIMENT_STORE=sqlite. Experiments idle for longer than a
+# session lasts, or the least recently used ones beyond EXPERIMENT_CACHE_SIZE, are closed as incomplete on a
+# background thread.
+experiments = make_store(os.environ.get('EXPERIMENT_STORE'), DB, os.environ.get('EXPERIMENT_STORE_PATH'),
+                         max_size=int(os.environ.get('EXPERIMENT_CACHE_SIZE', 10000)),
+                         ttl=float(os.environ.get('EXPERIMENT_TTL', app.config['PERMANENT_SESSION_LIFETIME'])),
+                         on_evict=evict_experiment)
+
+# balanced assignment of the tasks: the least filled task the participant has not played, counting complete and
+# running sessions (shared between workers when EXPERIMENT_STORE=sqlite). Reservations of sessions that never end
+# are released after ASSIGNMENT_TIMEOUT seconds.
+assignments = make_scheduler(os.environ.get('EXPERIMENT_STORE'), task_ids, study_stats, task_quotas,
+                             timeout=float(os.environ.get('ASSIGNMENT_TIMEOUT', experiments.ttl)),
+                             path=os.environ.get('EXPERIMENT_STORE_PATH'))
+
+REGISTRY.register(Gauge('active_experiments', 'Number of running experiments', lambda: len(experiments)))
+REGISTRY.register(Gauge('mongodb_clients_created', 'MongoDB clients created by this process', lambda: DB.clients_created))
+REGISTRY.register(Gauge('mongodb_pool_open_connections', 'Open connections in the MongoDB pool',
+                        lambda: mongo_pool.counts['open']))
+REGISTRY.register(Gauge('mongodb_pool_checked_out_connections', 'Connections of the MongoDB pool in use',
+                        lambda: mongo_pool.counts['checked_out']))
+REGISTRY.register(Gauge('mongodb_pool_checkouts_total', 'Connections checked out of the MongoDB pool',
+                        lambda: mongo_pool.counts['checkouts'], kind='counter'))
+REGISTRY.register(Gauge('mongodb_pool_checkout_failures_total', 'Failed checkouts from the MongoDB pool (e.g. wait queue timeouts)',
+                        lambda: mongo_pool.counts['checkout_failures'], kind='counter'))
+REGISTRY.register(Gauge('mongodb_pool_connections_created_total', 'Connections opened by the MongoDB pool',
+                        lambda: mongo_pool.counts['created'], kind='counter'))
+
+@app.errorhandler(DatabaseUnavailable)
+def database_unavailable(error):
+        """
+        Tell the participant to come back later instead of failing with an unrelated error
+        """
+        logger.error("%s", error)
+        message = "The experiment is temporarily unavailable. Please try again in a few minutes."
+        return render_template("failed.html",message=message,addl_message=""), 503
+
+@app.before_request
+def start_timer():
+        g.request_start = time.perf_counter()
+        # when the request arrived, on the monotonic clock stored with the trials it records
+        g.receive_ns = time.monotonic_ns()
+
+@app.after_request
+def record_latency(response):
+        """
+        Add the time spent handling the request to the histogram of its route (streamed responses are timed up to their first byte)
+        """
+        start = g.pop("request_start", None)
+        if start is not None:
+                route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+                REQUEST_LATENCY.observe(time.perf_counter()-start, route, request.method, response.status_code)
+        return response
+
+def record_trial(uniqueID, experiment, response, reward):
+        """
+        Record the response for the current trial, with when the request arrived and how long it took to record it,
+        and queue it for writing to the database
+        """
+        experiment.record_response(response, reward)
+        trial = experiment.current_trial-1
+        receive_ns = g.get("receive_ns")
+        if receive_ns is not None:
+                experiment.log.set_timings(trial, server_receive_ns=receive_ns,
+                                           server_process_ns=time.monotonic_ns()-receive_ns)
+        trial_writer.put(uniqueID, experiment.task_id, experiment.log.document(trial, experiment.debug))
+
+def timing_ms(value):
+        """
+        A performance.now() value sent by the page as a float, or None if it is not a finite number
+        """
+        if type(value) not in (int, float):
+                return None
+        try:
+                value = float(value)
+        except OverflowError:
+                # integers too large for a float
+                return None
+        return value if math.isfinite(value) else None
+
+def record_timings(uniqueID, experiment, origin, timings):
+        """
+        Log the performance.now() timings the page measured for recorded trials, queue them for writing to the database
+        and add them to the latency metrics. Returns the number of trials whose timings were accepted.
+        """
+        accepted = 0
+        for timing in timings[:experiment.max_trials]:
+                trial = timing.get("trial") if isinstance(timing, dict) else None
+                # only trials already recorded, whose document was queued before these timings
+                # (booleans are ints too, and would index every trial of the log)
+                if type(trial) is not int or not 0 <= trial < experiment.current_trial:
+                        continue
+                values = {field: value for field, value in
+                          (("client_"+event, timing_ms(timing.get(event))) for event in ("onset", "click", "reward", "sent", "received"))
+                          if value is not None}
+                if len(values) == 0:
+                        continue
+                if timing_ms(origin) is not None:
+                        values["client_origin"] = timing_ms(origin)
+                experiment.log.set_timings(trial, **values)
+                trial_writer.put(uniqueID, experiment.task_id, dict(values, trial=trial), update=True)
+                accepted += 1
+                # split the round trip seen by the page into server and network time
+                logged = experiment.log.timings(trial)
+                if logged["client_sent"] is not None and logged["client_received"] is not None and logged["server_process_ns"] is not None:
+                        server = logged["server_process_ns"]/1e9
+                        TRIAL_LATENCY.observe(server, "server")
+                        TRIAL_LATENCY.observe(max(0, (logged["client_received"]-logged["client_sent"])/1e3-server), "network")
+                if logged["client_onset"] is not None and logged["client_click"] is not None:
+                        REACTION_TIME.observe(max(0, (logged["client_click"]-logged["client_onset"])/1e3))
+        return accepted
  
 @app.route("/")
 def home_view():
@@ -93,13 +235,28 @@ def home_view():
         # if logged in, check if the user has an experiment
         if session.get("uniqueID") in experiments:
                 return redirect("/experiment")
-        # if not, create a new experiment
         session_id = session.get("uniqueID")
-        # get a random task id from the list of valid task ids
-        valid = valid_tasks(session_id,DB,task_ids)
-        if len(valid) == 0:
+        # resume a session that was started but never closed (e.g. after a worker restart)
+        task_id = participant_index.live_task(session_id)
+        if task_id is not None:
+                experiment = MultiLevelMarkov(task_id,max_trials,min_trials,naive_trials,DB,debug=app.debug)
+                experiment.replay(trial_writer.storage.live_trials(session_id, task_id))
+                experiments[session_id] = experiment
+                assignments.reserve(session_id, task_id)
+                # the played tasks cached by this worker will be stale once this session ends
+                participant_index.invalidate(session_id)
+                return redirect("/experiment")
+        # if not, create a new experiment
+        # get the least filled task among the ones the user has not played yet
+        already_played = participant_index.played_tasks(session_id)
+        if app.debug:
+                logger.debug("Already played: %s", sorted(already_played))
+        task_id = assignments.assign(session_id, exclude=already_played)
+        if task_id is None:
                 return render_template("notasks.html")
-        task_id = np.random.choice(valid)
+        participant_index.start_session(session_id, task_id)
+        # the played tasks cached by this worker will be stale once this session ends
+        participant_index.invalidate(session_id)
         # check if app is in debug mode
         if app.debug:
                 experiments[session_id] = MultiLevelMarkov(task_id,max_trials,min_trials,naive_trials,DB,debug=True)
@@ -118,6 +275,7 @@ def login_view():
                         message = "The uniqueID you provided is not valid. Please try again."
                         return render_template("failed.html",message=message,addl_message="")
                 session["uniqueID"] = input_uid
+                session.permanent = True
                 # redirect to the home page
                 return redirect("/")
 
@@ -130,6 +288,7 @@ def login_view():
                         return render_template("failed.html",message=message,addl_message="")
                 # store the username in the session
                 session["uniqueID"] = input_uid
+                session.permanent = True
                 # redirect to the home page
                 return redirect("/")
         
@@ -138,14 +297,24 @@ def login_view():
 # logout
 @app.route("/logout")
 def logout_view():
-        if not session.get("uniqueID") or session.get("uniqueID") not in experiments:
+        if not session.get("uniqueID"):
                 return redirect("/login")
-        # write experiment data to database
+        # remove the experiment from the store
         session_id = session.get("uniqueID")
-        experiment = experiments[session_id]
-        confirmation = experiment.write_to_database(session_id)
-        # remove the experiment from the dictionary
-        del experiments[session_id]
+        experiment = experiments.pop(session_id)
+        if experiment is None:
+                return redirect("/login")
+        # write experiment data to database
+        try:
+                confirmation = experiment.write_to_database(session_id, trial_writer, stats=study_stats)
+        except DatabaseUnavailable:
+                # keep the session running so that logging out can be retried
+                experiments[session_id] = experiment
+                raise
+        if confirmation == "no_trials":
+                participant_index.cancel_session(session_id, experiment.task_id)
+        assignments.finish(session_id, experiment.task_id,
+                           complete=confirmation not in ("no_trials", "not_enough_trials"))
         # remove the uniqueID from the sessions
         session.pop("uniqueID", None)
         if request.args.get("direct")=='yes':
@@ -165,39 +334,76 @@ def logout_view():
 # download all data
 @app.route("/download")
 def download_view():
-        # find all collections
-        collections = DB.list_collection_names()
-        # loop through collections and convert to pandas dataframe
-        dfs = []
-        for collection in collections:
-                df = pd.DataFrame(DB[collection].find())
-                # add collection name as a column
-                df['collection'] = collection
-                dfs.append(df)
-        # create a single dataframe
-        df = pd.concat(dfs)
-        # convert to csv
-        csv = df.to_csv(index=False)
+        """
+        Stream every stored trial as CSV (or Parquet with format=parquet). Optional filters: since=YYYY-MM-DD[ HH:MM:SS]
+        and task_id=<id>; gzip=1 compresses the CSV on the fly.
+        """
+        since = request.args.get("since")
+        task_id = request.args.get("task_id")
+        if task_id is not None:
+                try:
+                        task_id = int(task_id)
+                except ValueError:
+                        return jsonify(error="task_id must be an integer."), 400
+        trials = trial_writer.storage.iter_trials(since=since, task_id=task_id)
+        if request.args.get("format") == "parquet":
+                if not parquet_available():
+                        return jsonify(error="Parquet export needs pyarrow to be installed."), 501
+                return Response(
+                        stream_with_context(iter_parquet(trials)),
+                        mimetype="application/vnd.apache.parquet",
+                        headers={"Content-disposition":
+                                "attachment; filename=data.parquet"})
+        if request.args.get("gzip") in ("1", "yes", "true"):
+                return Response(
+                        stream_with_context(iter_gzip(iter_csv(trials))),
+                        mimetype="application/gzip",
+                        headers={"Content-disposition":
+                                "attachment; filename=data.csv.gz"})
         # send csv to client
         return Response(
-                csv,
+                stream_with_context(iter_csv(trials)),
                 mimetype="text/csv",
                 headers={"Content-disposition":
                         "attachment; filename=data.csv"})
 
+# token giving access to the study dashboard (/stats), which is disabled when it is not set
+admin_token = os.environ.get('ADMIN_TOKEN')
 
+def is_admin():
+        """
+        Check the admin token, sent as an "Authorization: Bearer <token>" header or a token query parameter
+        """
+        if not admin_token:
+                return False
+        authorization = request.headers.get("Authorization", "")
+        token = authorization[7:] if authorization.startswith("Bearer ") else request.args.get("token", "")
+        return hmac.compare_digest(token.encode(), admin_token.encode())
+
+@app.route("/stats")
+def stats_view():
+        """
+        Sessions (complete and incomplete), trial counts, mean points and payouts of each task of the study, from the
+        aggregates kept up to date as sessions end (the trials themselves are not read), and the complete and running
+        sessions counted by the task assignment. Only for admins (see ADMIN_TOKEN).
+        """
+        if not admin_token:
+                return jsonify(error="The dashboard is disabled (ADMIN_TOKEN is not set)."), 404
+        if not is_admin():
+                return jsonify(error="A valid admin token is needed."), 401, {"WWW-Authenticate": "Bearer"}
+        counts = assignments.counts()
+        return jsonify(assignment={str(task_id): {"complete": complete, "running": running}
+                                   for task_id, (complete, running) in counts.items()},
+                       **study_stats.summary(task_ids))
 
 # generate new UniqueID
 @app.route("/generateID", methods=["GET", "POST"])
 def generateID_view():
-        # generate a random alphanumeric string of length 7
-        uniqueID = ''.join(np.random.choice(list('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'),10))
-        # check if the uniqueID already exists in database by looping through all collections and checking if the uniqueID is in the collection name
-        collections = DB.list_collection_names()
-        for collection in collections:
-                if uniqueID in collection:
-                        # if the uniqueID exists, generate a new one
-                        return redirect("/generateID")
+        # generate random alphanumeric strings of length 10 until one can be reserved in the participant index
+        while True:
+                uniqueID = ''.join(np.random.choice(list('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'),10))
+                if participant_index.register(uniqueID):
+                        break
         # if the uniqueID does not exist, show a page with the uniqueID and a link to redirect to the login page with the uniqueID
         return render_template("newID.html",id=uniqueID)
 
@@ -209,7 +415,7 @@ def experiment_view():
                 return redirect("/login")
         # experiment = experiments[session.get("uniqueID")]
         # experiment.reset()
-        return render_template("experiment.html")
+        return render_template("experiment.html", prefetch_depth=prefetch_depth)
 
 # GET requests
 
@@ -218,68 +424,68 @@ def get_left_string():
         """
         Get the string for the left option
         """
-        if not session.get("uniqueID") or session.get("uniqueID") not in experiments:
-                return redirect("/login")
-        experiment = experiments[session.get("uniqueID")]
-        left_string, _, _, _ = experiment.get_next_trial()
-        # max trials reached
-        if left_string is None:
-                return redirect("/logout")
-        # send the string to the client as a json object
-        return jsonify(left_string=left_string)
+        with experiments.checkout(session.get("uniqueID")) as experiment:
+                if experiment is None:
+                        return redirect("/login")
+                left_string, _, _, _ = experiment.get_next_trial()
+                # max trials reached
+                if left_string is None:
+                        return redirect("/logout")
+                # send the string to the client as a json object
+                return jsonify(left_string=left_string)
 
 @app.route("/get_right_string")
 def get_right_string():
         """
         Get the string for the right option
         """
-        if not session.get("uniqueID") or session.get("uniqueID") not in experiments:
-                return redirect("/login")
-        experiment = experiments[session.get("uniqueID")]
-        _, _, right_string, _ = experiment.get_next_trial()
-        # max trials reached
-        if right_string is None:
-                return redirect("/logout")
-        # send the string to the client as a json object
-        return jsonify(right_string=right_string)
+        with experiments.checkout(session.get("uniqueID")) as experiment:
+                if experiment is None:
+                        return redirect("/login")
+                _, _, right_string, _ = experiment.get_next_trial()
+                # max trials reached
+                if right_string is None:
+                        return redirect("/logout")
+                # send the string to the client as a json object
+                return jsonify(right_string=right_string)
 
 @app.route("/get_points_and_trial")
 def get_points_and_trial():
         """
         Get the current points and trials
         """
-        if not session.get("uniqueID") or session.get("uniqueID") not in experiments:
+        experiment = experiments.get(session.get("uniqueID")) if session.get("uniqueID") else None
+        if experiment is None:
                 return redirect("/login")
-        experiment = experiments[session.get("uniqueID")]
         points = experiment.current_points
         trial = experiment.current_trial
         winnings = round(points*unit_winnings,2) # round to 2 decimal places
         # send the string to the client as a json object
-        return jsonify(points=points, trial=trial, winnings=winnings)
+        return jsonify(points=points, trial=trial, winnings=winnings, fraction_optimal=fraction_of_optimal(experiment))
 
 @app.route("/get_left_reward")
 def get_left_reward():
         """
         Get the reward for the left option
         """
-        if not session.get("uniqueID") or session.get("uniqueID") not in experiments:
-                return redirect("/login")
-        experiment = experiments[session.get("uniqueID")]
-        _, left_reward, _, _ = experiment.get_next_trial()
-        # send the string to the client as a json object
-        return jsonify(left_reward=left_reward)
+        with experiments.checkout(session.get("uniqueID")) as experiment:
+                if experiment is None:
+                        return redirect("/login")
+                _, left_reward, _, _ = experiment.get_next_trial()
+                # send the string to the client as a json object
+                return jsonify(left_reward=left_reward)
 
 @app.route("/get_right_reward")
 def get_right_reward():
         """
         Get the reward for the right option
         """
-        if not session.get("uniqueID") or session.get("uniqueID") not in experiments:
-                return redirect("/login")
-        experiment = experiments[session.get("uniqueID")]
-        _, _, _, right_reward = experiment.get_next_trial()
-        # send the string to the client as a json object
-        return jsonify(right_reward=right_reward)
+        with experiments.checkout(session.get("uniqueID")) as experiment:
+                if experiment is None:
+                        return redirect("/login")
+                _, _, _, right_reward = experiment.get_next_trial()
+                # send the string to the client as a json object
+                return jsonify(right_reward=right_reward)
 
 # record responses
 @app.route("/left_response")
@@ -287,30 +493,157 @@ def left_response():
         """
         Record the response for the left option
         """
-        if not session.get("uniqueID") or session.get("uniqueID") not in experiments:
-                return redirect("/login")
-        experiment = experiments[session.get("uniqueID")]
-        left_string, left_reward, _, _ = experiment.get_next_trial()
-        experiment.record_response(left_string, left_reward)
-        print("left response recorded")
-        return jsonify(success=True)
+        with experiments.checkout(session.get("uniqueID")) as experiment:
+                if experiment is None:
+                        return redirect("/login")
+                left_string, left_reward, _, _ = experiment.get_next_trial()
+                record_trial(session.get("uniqueID"), experiment, left_string, left_reward)
+                logger.debug("left response recorded")
+                return jsonify(success=True)
 
 @app.route("/right_response")
 def right_response():
         """
         Record the response for the right option
         """
-        if not session.get("uniqueID") or session.get("uniqueID") not in experiments:
-                return redirect("/login")
-        experiment = experiments[session.get("uniqueID")]
-        _, _, right_string, right_reward = experiment.get_next_trial()
-        experiment.record_response(right_string, right_reward)
-        print("right response recorded")
-        return jsonify(success=True)
+        with experiments.checkout(session.get("uniqueID")) as experiment:
+                if experiment is None:
+                        return redirect("/login")
+                _, _, right_string, right_reward = experiment.get_next_trial()
+                record_trial(session.get("uniqueID"), experiment, right_string, right_reward)
+                logger.debug("right response recorded")
+                return jsonify(success=True)
+
+def trial_payload(experiment):
+        """
+        Everything the client needs to show the next trial
+        """
+        left_string, left_reward, right_string, right_reward = experiment.get_next_trial()
+        points = experiment.current_points
+        winnings = round(points*unit_winnings,2) # round to 2 decimal places
+        return dict(left_string=left_string, right_string=right_string,
+                    left_reward=left_reward, right_reward=right_reward,
+                    points=points, trial=experiment.current_trial, winnings=winnings,
+                    fraction_optimal=fraction_of_optimal(experiment), done=left_string is None)
+
+@app.route("/trial", methods=["GET", "POST"])
+def trial_view():
+        """
+        Record the choice ('left' or 'right') made on the given trial and return the next trial.
+        Without a choice, or if the trial was already recorded, the current trial is returned unchanged.
+        """
+        with experiments.checkout(session.get("uniqueID")) as experiment:
+                if experiment is None:
+                        return redirect("/login")
+                choice = request.values.get("choice")
+                trial = request.values.get("trial", type=int)
+                recorded = False
+                if choice in ("left", "right") and trial == experiment.current_trial:
+                        left_string, left_reward, right_string, right_reward = experiment.get_next_trial()
+                        if left_string is not None:
+                                if choice == "left":
+                                        record_trial(session.get("uniqueID"), experiment, left_string, left_reward)
+                                else:
+                                        record_trial(session.get("uniqueID"), experiment, right_string, right_reward)
+                                recorded = True
+                payload = trial_payload(experiment)
+                # send the trial to the client as a json object
+                return jsonify(recorded=recorded, **payload)
+
+def prefetch_payload(experiment, depth):
+        """
+        The tree of upcoming trials along with the score at its root
+        """
+        points = experiment.current_points
+        return dict(tree=experiment.lookahead(depth), points=points, trial=experiment.current_trial,
+                    winnings=round(points*unit_winnings,2), unit_winnings=unit_winnings,
+                    max_trials=experiment.max_trials, done=experiment.current_trial >= experiment.max_trials)
+
+@app.route("/prefetch")
+def prefetch_view():
+        """
+        Get the tree of the next depth levels of (state, reward_A, reward_B) nodes from the current trial
+        """
+        with experiments.checkout(session.get("uniqueID")) as experiment:
+                if experiment is None:
+                        return redirect("/login")
+                depth = min(request.args.get("depth", prefetch_depth, type=int), max_prefetch_depth)
+                payload = prefetch_payload(experiment, depth)
+                return jsonify(**payload)
+
+@app.route("/upload_choices", methods=["POST"])
+def upload_choices():
+        """
+        Record a batch of choices made from a prefetched tree. Every choice is checked against the server's own
+        state machine; the first one that diverges (wrong trial, state or reward) rejects the rest of the batch.
+        Choices for trials that were already recorded are ignored. Returns a fresh tree from the current trial.
+        """
+        data = request.get_json(silent=True)
+        choices = data.get("choices", []) if isinstance(data, dict) else None
+        if not isinstance(choices, list) or not all(isinstance(choice, dict) for choice in choices):
+                return jsonify(error="Expected a JSON object with a list of choices."), 400
+        try:
+                depth = min(int(data.get("depth", prefetch_depth)), max_prefetch_depth)
+        except (TypeError, ValueError, OverflowError):
+                return jsonify(error="The depth must be an integer."), 400
+        with experiments.checkout(session.get("uniqueID")) as experiment:
+                if experiment is None:
+                        return redirect("/login")
+                accepted = 0
+                diverged = False
+                for choice in choices:
+                        trial = choice.get("trial")
+                        if isinstance(trial, int) and trial < experiment.current_trial:
+                                continue
+                        if trial != experiment.current_trial or choice.get("state") != int(experiment.current_state):
+                                diverged = True
+                                break
+                        left_string, left_reward, right_string, right_reward = experiment.get_next_trial()
+                        if left_string is None or choice.get("choice") not in ("left", "right"):
+                                diverged = True
+                                break
+                        if choice.get("choice") == "left":
+                                response, reward = left_string, left_reward
+                        else:
+                                response, reward = right_string, right_reward
+                        if choice.get("reward") != reward:
+                                diverged = True
+                                break
+                        record_trial(session.get("uniqueID"), experiment, response, reward)
+                        accepted += 1
+                payload = prefetch_payload(experiment, depth)
+                if diverged:
+                        logger.warning("prefetched choices of %s diverged from the server state, rejecting", session.get("uniqueID"))
+                return jsonify(accepted=accepted, diverged=diverged, **payload), 409 if diverged else 200
+
+@app.route("/timings", methods=["POST"])
+def timings_view():
+        """
+        Record a batch of trial timings measured by the page: {"origin": performance.timeOrigin, "timings": [{"trial",
+        "onset", "click", "reward", "sent", "received"}, ...]} with performance.now() values in ms.
+        Timings of trials not recorded yet are ignored.
+        """
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+                return jsonify(error="Expected a JSON object."), 400
+        with experiments.checkout(session.get("uniqueID")) as experiment:
+                if experiment is None:
+                        return redirect("/login")
+                timings = data.get("timings")
+                accepted = record_timings(session.get("uniqueID"), experiment, data.get("origin"),
+                                          timings if isinstance(timings, list) else [])
+                return jsonify(accepted=accepted)
 
 @app.route("/is_debug_mode")
 def is_debug_mode():
         """
         Check if debug mode is on
         """
-        return jsonify(debug=app.debug)
\ No newline at end of file
+        return jsonify(debug=app.debug)
+
+@app.route("/metrics")
+def metrics_view():
+        """
+        Request, MongoDB and session store latencies and the number of running experiments of this process in the Prometheus text format
+        """
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
\ No newline at end of file
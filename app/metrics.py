@@ -0,0 +1,177 @@
+import bisect
+import threading
+import time
+from pymongo import monitoring
+
+# latency buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_labels(names:tuple, values:tuple) -> str:
+    if len(names) == 0:
+        return ''
+    return '{'+','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                        for name, value in zip(names, values))+'}'
+
+class Counter:
+
+    def __init__(self, name:str, help:str, labels:tuple=()) -> None:
+        """
+        Monotonic counter, one value per combination of labels
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount:float=1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0)+amount
+
+    def render(self) -> list:
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} counter'.format(self.name)]
+        for labels, value in sorted(self.values.items()):
+            lines.append('{}{} {}'.format(self.name, format_labels(self.labels, labels), value))
+        return lines
+
+class Gauge:
+
+    def __init__(self, name:str, help:str, function, kind:str='gauge') -> None:
+        """
+        Value read from function() when the metrics are rendered (kind='counter' for values that only go up)
+        """
+        self.name = name
+        self.help = help
+        self.function = function
+        self.kind = kind
+
+    def render(self) -> list:
+        return ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind),
+                '{} {}'.format(self.name, self.function())]
+
+class Histogram:
+
+    def __init__(self, name:str, help:str, labels:tuple=(), buckets:tuple=BUCKETS) -> None:
+        """
+        Histogram of observed values (e.g. latencies in seconds), one per combination of labels
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value:float, *labels) -> None:
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # one count per bucket, +Inf, then the sum
+                counts = self.values[labels] = [0]*(len(self.buckets)+1)+[0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def time(self, *labels):
+        """
+        Context manager observing the time spent in its block
+        """
+        return Timer(self, labels)
+
+    def render(self) -> list:
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        for labels, counts in sorted(self.values.items()):
+            total = 0
+            for bucket, count in zip(self.buckets+('+Inf',), counts[:-1]):
+                total += count
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(self.labels+('le',), labels+(bucket,)), total))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(self.labels, labels), counts[-1]))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(self.labels, labels), total))
+        return lines
+
+class Timer:
+
+    def __init__(self, histogram:Histogram, labels:tuple) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.perf_counter()-self.start, *self.labels)
+
+class Registry:
+
+    def __init__(self) -> None:
+        """
+        Collection of metrics rendered together in the Prometheus text format
+        """
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return '\n'.join(lines)+'\n'
+
+class MongoCommandTimer(monitoring.CommandListener):
+
+    def __init__(self, histogram:Histogram) -> None:
+        """
+        Time every MongoDB command (insert, find, listCollections, ...) of the clients it is given to
+        """
+        self.histogram = histogram
+
+    def started(self, event) -> None:
+        pass
+
+    def succeeded(self, event) -> None:
+        self.histogram.observe(event.duration_micros/1e6, event.command_name, 'ok')
+
+    def failed(self, event) -> None:
+        self.histogram.observe(event.duration_micros/1e6, event.command_name, 'failed')
+
+class TimedSessionInterface:
+
+    def __init__(self, interface:object, histogram:Histogram) -> None:
+        """
+        Wrap a Flask session interface to time loading and saving sessions
+        """
+        self.interface = interface
+        self.histogram = histogram
+
+    def open_session(self, app, request):
+        with self.histogram.time('open'):
+            return self.interface.open_session(app, request)
+
+    def save_session(self, app, session, response):
+        with self.histogram.time('save'):
+            return self.interface.save_session(app, session, response)
+
+    def __getattr__(self, name):
+        return getattr(self.interface, name)
+
+# metrics of this process
+REGISTRY = Registry()
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    'http_request_duration_seconds', 'Time spent handling requests', ('route', 'method', 'status')))
+MONGO_LATENCY = REGISTRY.register(Histogram(
+    'mongodb_command_duration_seconds', 'Time spent in MongoDB commands', ('command', 'outcome')))
+SESSION_LATENCY = REGISTRY.register(Histogram(
+    'session_store_duration_seconds', 'Time spent loading and saving Flask sessions', ('operation',)))
+STORE_LATENCY = REGISTRY.register(Histogram(
+    'experiment_store_duration_seconds', 'Time spent loading and saving running experiments', ('operation',)))
+STORE_LOOKUPS = REGISTRY.register(Counter(
+    'experiment_store_lookups_total', 'Lookups of running experiments that found (hit) or did not find (miss) one', ('result',)))
+STORE_EVICTIONS = REGISTRY.register(Counter(
+    'experiment_store_evictions_total', 'Experiments dropped from the store because they were idle (ttl) or it was full (size)', ('reason',)))
+TRIAL_LATENCY = REGISTRY.register(Histogram(
+    'trial_latency_seconds', 'Round trip of recording a trial seen by the page, split into the time spent on the server (server) and the rest (network)',
+    ('component',), buckets=BUCKETS+(30,)))
+REACTION_TIME = REGISTRY.register(Histogram(
+    'trial_reaction_time_seconds', 'Time from stimulus onset to click reported by the page',
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 30)))
@@ -0,0 +1,57 @@
+"""
+Move the trials of the per-session collections (uniqueID_taskid, uniqueID_taskid_incomplete, uniqueID_taskid_live) into
+the consolidated trials collection used with TRIAL_STORAGE=consolidated.
+
+Collections are copied in batches and marked as migrated in the migrations collection, so an interrupted run resumes
+with the first collection not marked yet (trials are upserted, so a partly copied collection is simply copied again).
+Stop the app (or drain its sessions) before migrating live collections.
+
+Usage: python -m app.migrate [--batch-size 1000] [--drop]
+"""
+import argparse
+import time
+from .storage import TRIAL_COLLECTION, ConsolidatedStorage
+
+def migrate(db:object, batch_size:int=1000, drop:bool=False, report=print) -> (int, int):
+    """
+    Copy every per-session collection not migrated yet into the trials collection, dropping it afterwards if drop is
+    set. Returns the number of collections and trials copied.
+    """
+    storage = ConsolidatedStorage(db)
+    progress = db['migrations']
+    names = sorted(name for name in db.list_collection_names() if TRIAL_COLLECTION.match(name))
+    done = {document['_id'] for document in progress.find({'_id': {'$in': names}}, {'_id': 1})}
+    pending = [name for name in names if name not in done]
+    report('{} trial collections, {} already migrated, {} to go'.format(len(names), len(done), len(pending)))
+    start = time.monotonic()
+    n_trials = 0
+    for i, name in enumerate(pending):
+        uniqueID, task_id, status = TRIAL_COLLECTION.match(name).groups()
+        status = status[1:] if status else 'complete'
+        n_copied = 0
+        batch = []
+        for document in db[name].find({}, {'_id': 0}, batch_size=batch_size):
+            batch.append(document)
+            if len(batch) >= batch_size:
+                storage.write(uniqueID, int(task_id), batch, status=status)
+                n_copied += len(batch)
+                batch = []
+        storage.write(uniqueID, int(task_id), batch, status=status)
+        n_copied += len(batch)
+        progress.update_one({'_id': name}, {'$set': {'trials': n_copied, 'time': time.time()}}, upsert=True)
+        if drop:
+            db[name].drop()
+        n_trials += n_copied
+        elapsed = time.monotonic()-start
+        report('[{}/{}] {}: {} trials ({} in total, {:.0f} trials/s)'.format(
+            i+1, len(pending), name, n_copied, n_trials, n_trials/elapsed if elapsed > 0 else 0))
+    return len(pending), n_trials
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=1000, help='trials read and written per round-trip')
+    parser.add_argument('--drop', action='store_true', help='drop each collection once it is migrated')
+    args = parser.parse_args()
+    from .main import DB
+    n_collections, n_trials = migrate(DB, args.batch_size, args.drop)
+    print('Migrated {} trials from {} collections.'.format(n_trials, n_collections))
@@ -0,0 +1,165 @@
+import hashlib
+import os
+import sys
+import threading
+import numpy as np
+from .tasks import TaskRegistry, TASKS
+from .simulate import stack_tasks
+
+# cache of the optimal returns, one file per horizon
+OPTIMAL_FILE = "./data/optimal_{}.npz"
+
+def task_hash(state_labels:np.ndarray, state_transitions:np.ndarray) -> str:
+    """
+    Hash of the task data, used to key the cache so that edited tasks are recomputed
+    """
+    digest = hashlib.sha256()
+    for array in (state_labels, state_transitions):
+        array = np.ascontiguousarray(array, dtype=np.int32)
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+def best_returns(tasks:list, horizon:int) -> np.ndarray:
+    """
+    Largest number of points that can be earned from state 0 in 0..horizon trials, for several tasks at once
+    (an (n_tasks, horizon+1) array)
+    """
+    rewards, transitions = stack_tasks(tasks)
+    n_tasks, n_states, _ = rewards.shape
+    rows = np.arange(n_tasks)[:, None, None]
+    values = np.zeros((n_tasks, n_states), dtype=np.int64)
+    best = np.zeros((n_tasks, horizon+1), dtype=np.int64)
+    for h in range(1, horizon+1):
+        values = (rewards+values[rows, transitions]).max(axis=2)
+        best[:, h] = values[:, 0]
+    return best
+
+def optimal_cycle(state_labels:np.ndarray, state_transitions:np.ndarray) -> (float, list):
+    """
+    The cycle of states reachable from state 0 with the most points per trial, which optimal play settles into.
+    Returns (points per trial, states of the cycle); the shortest cycle wins ties.
+    """
+    rewards = np.asarray(state_labels)[state_transitions]*100
+    # states reachable from state 0
+    reachable = {0}
+    stack = [0]
+    while stack:
+        state = stack.pop()
+        for next_state in state_transitions[state]:
+            if int(next_state) not in reachable:
+                reachable.add(int(next_state))
+                stack.append(int(next_state))
+    # enumerate the simple cycles, each from its smallest state (the graphs have at most a few dozen)
+    best_gain, best_cycle = -1.0, []
+    for start in sorted(reachable):
+        stack = [(start, [start], 0)]
+        while stack:
+            state, path, points = stack.pop()
+            for response in (0, 1):
+                next_state = int(state_transitions[state][response])
+                total = points+int(rewards[state][response])
+                if next_state == start:
+                    gain = total/len(path)
+                    if gain > best_gain or (gain == best_gain and len(path) < len(best_cycle)):
+                        best_gain, best_cycle = gain, path
+                elif next_state > start and next_state not in path:
+                    stack.append((next_state, path+[next_state], total))
+    return best_gain, best_cycle
+
+class OptimalReturns:
+
+    def __init__(self, registry:TaskRegistry=TASKS, horizon:int=495, path:str=None) -> None:
+        """
+        Optimal returns of the tasks over up to horizon rewarded trials (max_trials-naive_trials). Results are read
+        from a cache on disk, keyed by a hash of each task, and computed on demand for tasks missing from it.
+        """
+        self.registry = registry
+        self.horizon = horizon
+        self.path = path or OPTIMAL_FILE.format(horizon)
+        self.results = None
+        self.lock = threading.Lock()
+
+    def load(self) -> None:
+        """
+        Read the cache (only done once per process)
+        """
+        with self.lock:
+            if self.results is not None:
+                return
+            results = {}
+            if os.path.exists(self.path):
+                with np.load(self.path) as cache:
+                    for key, best, gain, cycle in zip(cache['keys'], cache['best'], cache['gain'], cache['cycle']):
+                        results[str(key)] = (best, float(gain), cycle[cycle >= 0].tolist())
+            self.results = results
+
+    def compute(self, task_ids:list) -> int:
+        """
+        Compute the optimal returns of the tasks missing from the cache. Returns the number of tasks computed.
+        """
+        self.load()
+        keys = {}
+        for task_id in task_ids:
+            key = task_hash(*self.registry.get(task_id))
+            if key not in self.results:
+                keys[key] = task_id
+        if len(keys) == 0:
+            return 0
+        tasks = [self.registry.get(task_id) for task_id in keys.values()]
+        best = best_returns(tasks, self.horizon)
+        with self.lock:
+            for i, (key, task) in enumerate(zip(keys, tasks)):
+                self.results[key] = (best[i], *optimal_cycle(*task))
+        return len(keys)
+
+    def save(self) -> None:
+        """
+        Write the cache (atomically, so that workers never read a partial file)
+        """
+        with self.lock:
+            keys = sorted(self.results)
+            max_length = max([len(self.results[key][2]) for key in keys], default=0)
+            cycles = np.full((len(keys), max_length), -1, dtype=np.int16)
+            for i, key in enumerate(keys):
+                cycle = self.results[key][2]
+                cycles[i, :len(cycle)] = cycle
+            tmp_path = self.path+'.tmp.npz'
+            np.savez_compressed(tmp_path, keys=np.array(keys),
+                                best=np.array([self.results[key][0] for key in keys]).reshape(len(keys), self.horizon+1),
+                                gain=np.array([self.results[key][1] for key in keys]), cycle=cycles)
+            os.replace(tmp_path, self.path)
+
+    def get(self, task_id:int) -> (np.ndarray, float, list):
+        """
+        Return (best, gain, cycle) for a task: the most points that can be earned from state 0 in 0..horizon trials,
+        the points per trial of the optimal cycle and the states of that cycle
+        """
+        if self.results is None:
+            self.load()
+        key = task_hash(*self.registry.get(task_id))
+        if key not in self.results:
+            self.compute([task_id])
+        return self.results[key]
+
+    def fraction(self, task_id:int, points:int, n_trials:int) -> float:
+        """
+        Points earned in n_trials rewarded trials as a fraction of the most that could have been earned, or None before
+        any points could be earned
+        """
+        best = self.get(task_id)[0][min(max(n_trials, 0), self.horizon)]
+        if best <= 0:
+            return None
+        return points/best
+
+if __name__ == "__main__":
+    # python -m app.optimal precompute [horizon]
+    if len(sys.argv) not in (2, 3) or sys.argv[1] != 'precompute':
+        print('Usage: python -m app.optimal precompute [horizon]')
+        sys.exit(1)
+    optimal = OptimalReturns(horizon=int(sys.argv[2]) if len(sys.argv) == 3 else 495)
+    TASKS.load()
+    n_computed = optimal.compute(sorted(TASKS.tasks))
+    optimal.save()
+    print('Computed the optimal returns of {} tasks ({} cached) into {}.'.format(
+        n_computed, len(TASKS)-n_computed, optimal.path))
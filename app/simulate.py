@@ -0,0 +1,232 @@
+"""
+Offline simulation of agents playing MultiLevel Markov tasks, to estimate the score distributions of each task before it
+is launched (e.g. to calibrate unit_winnings or choose task_ids).
+
+Agents follow the same rules as MultiLevelMarkov: naive_trials trials without reward, then from state 0 each response
+moves to state_transitions[state][A=0/B=1] and earns 100 times the label of the new state. Every agent of every task in
+a batch is stepped at once as NumPy arrays, and batches of tasks are spread over a process pool.
+
+Usage: python -m app.simulate [--tasks 3151 13151] [--policies random wsls greedy softmax] [--agents 1000] [--output scores.csv]
+"""
+import argparse
+import csv
+import sys
+import time
+import numpy as np
+from .tasks import TaskRegistry, TASK_FILE
+
+class Policy:
+
+    def reset(self, n_agents:int, rng:np.random.Generator) -> None:
+        """
+        Start a new game for n_agents agents
+        """
+        pass
+
+    def choose(self, rewards:np.ndarray, rng:np.random.Generator) -> np.ndarray:
+        """
+        Get the responses (0 for A, 1 for B) of every agent. rewards holds the (reward_A, reward_B) on offer to each
+        agent, which only the policies that are told the rewards in advance may look at.
+        """
+        raise NotImplementedError
+
+    def update(self, choices:np.ndarray, rewards:np.ndarray) -> None:
+        """
+        Learn from the reward each agent got for its response
+        """
+        pass
+
+class RandomPolicy(Policy):
+
+    def choose(self, rewards:np.ndarray, rng:np.random.Generator) -> np.ndarray:
+        return rng.integers(0, 2, len(rewards))
+
+class WSLSPolicy(Policy):
+
+    def reset(self, n_agents:int, rng:np.random.Generator) -> None:
+        self.choices = rng.integers(0, 2, n_agents)
+        self.last_rewards = np.zeros(n_agents, dtype=np.int32)
+
+    def choose(self, rewards:np.ndarray, rng:np.random.Generator) -> np.ndarray:
+        return self.choices
+
+    def update(self, choices:np.ndarray, rewards:np.ndarray) -> None:
+        """
+        Win-stay lose-shift: keep the same response unless the reward dropped
+        """
+        self.choices = np.where(rewards < self.last_rewards, 1-choices, choices)
+        self.last_rewards = rewards
+
+class GreedyPolicy(Policy):
+
+    def choose(self, rewards:np.ndarray, rng:np.random.Generator) -> np.ndarray:
+        """
+        Take the larger of the rewards on offer (ties broken at random). Participants only see the reward after
+        responding, so this is a myopic upper reference rather than a model of behaviour.
+        """
+        ties = rewards[:, 0] == rewards[:, 1]
+        return np.where(ties, rng.integers(0, 2, len(rewards)), rewards[:, 1] > rewards[:, 0])
+
+class SoftmaxQPolicy(Policy):
+
+    def __init__(self, alpha:float=0.2, beta:float=3.0) -> None:
+        """
+        Q-learning over (last reward, response) with softmax responses: alpha is the learning rate, beta the inverse
+        temperature on rewards scaled to 0-3
+        """
+        self.alpha = alpha
+        self.beta = beta
+
+    def reset(self, n_agents:int, rng:np.random.Generator) -> None:
+        self.q = np.zeros((n_agents, 4, 2))
+        self.observations = np.zeros(n_agents, dtype=np.int64)
+        self.agents = np.arange(n_agents)
+
+    def choose(self, rewards:np.ndarray, rng:np.random.Generator) -> np.ndarray:
+        q = self.q[self.agents, self.observations]
+        p_B = 1/(1+np.exp(-self.beta*(q[:, 1]-q[:, 0])))
+        return (rng.random(len(p_B)) < p_B).astype(np.int64)
+
+    def update(self, choices:np.ndarray, rewards:np.ndarray) -> None:
+        q = self.q[self.agents, self.observations, choices]
+        self.q[self.agents, self.observations, choices] = q+self.alpha*(rewards/100-q)
+        self.observations = np.minimum(rewards//100, 3)
+
+POLICIES = {'random': RandomPolicy, 'wsls': WSLSPolicy, 'greedy': GreedyPolicy, 'softmax': SoftmaxQPolicy}
+
+def stack_tasks(tasks:list) -> (np.ndarray, np.ndarray):
+    """
+    Stack the (state_labels, state_transitions) of several tasks into (n_tasks, n_states, 2) arrays of the reward offered
+    for each response and of the state it leads to. Tasks with fewer states are padded with unreachable states.
+    """
+    n_states = max(len(state_labels) for state_labels, _ in tasks)
+    rewards = np.zeros((len(tasks), n_states, 2), dtype=np.int32)
+    transitions = np.zeros((len(tasks), n_states, 2), dtype=np.int32)
+    for i, (state_labels, state_transitions) in enumerate(tasks):
+        transitions[i, :len(state_transitions)] = state_transitions
+        rewards[i, :len(state_transitions)] = np.asarray(state_labels)[state_transitions]*100
+    return rewards, transitions
+
+def simulate(rewards:np.ndarray, transitions:np.ndarray, policy:Policy, n_agents:int, max_trials:int=500,
+             naive_trials:int=5, rng:np.random.Generator=None) -> np.ndarray:
+    """
+    Play n_agents agents on each of the stacked tasks (see stack_tasks) for max_trials trials and return their total
+    points as an (n_tasks, n_agents) array
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    n_tasks, n_states, _ = rewards.shape
+    # agents of all tasks side by side, addressed through the flattened (task, state) index
+    rewards = rewards.reshape(-1, 2)
+    transitions = transitions.reshape(-1, 2)
+    offsets = np.repeat(np.arange(n_tasks)*n_states, n_agents)
+    agents = np.arange(len(offsets))
+    states = np.zeros(len(offsets), dtype=np.int32)
+    points = np.zeros(len(offsets), dtype=np.int64)
+    no_rewards = np.zeros((len(offsets), 2), dtype=np.int32)
+    policy.reset(len(offsets), rng)
+    for trial in range(max_trials):
+        if trial < naive_trials:
+            # naive trials: no reward, and every agent starts in state 0 afterwards
+            offered = no_rewards
+        else:
+            offered = rewards[offsets+states]
+        choices = policy.choose(offered, rng)
+        earned = offered[agents, choices]
+        policy.update(choices, earned)
+        points += earned
+        if trial >= naive_trials:
+            states = transitions[offsets+states, choices]
+    return points.reshape(n_tasks, n_agents)
+
+# columns of the score distributions
+SUMMARY_FIELDS = ('task_id', 'policy', 'agents', 'mean', 'std', 'min', 'p5', 'p25', 'p50', 'p75', 'p95', 'max')
+
+def summarize(task_ids:list, policy:str, scores:np.ndarray) -> list:
+    """
+    Turn the (n_tasks, n_agents) scores of a policy into one row of summary statistics per task
+    """
+    percentiles = np.percentile(scores, [5, 25, 50, 75, 95], axis=1)
+    return [dict(zip(SUMMARY_FIELDS, (int(task_id), policy, scores.shape[1], float(scores[i].mean()),
+                                      float(scores[i].std()), int(scores[i].min()), *percentiles[:, i].tolist(),
+                                      int(scores[i].max()))))
+            for i, task_id in enumerate(task_ids)]
+
+def simulate_batch(task_ids:list, tasks:list, policies:list, n_agents:int, max_trials:int, naive_trials:int,
+                   seed:np.random.SeedSequence) -> list:
+    """
+    Simulate every policy on a batch of tasks and return the summary rows (run in the worker processes)
+    """
+    rewards, transitions = stack_tasks(tasks)
+    rows = []
+    for policy, policy_seed in zip(policies, seed.spawn(len(policies))):
+        scores = simulate(rewards, transitions, POLICIES[policy](), n_agents, max_trials, naive_trials,
+                          np.random.default_rng(policy_seed))
+        rows += summarize(task_ids, policy, scores)
+    return rows
+
+def simulate_tasks(registry:TaskRegistry, task_ids:list=None, policies:list=tuple(POLICIES), n_agents:int=1000,
+                   max_trials:int=500, naive_trials:int=5, batch_size:int=64, processes:int=None, seed:int=0):
+    """
+    Simulate the policies on the given tasks (all tasks by default) in batches of batch_size tasks spread over a pool
+    of processes, yielding the summary rows of each batch as it completes
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    registry.load()
+    if task_ids is None:
+        task_ids = sorted(registry.tasks)
+    batches = [task_ids[i:i+batch_size] for i in range(0, len(task_ids), batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+    with ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(simulate_batch, batch, [registry.get(task_id) for task_id in batch], list(policies),
+                               n_agents, max_trials, naive_trials, batch_seed)
+                   for batch, batch_seed in zip(batches, seeds)]
+        for future in futures:
+            yield future.result()
+
+def main(argv:list=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', type=int, nargs='*', help='task ids (default: every task)')
+    parser.add_argument('--policies', nargs='+', choices=sorted(POLICIES), default=list(POLICIES))
+    parser.add_argument('--agents', type=int, default=1000, help='agents per task and policy')
+    parser.add_argument('--max-trials', type=int, default=500)
+    parser.add_argument('--naive-trials', type=int, default=5)
+    parser.add_argument('--max-winnings', type=float, default=15, help='payout in dollars of the best score')
+    parser.add_argument('--batch-size', type=int, default=64, help='tasks simulated together by a process')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--task-file', default=TASK_FILE)
+    parser.add_argument('--output', default='scores.csv', help='CSV file of the score distributions per task and policy')
+    args = parser.parse_args(argv)
+
+    registry = TaskRegistry(args.task_file)
+    registry.load()
+    task_ids = args.tasks or sorted(registry.tasks)
+    missing = [task_id for task_id in task_ids if task_id not in registry]
+    if missing:
+        sys.exit('Unknown task ids: {}'.format(missing))
+
+    start = time.perf_counter()
+    done = 0
+    rows = []
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+        for batch in simulate_tasks(registry, task_ids, args.policies, args.agents, args.max_trials, args.naive_trials,
+                                    args.batch_size, args.processes, args.seed):
+            writer.writerows(batch)
+            rows += batch
+            done += len(batch)//len(args.policies)
+            print('{}/{} tasks simulated ({:.1f} s)'.format(done, len(task_ids), time.perf_counter()-start), file=sys.stderr)
+
+    print('Score distributions of {} tasks x {} agents written to {}'.format(len(task_ids), args.agents, args.output))
+    print('{:<8} {:>10} {:>10} {:>10} {:>22}'.format('policy', 'mean', 'p50', 'p95', 'unit_winnings (p95)'))
+    for policy in args.policies:
+        policy_rows = [row for row in rows if row['policy'] == policy]
+        p95 = np.mean([row['p95'] for row in policy_rows])
+        print('{:<8} {:>10.1f} {:>10.1f} {:>10.1f} {:>22.3g}'.format(
+            policy, np.mean([row['mean'] for row in policy_rows]), np.mean([row['p50'] for row in policy_rows]), p95,
+            args.max_winnings/p95 if p95 > 0 else float('nan')))
+
+if __name__ == "__main__":
+    main()
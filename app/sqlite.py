@@ -0,0 +1,44 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# database shared by the worker processes of a host when EXPERIMENT_STORE=sqlite, unless EXPERIMENT_STORE_PATH is set
+DEFAULT_PATH = '/tmp/experiments.sqlite3'
+
+class SQLiteDatabase:
+
+    def __init__(self, path:str=None) -> None:
+        """
+        A SQLite database in WAL mode that every worker process on the host can use, with one connection per thread
+        """
+        self.path = path or DEFAULT_PATH
+        self.local = threading.local()
+        self.connection().execute("PRAGMA journal_mode=WAL")
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Get the connection for this thread (connections are not shared between threads or forked processes)
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager giving the connection of this thread inside a write transaction, committed on exit and rolled
+        back on error
+        """
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
@@ -0,0 +1,189 @@
+"""
+Study dashboard aggregates: one document per task in the study_stats collection, with the number of complete and
+incomplete sessions, the distribution of their trial counts, their points and the payout owed for the complete ones.
+They are incremented with a single $inc update whenever a session is written to the database (so reading them never
+scans the trials), and can be recomputed from the stored trials with
+
+python -m app.stats rebuild   (recompute and replace the aggregates)
+python -m app.stats check     (recompute and report the tasks whose aggregates differ, without changing them)
+"""
+import sys
+import threading
+import time
+
+class StudyStats:
+
+    def __init__(self, db:object, unit_winnings:float, bin_size:int=50, ttl:float=10,
+                 collection:str='study_stats') -> None:
+        """
+        Per-task session aggregates, with trial counts binned by bin_size trials and payouts of points*unit_winnings
+        (rounded to the cent, as shown to the participant). Summaries are cached in-process for ttl seconds.
+        """
+        self.db = db
+        self.unit_winnings = unit_winnings
+        self.bin_size = bin_size
+        self.ttl = ttl
+        self.collection = collection
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def payout_cents(self, points:int) -> int:
+        return int(round(round(points*self.unit_winnings, 2)*100))
+
+    def update(self, status:str, n_trials:int, points:int) -> dict:
+        """
+        Changes to the aggregates of a task for one closed session
+        """
+        update = {
+            '$inc': {
+                'sessions.'+status: 1,
+                'trials': n_trials,
+                'points': points,
+                'trial_counts.'+str(n_trials//self.bin_size*self.bin_size): 1,
+            },
+            '$min': {'min_trials': n_trials},
+            '$max': {'max_trials': n_trials},
+        }
+        if status == 'complete':
+            update['$inc'].update({'complete_trials': n_trials, 'complete_points': points,
+                                   'payout_cents': self.payout_cents(points)})
+        return update
+
+    def record(self, task_id:int, complete:bool, n_trials:int, points:int) -> None:
+        """
+        Add a closed session to the aggregates of its task
+        """
+        self.db[self.collection].update_one({'_id': int(task_id)},
+                                            self.update('complete' if complete else 'incomplete', n_trials, points),
+                                            upsert=True)
+
+    def completed_sessions(self, task_ids:list) -> dict:
+        """
+        Get the number of complete sessions of each task (read from the aggregates, not cached)
+        """
+        return {document['_id']: document.get('sessions', {}).get('complete', 0) for document in
+                self.db[self.collection].find({'_id': {'$in': [int(task_id) for task_id in task_ids]}}, {'sessions': 1})}
+
+    def summary(self, task_ids:list) -> dict:
+        """
+        Dashboard of the given tasks, read from the aggregates at most once every ttl seconds
+        """
+        key = tuple(task_ids)
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+            documents = {document['_id']: document for document in
+                         self.db[self.collection].find({'_id': {'$in': [int(task_id) for task_id in task_ids]}})}
+            tasks = [self.describe(int(task_id), documents.get(int(task_id), {})) for task_id in task_ids]
+            summary = {
+                'tasks': tasks,
+                'total': {
+                    'complete': sum(task['sessions']['complete'] for task in tasks),
+                    'incomplete': sum(task['sessions']['incomplete'] for task in tasks),
+                    'payout': round(sum(task['payout']['total'] for task in tasks), 2),
+                },
+                'updated': time.strftime('%Y-%m-%d %H:%M:%S'),
+            }
+            self.cache[key] = (time.monotonic()+self.ttl, summary)
+            return summary
+
+    def describe(self, task_id:int, document:dict) -> dict:
+        """
+        Dashboard entry of a task from its aggregates document
+        """
+        sessions = document.get('sessions', {})
+        complete = sessions.get('complete', 0)
+        incomplete = sessions.get('incomplete', 0)
+        n_sessions = complete+incomplete
+
+        def mean(total, count, digits=1):
+            return round(total/count, digits) if count else None
+
+        return {
+            'task_id': task_id,
+            'sessions': {'complete': complete, 'incomplete': incomplete, 'total': n_sessions},
+            'trials': {
+                'total': document.get('trials', 0),
+                'mean': mean(document.get('trials', 0), n_sessions),
+                'mean_complete': mean(document.get('complete_trials', 0), complete),
+                'min': document.get('min_trials'),
+                'max': document.get('max_trials'),
+                # sessions per bin of bin_size trial counts
+                'distribution': [{'from': start, 'to': start+self.bin_size-1, 'sessions': count} for start, count in
+                                 sorted((int(start), count) for start, count in document.get('trial_counts', {}).items())],
+            },
+            'points': {
+                'mean': mean(document.get('points', 0), n_sessions),
+                'mean_complete': mean(document.get('complete_points', 0), complete),
+            },
+            'payout': {
+                'total': round(document.get('payout_cents', 0)/100, 2),
+                'mean': mean(document.get('payout_cents', 0)/100, complete, 2),
+            },
+        }
+
+    def compute(self, trials) -> dict:
+        """
+        Aggregates of every task recomputed from scratch from the stored trial documents (as yielded by the trial
+        storage's iter_trials). Sessions still running are left out, as they are only counted once closed.
+        """
+        sessions = {}
+        for document in trials:
+            if document['status'] == 'live':
+                continue
+            key = (document['participant'], document['task_id'], document['status'])
+            n_trials, points = sessions.get(key, (0, 0))
+            sessions[key] = (n_trials+1, points+int(document['reward']))
+        aggregates = {}
+        for (_, task_id, status), (n_trials, points) in sorted(sessions.items()):
+            aggregate = aggregates.setdefault(int(task_id), {'_id': int(task_id)})
+            update = self.update(status, n_trials, points)
+            for path, value in update['$inc'].items():
+                parent = aggregate
+                *parents, name = path.split('.')
+                for part in parents:
+                    parent = parent.setdefault(part, {})
+                parent[name] = parent.get(name, 0)+value
+            aggregate['min_trials'] = min(aggregate.get('min_trials', n_trials), n_trials)
+            aggregate['max_trials'] = max(aggregate.get('max_trials', n_trials), n_trials)
+        return aggregates
+
+    def rebuild(self, trials) -> int:
+        """
+        Replace the aggregates with the ones recomputed from the stored trials. Returns the number of tasks.
+        """
+        aggregates = self.compute(trials)
+        collection = self.db[self.collection]
+        for task_id, aggregate in aggregates.items():
+            collection.replace_one({'_id': task_id}, aggregate, upsert=True)
+        collection.delete_many({'_id': {'$nin': list(aggregates)}})
+        self.cache.clear()
+        return len(aggregates)
+
+    def check(self, trials) -> list:
+        """
+        Compare the aggregates with the ones recomputed from the stored trials. Returns the task ids that differ.
+        """
+        aggregates = self.compute(trials)
+        stored = {document['_id']: document for document in self.db[self.collection].find()}
+        return sorted(task_id for task_id in set(aggregates) | set(stored)
+                      if aggregates.get(task_id) != stored.get(task_id))
+
+if __name__ == "__main__":
+    # python -m app.stats rebuild|check
+    if sys.argv[1:] not in (['rebuild'], ['check']):
+        print('Usage: python -m app.stats rebuild|check')
+        sys.exit(1)
+    from .main import study_stats, trial_writer
+    if sys.argv[1] == 'rebuild':
+        print('Rebuilt the statistics of {} tasks.'.format(study_stats.rebuild(trial_writer.storage.iter_trials())))
+    else:
+        differences = study_stats.check(trial_writer.storage.iter_trials())
+        if differences:
+            print('Statistics differ from the stored trials for tasks {}.'.format(differences))
+            sys.exit(1)
+        print('Statistics match the stored trials.')
@@ -0,0 +1,196 @@
+import logging
+import re
+from pymongo import UpdateOne
+from .trials import FIELDS, DEBUG_FIELDS, TIMING_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# collections holding trials are named uniqueID_taskid, uniqueID_taskid_incomplete or uniqueID_taskid_live
+TRIAL_COLLECTION = re.compile(r'^([A-Za-z0-9]{10})_(\d+)(_incomplete|_live)?$')
+
+class CollectionStorage:
+
+    def __init__(self, db:object, index:object=None) -> None:
+        """
+        Trials stored in one collection per participant and task. While the session is running its trials go to
+        uniqueID_taskid_live; when it ends the collection is renamed to uniqueID_taskid (or uniqueID_taskid_incomplete
+        if not enough trials were completed). Sessions are closed in the participant index, if given, and writes
+        arriving after the session was closed are dropped.
+        """
+        self.db = db
+        self.index = index
+        self.indexed = set()
+
+    def collection_name(self, uniqueID:str, task_id:int, status:str) -> str:
+        """
+        Name of the collection for a session with status 'live', 'complete' or 'incomplete'
+        """
+        name = uniqueID+'_'+str(task_id)
+        if status != 'complete':
+            name += '_'+status
+        return name
+
+    def write(self, uniqueID:str, task_id:int, documents:list) -> int:
+        """
+        Upsert trial documents into the live collection of a session. Trials are unique per collection, so writing
+        the same trial twice is a no-op. Returns the number of new trials.
+        """
+        if len(documents) == 0:
+            return 0
+        name = self.collection_name(uniqueID, task_id, 'live')
+        collection = self.db[name]
+        if name not in self.indexed:
+            collection.create_index('trial', unique=True)
+            self.indexed.add(name)
+        result = collection.bulk_write(
+            [UpdateOne({'trial': document['trial']}, {'$setOnInsert': document}, upsert=True) for document in documents],
+            ordered=False)
+        # a writer lagging behind the close of the session (e.g. on another worker) recreates the live collection:
+        # every trial was written from the trial log before the session was closed, so drop it again
+        if result.upserted_count > 0 and self.index is not None and self.index.is_closed(uniqueID, task_id):
+            logger.info('Dropping %d trials written after the session of %s was closed', result.upserted_count, uniqueID)
+            collection.drop()
+            self.indexed.discard(name)
+            return 0
+        return result.upserted_count
+
+    def update(self, uniqueID:str, task_id:int, documents:list) -> int:
+        """
+        Set fields of trials already written to the live collection of a session (e.g. timings reported after the trial
+        was recorded). Each document holds the trial number and the fields to set; trials that were not written are
+        skipped. Returns the number of trials matched.
+        """
+        if len(documents) == 0:
+            return 0
+        result = self.db[self.collection_name(uniqueID, task_id, 'live')].bulk_write(
+            [UpdateOne({'trial': document['trial']}, {'$set': document}) for document in documents], ordered=False)
+        return result.matched_count
+
+    def persisted_trials(self, uniqueID:str, task_id:int) -> set:
+        """
+        Trial numbers already written to the live collection of a session
+        """
+        collection = self.db[self.collection_name(uniqueID, task_id, 'live')]
+        return {document['trial'] for document in collection.find({}, {'trial': 1, '_id': 0})}
+
+    def finalize(self, uniqueID:str, task_id:int, complete:bool) -> None:
+        """
+        Close a session by renaming its live collection
+        """
+        name = self.collection_name(uniqueID, task_id, 'live')
+        self.db[name].rename(self.collection_name(uniqueID, task_id, 'complete' if complete else 'incomplete'))
+        self.indexed.discard(name)
+        if self.index is not None:
+            self.index.close_session(uniqueID, task_id, complete)
+            # trials written by a lagging writer between the rename and the index update
+            self.db[name].drop()
+
+    def live_trials(self, uniqueID:str, task_id:int) -> list:
+        """
+        Trial documents of a session that was never closed (e.g. because its worker died), sorted by trial
+        """
+        return list(self.db[self.collection_name(uniqueID, task_id, 'live')].find({}, {'_id': 0}).sort('trial', 1))
+
+    def iter_trials(self, since:str=None, task_id:int=None, batch_size:int=1000):
+        """
+        Iterate over the stored trials (optionally only those recorded at or after since, 'YYYY-MM-DD[ HH:MM:SS]', or of
+        one task), adding the collection, participant, task_id and status of their session. Collections are read
+        one at a time, batch_size documents per round-trip.
+        """
+        query = {} if since is None else {'time': {'$gte': since}}
+        projection = dict({field: 1 for field in FIELDS + DEBUG_FIELDS + TIMING_FIELDS}, _id=0)
+        for name in sorted(self.db.list_collection_names()):
+            match = TRIAL_COLLECTION.match(name)
+            if match is None or (task_id is not None and int(match.group(2)) != task_id):
+                continue
+            session = {
+                'collection': name,
+                'participant': match.group(1),
+                'task_id': int(match.group(2)),
+                'status': match.group(3)[1:] if match.group(3) else 'complete',
+            }
+            for document in self.db[name].find(query, projection, batch_size=batch_size):
+                document.update(session)
+                yield document
+
+class ConsolidatedStorage(CollectionStorage):
+
+    def __init__(self, db:object, index:object=None, collection:str='trials') -> None:
+        """
+        Trials of every session stored in a single collection, with the participant, task_id and status ('live',
+        'complete' or 'incomplete') of their session, indexed on (participant, task_id, trial) and (task_id, time)
+        """
+        self.db = db
+        self.index = index
+        self.collection = db[collection]
+        self.ready = False
+
+    def ensure(self) -> None:
+        """
+        Create the indexes (once per process)
+        """
+        if self.ready:
+            return
+        self.collection.create_index([('participant', 1), ('task_id', 1), ('trial', 1)], unique=True)
+        self.collection.create_index([('task_id', 1), ('time', 1)])
+        self.ready = True
+
+    def write(self, uniqueID:str, task_id:int, documents:list, status:str='live') -> int:
+        if len(documents) == 0:
+            return 0
+        self.ensure()
+        session = {'participant': uniqueID, 'task_id': int(task_id)}
+        result = self.collection.bulk_write(
+            [UpdateOne(dict(session, trial=document['trial']), {'$setOnInsert': dict(document, status=status, **session)},
+                       upsert=True) for document in documents],
+            ordered=False)
+        return result.upserted_count
+
+    def update(self, uniqueID:str, task_id:int, documents:list) -> int:
+        if len(documents) == 0:
+            return 0
+        self.ensure()
+        session = {'participant': uniqueID, 'task_id': int(task_id), 'status': 'live'}
+        result = self.collection.bulk_write(
+            [UpdateOne(dict(session, trial=document['trial']), {'$set': document}) for document in documents],
+            ordered=False)
+        return result.matched_count
+
+    def persisted_trials(self, uniqueID:str, task_id:int) -> set:
+        return {document['trial'] for document in
+                self.collection.find({'participant': uniqueID, 'task_id': int(task_id), 'status': 'live'},
+                                     {'trial': 1, '_id': 0})}
+
+    def finalize(self, uniqueID:str, task_id:int, complete:bool) -> None:
+        self.collection.update_many({'participant': uniqueID, 'task_id': int(task_id), 'status': 'live'},
+                                    {'$set': {'status': 'complete' if complete else 'incomplete'}})
+        if self.index is not None:
+            self.index.close_session(uniqueID, task_id, complete)
+
+    def live_trials(self, uniqueID:str, task_id:int) -> list:
+        return list(self.collection.find({'participant': uniqueID, 'task_id': int(task_id), 'status': 'live'},
+                                         dict({field: 1 for field in FIELDS + DEBUG_FIELDS + TIMING_FIELDS}, _id=0)).sort('trial', 1))
+
+    def iter_trials(self, since:str=None, task_id:int=None, batch_size:int=1000):
+        query = {}
+        if since is not None:
+            query['time'] = {'$gte': since}
+        if task_id is not None:
+            query['task_id'] = task_id
+        projection = dict({field: 1 for field in ('participant', 'task_id', 'status') + FIELDS + DEBUG_FIELDS + TIMING_FIELDS}, _id=0)
+        cursor = self.collection.find(query, projection, batch_size=batch_size)
+        for document in cursor.sort([('participant', 1), ('task_id', 1), ('trial', 1)]):
+            # name of the collection the session would have in the per-participant layout
+            document['collection'] = self.collection_name(document['participant'], document['task_id'], document['status'])
+            yield document
+
+def make_storage(kind:str, db:object, index:object=None) -> CollectionStorage:
+    """
+    Create the trial storage: 'collections' (default, one collection per session) or 'consolidated' (a single trials
+    collection), closing the sessions in the participant index, if given
+    """
+    if kind == 'consolidated':
+        return ConsolidatedStorage(db, index)
+    elif kind in (None, '', 'collections'):
+        return CollectionStorage(db, index)
+    raise ValueError('Unknown trial storage: {}'.format(kind))
@@ -0,0 +1,323 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from .experiments import MultiLevelMarkov
+from .sqlite import SQLiteDatabase
+from .metrics import STORE_LATENCY, STORE_LOOKUPS, STORE_EVICTIONS
+
+logger = logging.getLogger(__name__)
+
+class EvictionQueue:
+
+    def __init__(self, on_evict) -> None:
+        """
+        Call on_evict(uniqueID, experiment) for the evicted experiments from a background thread, so that the request
+        that found them does not wait for their trials to be saved
+        """
+        self.on_evict = on_evict
+        self.lock = threading.Lock()
+        self.pid = None
+        self.queue = None
+        self.thread = None
+
+    def start(self) -> None:
+        """
+        Start the eviction thread (again if this process was forked from the one that started it)
+        """
+        with self.lock:
+            if self.pid == os.getpid() and self.thread.is_alive():
+                return
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self.run, name='evict', daemon=True)
+            self.pid = os.getpid()
+            self.thread.start()
+
+    def put(self, uniqueID:str, experiment:MultiLevelMarkov) -> None:
+        if self.pid != os.getpid() or self.thread is None:
+            self.start()
+        self.queue.put((uniqueID, experiment))
+
+    def flush(self, timeout:float=60) -> bool:
+        """
+        Block until every experiment evicted so far has been handed to on_evict. Returns False on timeout.
+        """
+        if self.pid != os.getpid() or self.thread is None:
+            return True
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def run(self) -> None:
+        while True:
+            item = self.queue.get()
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            uniqueID, experiment = item
+            try:
+                self.on_evict(uniqueID, experiment)
+            except Exception:
+                logger.exception('Error saving the evicted experiment of %s', uniqueID)
+
+class ExperimentStore:
+
+    def __init__(self, db:object, max_size:int=None, ttl:float=None, on_evict=None) -> None:
+        """
+        Base class for the backends that keep track of the running experiments, keyed by uniqueID. Experiments idle for
+        more than ttl seconds, or the least recently used ones beyond max_size, are dropped and handed to
+        on_evict(uniqueID, experiment) on a background thread so that their trials can be saved.
+        """
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.evictions = None if on_evict is None else EvictionQueue(on_evict)
+
+    def evict(self, evicted:list) -> None:
+        """
+        Queue the dropped (uniqueID, experiment, reason) for on_evict (called without holding any lock of the store)
+        """
+        for uniqueID, experiment, reason in evicted:
+            STORE_EVICTIONS.inc(reason)
+            logger.info('Evicted the experiment of %s (%s)', uniqueID, reason)
+            if self.evictions is not None:
+                self.evictions.put(uniqueID, experiment)
+
+    def flush(self, timeout:float=60) -> bool:
+        """
+        Block until the experiments evicted so far are saved. Returns False on timeout.
+        """
+        return self.evictions is None or self.evictions.flush(timeout)
+
+    def lookup(self, experiment:MultiLevelMarkov) -> MultiLevelMarkov:
+        """
+        Count a lookup as a hit or a miss
+        """
+        STORE_LOOKUPS.inc('miss' if experiment is None else 'hit')
+        return experiment
+
+    def get(self, uniqueID:str) -> MultiLevelMarkov:
+        """
+        Get a copy of the experiment for reading or None if there is no experiment for the uniqueID
+        """
+        raise NotImplementedError
+
+    def checkout(self, uniqueID:str):
+        """
+        Context manager giving exclusive access to the experiment (or None) and saving any changes made to it on exit
+        """
+        raise NotImplementedError
+
+    def pop(self, uniqueID:str) -> MultiLevelMarkov:
+        """
+        Remove the experiment and return it (or None if there was none)
+        """
+        raise NotImplementedError
+
+    def __setitem__(self, uniqueID:str, experiment:MultiLevelMarkov) -> None:
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def __contains__(self, uniqueID:str) -> bool:
+        return self.get(uniqueID) is not None
+
+    def __getitem__(self, uniqueID:str) -> MultiLevelMarkov:
+        experiment = self.get(uniqueID)
+        if experiment is None:
+            raise KeyError(uniqueID)
+        return experiment
+
+    def __delitem__(self, uniqueID:str) -> None:
+        if self.pop(uniqueID) is None:
+            raise KeyError(uniqueID)
+
+class MemoryStore(ExperimentStore):
+
+    def __init__(self, db:object, max_size:int=None, ttl:float=None, on_evict=None) -> None:
+        """
+        Keep the experiments in the memory of this process (only works with a single worker)
+        """
+        super().__init__(db, max_size, ttl, on_evict)
+        # uniqueID -> (last use, experiment), least recently used first
+        self.experiments = OrderedDict()
+        self.lock = threading.RLock()
+
+    def use(self, uniqueID:str) -> MultiLevelMarkov:
+        """
+        Look up an experiment and mark it as just used (with the lock held)
+        """
+        entry = self.experiments.get(uniqueID)
+        if entry is None:
+            return self.lookup(None)
+        self.experiments[uniqueID] = (time.monotonic(), entry[1])
+        self.experiments.move_to_end(uniqueID)
+        return self.lookup(entry[1])
+
+    def expire(self) -> list:
+        """
+        Drop the experiments idle for more than ttl seconds and the least recently used ones beyond max_size
+        (with the lock held). Only the oldest entries are looked at, so this is cheap when nothing expires.
+        """
+        evicted = []
+        if self.ttl is not None:
+            deadline = time.monotonic()-self.ttl
+            while len(self.experiments) > 0:
+                uniqueID, (last_used, experiment) = next(iter(self.experiments.items()))
+                if last_used > deadline:
+                    break
+                del self.experiments[uniqueID]
+                evicted.append((uniqueID, experiment, 'ttl'))
+        if self.max_size is not None:
+            while len(self.experiments) > self.max_size:
+                uniqueID, (_, experiment) = self.experiments.popitem(last=False)
+                evicted.append((uniqueID, experiment, 'size'))
+        return evicted
+
+    def get(self, uniqueID:str) -> MultiLevelMarkov:
+        with self.lock:
+            evicted = self.expire()
+            experiment = self.use(uniqueID)
+        self.evict(evicted)
+        return experiment
+
+    @contextmanager
+    def checkout(self, uniqueID:str):
+        evicted = []
+        try:
+            with self.lock:
+                evicted = self.expire()
+                yield self.use(uniqueID)
+        finally:
+            self.evict(evicted)
+
+    def pop(self, uniqueID:str) -> MultiLevelMarkov:
+        with self.lock:
+            entry = self.experiments.pop(uniqueID, None)
+        return None if entry is None else entry[1]
+
+    def __setitem__(self, uniqueID:str, experiment:MultiLevelMarkov) -> None:
+        with self.lock:
+            self.experiments[uniqueID] = (time.monotonic(), experiment)
+            self.experiments.move_to_end(uniqueID)
+            evicted = self.expire()
+        self.evict(evicted)
+
+    def __len__(self) -> int:
+        return len(self.experiments)
+
+class SQLiteStore(ExperimentStore):
+
+    columns = ('task_id', 'max_trials', 'min_trials', 'naive_trials', 'debug',
+               'current_state', 'current_trial', 'current_points', 'log')
+
+    def __init__(self, db:object, path:str=None, max_size:int=None, ttl:float=None, on_evict=None,
+                 sweep_interval:float=60) -> None:
+        """
+        Keep the experiments in a SQLite database in WAL mode so that every worker process on the host can serve
+        every participant. Each checkout runs in its own write transaction. Each process looks for expired
+        experiments at most every sweep_interval seconds, and whichever process finds them first evicts them.
+        """
+        super().__init__(db, max_size, ttl, on_evict)
+        self.database = SQLiteDatabase(path)
+        self.sweep_interval = sweep_interval
+        self.last_sweep = time.monotonic()
+        conn = self.database.connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS experiments ("
+            "uid TEXT PRIMARY KEY, task_id INTEGER, max_trials INTEGER, min_trials INTEGER, naive_trials INTEGER, "
+            "debug INTEGER, current_state INTEGER, current_trial INTEGER, current_points INTEGER, log BLOB, "
+            "updated REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS experiments_updated ON experiments (updated)")
+
+    def load(self, row:tuple) -> MultiLevelMarkov:
+        """
+        Rebuild an experiment from a row of the experiments table
+        """
+        if row is None:
+            return None
+        with STORE_LATENCY.time('load'):
+            return MultiLevelMarkov.from_state(dict(zip(self.columns, row)), self.db)
+
+    def save(self, conn:sqlite3.Connection, uniqueID:str, experiment:MultiLevelMarkov) -> None:
+        with STORE_LATENCY.time('save'):
+            state = experiment.to_state()
+            conn.execute(
+                "INSERT OR REPLACE INTO experiments (uid, {}, updated) VALUES (?, {}, ?)".format(
+                    ', '.join(self.columns), ', '.join('?'*len(self.columns))),
+                (uniqueID, *[state[column] for column in self.columns], time.time()))
+
+    def expire(self) -> None:
+        """
+        Evict the experiments not updated for more than ttl seconds and the least recently updated ones beyond max_size
+        """
+        if (self.ttl is None and self.max_size is None) or time.monotonic()-self.last_sweep < self.sweep_interval:
+            return
+        self.last_sweep = time.monotonic()
+        select = "SELECT uid, {} FROM experiments ".format(', '.join(self.columns))
+        with self.database.transaction() as conn:
+            rows = []
+            if self.ttl is not None:
+                rows += [(row, 'ttl') for row in
+                         conn.execute(select+"WHERE updated < ?", (time.time()-self.ttl,)).fetchall()]
+            if self.max_size is not None:
+                excess = conn.execute("SELECT COUNT(*) FROM experiments").fetchone()[0]-len(rows)-self.max_size
+                if excess > 0:
+                    expired = {row[0] for row, _ in rows}
+                    rows += [(row, 'size') for row in
+                             conn.execute(select+"ORDER BY updated LIMIT ?", (excess+len(rows),)).fetchall()
+                             if row[0] not in expired][:excess]
+            conn.executemany("DELETE FROM experiments WHERE uid = ?", [(row[0],) for row, _ in rows])
+        self.evict([(row[0], self.load(row[1:]), reason) for row, reason in rows])
+
+    def get(self, uniqueID:str) -> MultiLevelMarkov:
+        row = self.database.connection().execute(
+            "SELECT {} FROM experiments WHERE uid = ?".format(', '.join(self.columns)), (uniqueID,)).fetchone()
+        return self.lookup(self.load(row))
+
+    def __contains__(self, uniqueID:str) -> bool:
+        row = self.database.connection().execute("SELECT 1 FROM experiments WHERE uid = ?", (uniqueID,)).fetchone()
+        STORE_LOOKUPS.inc('miss' if row is None else 'hit')
+        return row is not None
+
+    @contextmanager
+    def checkout(self, uniqueID:str):
+        self.expire()
+        with self.database.transaction() as conn:
+            row = conn.execute(
+                "SELECT {} FROM experiments WHERE uid = ?".format(', '.join(self.columns)), (uniqueID,)).fetchone()
+            experiment = self.lookup(self.load(row))
+            yield experiment
+            if experiment is not None:
+                self.save(conn, uniqueID, experiment)
+
+    def pop(self, uniqueID:str) -> MultiLevelMarkov:
+        with self.database.transaction() as conn:
+            row = conn.execute(
+                "SELECT {} FROM experiments WHERE uid = ?".format(', '.join(self.columns)), (uniqueID,)).fetchone()
+            conn.execute("DELETE FROM experiments WHERE uid = ?", (uniqueID,))
+        return self.load(row)
+
+    def __setitem__(self, uniqueID:str, experiment:MultiLevelMarkov) -> None:
+        conn = self.database.connection()
+        self.save(conn, uniqueID, experiment)
+        self.expire()
+
+    def __len__(self) -> int:
+        return self.database.connection().execute("SELECT COUNT(*) FROM experiments").fetchone()[0]
+
+def make_store(kind:str, db:object, path:str=None, max_size:int=None, ttl:float=None, on_evict=None) -> ExperimentStore:
+    """
+    Create the experiment store: 'memory' (default) or 'sqlite'
+    """
+    if kind == 'sqlite':
+        return SQLiteStore(db, path, max_size, ttl, on_evict)
+    elif kind in (None, '', 'memory'):
+        return MemoryStore(db, max_size, ttl, on_evict)
+    raise ValueError('Unknown experiment store: {}'.format(kind))
@@ -0,0 +1,109 @@
+import os
+import sys
+import threading
+import numpy as np
+
+# default location of the task database
+TASK_FILE = "./data/df_topset_mirror.pkl"
+
+def compiled_path(path:str) -> str:
+    """
+    Location of the precompiled copy of a task file
+    """
+    return os.path.splitext(path)[0]+'.npz'
+
+def compile_tasks(path:str=TASK_FILE, output:str=None) -> int:
+    """
+    Convert the task table (a pandas pickle) into a NumPy file that loads without pandas: the task ids, the number of
+    states of each task and their labels and transitions padded to the largest task. Returns the number of tasks.
+    """
+    import pandas as pd
+    taskDB = pd.read_pickle(path)
+    n_states = np.array([len(task[0]) for task in taskDB['task']], dtype=np.int32)
+    labels = np.zeros((len(taskDB), n_states.max()), dtype=np.int32)
+    transitions = np.zeros((len(taskDB), n_states.max(), 2), dtype=np.int32)
+    for i, task in enumerate(taskDB['task']):
+        labels[i, :n_states[i]] = task[0]
+        transitions[i, :n_states[i]] = task[1]
+    output = output or compiled_path(path)
+    # written under a temporary name first so that workers never load a partial file
+    tmp_output = output+'.tmp.npz'
+    np.savez(tmp_output, task_ids=np.array(taskDB.index, dtype=np.int64), n_states=n_states,
+             labels=labels, transitions=transitions)
+    os.replace(tmp_output, output)
+    return len(taskDB)
+
+class TaskRegistry:
+
+    def __init__(self, path:str=TASK_FILE) -> None:
+        """
+        Process-wide registry of MultiLevel Markov tasks. The task table is read once and every task is
+        converted to a pair of read-only arrays (state_labels, state_transitions) keyed by task id.
+        The precompiled copy of the table (see compile_tasks) is used when it is at least as recent as the table.
+        """
+        self.path = path
+        self.tasks = None
+        self.lock = threading.Lock()
+
+    def load(self) -> None:
+        """
+        Load the task table and convert it to compact arrays (only done once per process)
+        """
+        with self.lock:
+            if self.tasks is not None:
+                return
+            compiled = compiled_path(self.path)
+            if os.path.exists(compiled) and (not os.path.exists(self.path) or
+                                             os.path.getmtime(compiled) >= os.path.getmtime(self.path)):
+                self.tasks = self.load_compiled(compiled)
+            else:
+                self.tasks = self.load_pickle(self.path)
+
+    def load_compiled(self, path:str) -> dict:
+        with np.load(path) as data:
+            task_ids, n_states, labels, transitions = data['task_ids'], data['n_states'], data['labels'], data['transitions']
+        # the arrays are shared between all experiments using the task
+        labels.flags.writeable = False
+        transitions.flags.writeable = False
+        return {int(task_id): (labels[i, :n], transitions[i, :n])
+                for i, (task_id, n) in enumerate(zip(task_ids.tolist(), n_states.tolist()))}
+
+    def load_pickle(self, path:str) -> dict:
+        import pandas as pd
+        taskDB = pd.read_pickle(path)
+        tasks = {}
+        for task_id, task in zip(taskDB.index, taskDB['task']):
+            state_labels = np.array(task[0], dtype=np.int32)
+            state_transitions = np.array(task[1], dtype=np.int32)
+            # the arrays are shared between all experiments using the task
+            state_labels.flags.writeable = False
+            state_transitions.flags.writeable = False
+            tasks[int(task_id)] = (state_labels, state_transitions)
+        return tasks
+
+    def get(self, task_id:int) -> (np.ndarray, np.ndarray):
+        """
+        Return the (state_labels, state_transitions) arrays for a task or None if the task does not exist
+        """
+        if self.tasks is None:
+            self.load()
+        return self.tasks.get(int(task_id))
+
+    def __contains__(self, task_id:int) -> bool:
+        return self.get(task_id) is not None
+
+    def __len__(self) -> int:
+        if self.tasks is None:
+            self.load()
+        return len(self.tasks)
+
+# registry shared by all experiments in this process
+TASKS = TaskRegistry()
+
+if __name__ == "__main__":
+    # python -m app.tasks compile [task file]
+    if len(sys.argv) not in (2, 3) or sys.argv[1] != 'compile':
+        print('Usage: python -m app.tasks compile [task file]')
+        sys.exit(1)
+    path = sys.argv[2] if len(sys.argv) == 3 else TASK_FILE
+    print('Compiled {} tasks into {}.'.format(compile_tasks(path), compiled_path(path)))
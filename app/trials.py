@@ -0,0 +1,173 @@
+import numpy as np
+from datetime import datetime
+
+# one row per trial: what was offered (filled when the trial is shown) and what was chosen (filled when it is recorded)
+LOG_DTYPE = np.dtype([
+    ('trial', np.int32),
+    ('state', np.int32),
+    ('state_A', np.int32),
+    ('state_B', np.int32),
+    ('reward_A', np.int32),
+    ('reward_B', np.int32),
+    ('lr', np.int8),
+    ('response', 'S1'),
+    ('reward', np.int32),
+    ('time', 'datetime64[s]'),
+    # monotonic clock of the server when the request recording the trial arrived, and the time spent on it until the
+    # trial was recorded (0 if unknown)
+    ('server_receive_ns', np.int64),
+    ('server_process_ns', np.int64),
+    # performance.now() timestamps in ms reported by the page (NaN until uploaded): stimulus onset, click, reward shown,
+    # choice sent to and answer received from the server, relative to the page's performance.timeOrigin (epoch ms)
+    ('client_origin', np.float64),
+    ('client_onset', np.float64),
+    ('client_click', np.float64),
+    ('client_reward', np.float64),
+    ('client_sent', np.float64),
+    ('client_received', np.float64),
+])
+
+# fields written to the database for every trial, and the extra ones written in debug mode
+FIELDS = ('trial', 'state', 'response', 'reward', 'time')
+DEBUG_FIELDS = ('state_A', 'state_B', 'reward_A', 'reward_B', 'lr')
+# timing fields written for every trial, empty (None) when unknown
+SERVER_TIMING_FIELDS = ('server_receive_ns', 'server_process_ns')
+CLIENT_TIMING_FIELDS = ('client_origin', 'client_onset', 'client_click', 'client_reward', 'client_sent', 'client_received')
+TIMING_FIELDS = SERVER_TIMING_FIELDS + CLIENT_TIMING_FIELDS
+# values of the timing fields before they are known
+NO_TIMINGS = (0,)*len(SERVER_TIMING_FIELDS) + (np.nan,)*len(CLIENT_TIMING_FIELDS)
+
+def timing_value(field:str, value) -> object:
+    """
+    Database value of a timing field: None while unknown
+    """
+    if field in SERVER_TIMING_FIELDS:
+        return int(value) if value != 0 else None
+    return float(value) if not np.isnan(value) else None
+
+class TrialLog:
+
+    __slots__ = ('rows', 'n_presented', 'n_recorded')
+
+    def __init__(self, max_trials:int) -> None:
+        """
+        Preallocated log of the trials of an experiment, stored as a NumPy structured array indexed by trial
+        """
+        self.rows = np.zeros(max_trials, dtype=LOG_DTYPE)
+        self.n_presented = 0
+        self.n_recorded = 0
+
+    def __len__(self) -> int:
+        """
+        Number of recorded trials
+        """
+        return self.n_recorded
+
+    def present(self, trial:int, state:int, state_A:int, state_B:int, reward_A:int, reward_B:int, lr:int) -> None:
+        """
+        Log the options shown on a trial (only the first time the trial is shown)
+        """
+        if trial != self.n_presented:
+            return
+        self.rows[trial] = (trial, state, state_A, state_B, reward_A, reward_B, lr, b'', 0, 'NaT') + NO_TIMINGS
+        self.n_presented += 1
+
+    def record(self, trial:int, response:str, reward:int, time:datetime=None) -> None:
+        """
+        Log the response and reward of a trial
+        """
+        self.rows['response'][trial] = response
+        self.rows['reward'][trial] = reward
+        self.rows['time'][trial] = np.datetime64(time or datetime.now(), 's')
+        self.n_recorded = trial+1
+
+    def set_timings(self, trial:int, **timings) -> None:
+        """
+        Log timing fields of a trial (see TIMING_FIELDS)
+        """
+        for field, value in timings.items():
+            self.rows[field][trial] = value
+
+    def timings(self, trial:int) -> dict:
+        """
+        Get the timing fields of a trial as database values
+        """
+        return {field: timing_value(field, self.rows[field][trial]) for field in TIMING_FIELDS}
+
+    def columns(self, debug:bool=False, trials:list=None) -> dict:
+        """
+        Get the recorded trials (or the given trials among them) as a dict of python lists, one per database field
+        """
+        rows = self.rows[:self.n_recorded] if trials is None else self.rows[np.asarray(trials, dtype=np.intp)]
+        fields = FIELDS + (DEBUG_FIELDS if debug else ())
+        if len(rows) == 0:
+            return {field: [] for field in fields + TIMING_FIELDS}
+        columns = {}
+        for field in fields:
+            if field == 'response':
+                columns[field] = np.char.decode(rows[field], 'ascii').tolist()
+            elif field == 'time':
+                # same format as datetime.strftime("%Y-%m-%d %H:%M:%S")
+                columns[field] = np.char.replace(np.datetime_as_string(rows[field], unit='s'), 'T', ' ').tolist()
+            else:
+                columns[field] = rows[field].tolist()
+        for field in TIMING_FIELDS:
+            # unknown timings (see timing_value) become None
+            values = rows[field].astype(object)
+            values[rows[field] == 0 if field in SERVER_TIMING_FIELDS else np.isnan(rows[field])] = None
+            columns[field] = values.tolist()
+        return columns
+
+    def document(self, trial:int, debug:bool=False) -> dict:
+        """
+        Get a single recorded trial as a database document
+        """
+        row = self.rows[trial:trial+1]
+        document = {}
+        for field in FIELDS + (DEBUG_FIELDS if debug else ()):
+            if field == 'response':
+                document[field] = row[field][0].decode('ascii')
+            elif field == 'time':
+                document[field] = np.datetime_as_string(row[field][0], unit='s').replace('T', ' ')
+            else:
+                document[field] = row[field][0].item()
+        document.update(self.timings(trial))
+        return document
+
+    def to_documents(self, debug:bool=False, trials:list=None) -> list:
+        """
+        Get the recorded trials (or the given trials among them) as database documents
+        """
+        columns = self.columns(debug, trials)
+        return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+    def timing_documents(self, trials:list) -> list:
+        """
+        Get the timing fields of the given trials as update documents (trial number and timing fields), leaving out the
+        trials without any timing reported by the page
+        """
+        trials = np.asarray(trials, dtype=np.intp)
+        reported = np.zeros(len(trials), dtype=bool)
+        for field in CLIENT_TIMING_FIELDS:
+            reported |= ~np.isnan(self.rows[field][trials])
+        columns = self.columns(trials=trials[reported])
+        fields = ('trial',) + TIMING_FIELDS
+        return [dict(zip(fields, values)) for values in zip(*(columns[field] for field in fields))]
+
+    def to_bytes(self) -> bytes:
+        """
+        Get the shown trials as raw bytes (see from_bytes)
+        """
+        return self.rows[:self.n_presented].tobytes()
+
+    @classmethod
+    def from_bytes(cls, data:bytes, max_trials:int, n_recorded:int) -> 'TrialLog':
+        """
+        Rebuild a log from the output of to_bytes
+        """
+        log = cls(max_trials)
+        rows = np.frombuffer(data, dtype=LOG_DTYPE)
+        log.rows[:len(rows)] = rows
+        log.n_presented = len(rows)
+        log.n_recorded = n_recorded
+        return log
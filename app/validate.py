@@ -0,0 +1,223 @@
+"""
+Audit of the stored sessions against the tasks they were played on: every trial is checked against the task's
+state_transitions and state_labels, following the rules of MultiLevelMarkov (naive_trials trials in state -1 without
+reward, then state 0, then each response moves to state_transitions[state][A=0/B=1] and earns 100 times the label of
+the new state).
+
+The trials of all sessions of a task are checked at once as NumPy columns: the state each trial should start in and
+the reward it should have earned are gathered from the transition table for every trial of every participant together,
+and tasks are spread over a process pool. Flagged issues:
+
+    duplicate_trial   a trial number stored twice in a session
+    missing_trials    a session whose trial numbers are not 0, 1, 2, ... (trial: the first missing one)
+    trial             a trial number outside 0..max_trials-1
+    response          a response other than A or B
+    state             a state that does not follow from the previous trial (or from the naive trials)
+    reward            a reward that does not match the response made in the stored state
+    payout            a session whose points (and so payout) differ from those of the replayed rewards
+    status            a session closed as complete with fewer than min_trials trials
+    unknown_task      trials of a task that is not in the task table
+
+Usage: python -m app.validate [--tasks 3151 13151] [--processes 4] [--output issues.csv]
+"""
+import argparse
+import csv
+import sys
+import time
+import numpy as np
+from .tasks import TaskRegistry, TASKS
+
+# columns of the issue report
+ISSUE_FIELDS = ('task_id', 'participant', 'status', 'trial', 'issue', 'expected', 'found')
+# columns of the per-task summary
+SUMMARY_FIELDS = ('task_id', 'sessions', 'trials', 'issues', 'sessions_with_issues')
+RESPONSES = {'A': 0, 'B': 1}
+
+class TrialColumns:
+
+    def __init__(self) -> None:
+        """
+        Trials of the sessions of one task, accumulated as columns
+        """
+        self.sessions = {}
+        self.session = []
+        self.trial = []
+        self.state = []
+        self.response = []
+        self.reward = []
+
+    def __len__(self) -> int:
+        return len(self.trial)
+
+    def add(self, document:dict) -> None:
+        key = (document['participant'], document['status'])
+        self.session.append(self.sessions.setdefault(key, len(self.sessions)))
+        self.trial.append(document['trial'])
+        self.state.append(document['state'])
+        self.response.append(RESPONSES.get(document['response'], -1))
+        self.reward.append(document['reward'])
+
+    def arrays(self) -> dict:
+        return {
+            'sessions': list(self.sessions),
+            'session': np.array(self.session, dtype=np.int64),
+            'trial': np.array(self.trial, dtype=np.int64),
+            'state': np.array(self.state, dtype=np.int64),
+            'response': np.array(self.response, dtype=np.int64),
+            'reward': np.array(self.reward, dtype=np.int64),
+        }
+
+def group_by_task(trials, task_ids:list=None) -> dict:
+    """
+    Collect the stored trial documents (as yielded by the trial storage's iter_trials) into TrialColumns per task
+    """
+    tasks = {}
+    for document in trials:
+        if task_ids is not None and document['task_id'] not in task_ids:
+            continue
+        columns = tasks.get(document['task_id'])
+        if columns is None:
+            columns = tasks[document['task_id']] = TrialColumns()
+        columns.add(document)
+    return tasks
+
+def validate_task(task_id:int, state_labels:np.ndarray, state_transitions:np.ndarray, columns:dict,
+                  naive_trials:int, min_trials:int, max_trials:int, unit_winnings:float) -> (dict, list):
+    """
+    Check the trials of every session of a task (see TrialColumns.arrays) and return (summary, issues)
+    """
+    sessions = columns['sessions']
+    issues = []
+
+    def flag(rows, issue, expected, found):
+        for i in np.flatnonzero(rows):
+            participant, status = sessions[session[i]]
+            issues.append(dict(zip(ISSUE_FIELDS, (task_id, participant, status, int(trial[i]), issue,
+                                                  expected[i].item() if isinstance(expected, np.ndarray) else expected,
+                                                  found[i].item() if isinstance(found, np.ndarray) else found))))
+
+    # sort the trials by session and trial number
+    order = np.lexsort((columns['trial'], columns['session']))
+    session, trial, state, response, reward = (columns[name][order] for name in
+                                               ('session', 'trial', 'state', 'response', 'reward'))
+    n_trials = len(trial)
+    if n_trials == 0:
+        return dict(zip(SUMMARY_FIELDS, (task_id, len(sessions), 0, 0, 0))), issues
+
+    duplicate = np.zeros(n_trials, dtype=bool)
+    duplicate[1:] = (session[1:] == session[:-1]) & (trial[1:] == trial[:-1])
+    flag(duplicate, 'duplicate_trial', None, trial)
+    session, trial, state, response, reward = (column[~duplicate] for column in (session, trial, state, response, reward))
+    n_trials = len(trial)
+
+    flag((trial < 0) | (trial >= max_trials), 'trial', None, trial)
+
+    # trial numbers should run 0, 1, 2, ... in every session: compare them with their rank in the session
+    counts = np.bincount(session, minlength=len(sessions))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    rank = np.arange(n_trials)-starts[session]
+    gap = trial != rank
+    first_gap = np.full(len(sessions), n_trials)
+    np.minimum.at(first_gap, session[gap], np.flatnonzero(gap))
+    for s in np.flatnonzero(first_gap < n_trials):
+        participant, status = sessions[s]
+        issues.append(dict(zip(ISSUE_FIELDS, (task_id, participant, status, int(rank[first_gap[s]]), 'missing_trials',
+                                              int(trial[starts[s]+counts[s]-1])+1, int(counts[s])))))
+
+    valid_response = response >= 0
+    flag(~valid_response, 'response', 'A or B', None)
+
+    # state each trial should start in: -1 during the naive trials, 0 after them, then where the previous trial led
+    n_states = len(state_labels)
+    valid_state = (state >= 0) & (state < n_states)
+    reached = np.full(n_trials, -2)
+    can_move = valid_state & valid_response & (trial >= naive_trials)
+    reached[can_move] = state_transitions[state[can_move], response[can_move]]
+    expected_state = np.full(n_trials, -2)
+    follows = np.zeros(n_trials, dtype=bool)
+    follows[1:] = (session[1:] == session[:-1]) & (trial[1:] == trial[:-1]+1)
+    expected_state[follows] = np.roll(reached, 1)[follows]
+    expected_state[trial < naive_trials] = -1
+    expected_state[trial == naive_trials] = 0
+    known_state = expected_state != -2
+    flag(known_state & (state != expected_state), 'state', expected_state, state)
+
+    # reward of the response made in the stored state (none during the naive trials)
+    rewards = np.asarray(state_labels, dtype=np.int64)*100
+    expected_reward = np.full(n_trials, -1)
+    expected_reward[trial < naive_trials] = 0
+    expected_reward[can_move] = rewards[reached[can_move]]
+    known_reward = expected_reward >= 0
+    flag(known_reward & (reward != expected_reward), 'reward', expected_reward, reward)
+
+    # payout of the stored points against the payout of the replayed rewards
+    points = np.bincount(session, weights=reward, minlength=len(sessions))
+    expected_points = np.bincount(session, weights=np.where(known_reward, expected_reward, reward), minlength=len(sessions))
+    for s in np.flatnonzero(points != expected_points):
+        participant, status = sessions[s]
+        issues.append(dict(zip(ISSUE_FIELDS, (task_id, participant, status, None, 'payout',
+                                              round(float(expected_points[s])*unit_winnings, 2),
+                                              round(float(points[s])*unit_winnings, 2)))))
+    for s, (participant, status) in enumerate(sessions):
+        if status == 'complete' and counts[s] < min_trials:
+            issues.append(dict(zip(ISSUE_FIELDS, (task_id, participant, status, None, 'status', 'incomplete', status))))
+
+    flagged = {(issue['participant'], issue['status']) for issue in issues}
+    summary = dict(zip(SUMMARY_FIELDS, (task_id, len(sessions), int(counts.sum()), len(issues), len(flagged))))
+    return summary, issues
+
+def validate(trials, task_ids:list=None, registry:TaskRegistry=TASKS, naive_trials:int=5, min_trials:int=30,
+             max_trials:int=500, unit_winnings:float=0, processes:int=None):
+    """
+    Check the stored trials (as yielded by the trial storage's iter_trials) of the given tasks (every task by default),
+    one task per job of a process pool, yielding the (summary, issues) of each task as it completes
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    registry.load()
+    tasks = group_by_task(trials, None if task_ids is None else set(task_ids))
+    with ProcessPoolExecutor(processes) as pool:
+        futures = []
+        for task_id, columns in sorted(tasks.items()):
+            if task_id not in registry:
+                # a single issue for the whole task, which flags every one of its sessions
+                summary = dict(zip(SUMMARY_FIELDS, (task_id, len(columns.sessions), len(columns), 1, len(columns.sessions))))
+                yield summary, [dict(zip(ISSUE_FIELDS, (task_id, None, None, None, 'unknown_task', None, None)))]
+                continue
+            state_labels, state_transitions = registry.get(task_id)
+            futures.append(pool.submit(validate_task, task_id, state_labels, state_transitions, columns.arrays(),
+                                       naive_trials, min_trials, max_trials, unit_winnings))
+        for future in as_completed(futures):
+            yield future.result()
+
+def main(argv:list=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', type=int, nargs='*', help='task ids (default: every task with stored trials)')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--output', default='issues.csv', help='CSV file of the issues found')
+    args = parser.parse_args(argv)
+
+    from .main import trial_writer, naive_trials, min_trials, max_trials, unit_winnings
+    start = time.perf_counter()
+    n_issues = 0
+    summaries = []
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=ISSUE_FIELDS)
+        writer.writeheader()
+        for summary, issues in validate(trial_writer.storage.iter_trials(), args.tasks or None,
+                                        naive_trials=naive_trials, min_trials=min_trials, max_trials=max_trials,
+                                        unit_winnings=unit_winnings, processes=args.processes):
+            writer.writerows(issues)
+            n_issues += len(issues)
+            summaries.append(summary)
+
+    print('{:<10} {:>10} {:>10} {:>10} {:>22}'.format(*SUMMARY_FIELDS))
+    for summary in sorted(summaries, key=lambda summary: summary['task_id']):
+        print('{:<10} {:>10} {:>10} {:>10} {:>22}'.format(*(summary[field] for field in SUMMARY_FIELDS)))
+    print('{} trials of {} sessions checked in {:.1f} s, {} issues written to {}'.format(
+        sum(summary['trials'] for summary in summaries), sum(summary['sessions'] for summary in summaries),
+        time.perf_counter()-start, n_issues, args.output))
+    if n_issues > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class WriteBehindQueue:
+
+    def __init__(self, storage:object, batch_size:int=50, flush_interval:float=5.0) -> None:
+        """
+        Persist trials from a background thread while the session is running. Trials are written in batches of
+        batch_size, or every flush_interval seconds, whichever comes first.
+        """
+        self.storage = storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pid = None
+        self.queue = None
+        self.thread = None
+
+    def start(self) -> None:
+        """
+        Start the writer thread (again if this process was forked from the one that started it)
+        """
+        with self.lock:
+            if self.pid == os.getpid() and self.thread.is_alive():
+                return
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+            self.pid = os.getpid()
+            self.thread.start()
+
+    def put(self, uniqueID:str, task_id:int, document:dict, update:bool=False) -> None:
+        """
+        Queue a trial document for writing, or with update=True fields to set on a trial queued before it
+        """
+        if self.pid != os.getpid() or self.thread is None:
+            self.start()
+        self.queue.put((uniqueID, int(task_id), document, update))
+
+    def flush(self, timeout:float=30) -> bool:
+        """
+        Block until every trial queued so far has been written. Returns False on timeout.
+        """
+        if self.pid != os.getpid() or self.thread is None:
+            return True
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def write(self, pending:list) -> list:
+        """
+        Write the pending trials grouped by session and return the ones that could not be written. The trials of a
+        session are written before the updates, which always refer to trials queued earlier.
+        """
+        sessions = {}
+        for item in pending:
+            sessions.setdefault(item[:2], []).append(item)
+        failed = []
+        for (uniqueID, task_id), items in sessions.items():
+            try:
+                self.storage.write(uniqueID, task_id, [document for _, _, document, update in items if not update])
+                self.storage.update(uniqueID, task_id, [document for _, _, document, update in items if update])
+            except Exception as e:
+                logger.warning('Error writing trials for %s, will retry: %s', uniqueID, e)
+                failed += items
+        return failed
+
+    def run(self) -> None:
+        pending = []
+        waiting = []
+        deadline = time.monotonic()+self.flush_interval
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0, deadline-time.monotonic()))
+            except queue.Empty:
+                item = None
+            if isinstance(item, threading.Event):
+                waiting.append(item)
+            elif item is not None:
+                pending.append(item)
+            if len(pending) >= self.batch_size or len(waiting) > 0 or time.monotonic() >= deadline:
+                pending = self.write(pending)
+                deadline = time.monotonic()+self.flush_interval
+                # flushes only succeed once everything before them is written
+                if len(pending) == 0:
+                    for done in waiting:
+                        done.set()
+                    waiting = []
+                elif item is None or isinstance(item, threading.Event):
+                    time.sleep(min(1, self.flush_interval))
@@ -0,0 +1,82 @@
+"""
+Benchmark of what a participant's browser downloads to show the first trial of experiment.html: the page, its
+assets and the first /trial, on a first visit (empty cache) and on a repeat visit (assets cached, revalidated unless
+they are immutable), with the plain static files and with the built assets (python -m app.assets build).
+
+Runs in-process against mongomock, so it reports requests, bytes and external hosts rather than network time; the
+time estimate assumes one round trip per request wave (page, assets in parallel, /trial) plus the transfer time.
+
+Usage: python benchmarks/bench_assets.py [rtt_ms] [bandwidth_mbps]   (default: 100 5)
+"""
+import os
+import re
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+ASSET = re.compile(r'''(?:src|href)="([^"]+)"''')
+
+def load_app():
+    import pymongo
+    import mongomock
+    pymongo.MongoClient = mongomock.MongoClient
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    os.environ.setdefault('MONGO_DBNAME', 'bench')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    from app import main
+    return main
+
+def visit(client, cache):
+    """
+    Load experiment.html up to the first trial. cache maps asset URLs to their ETag (None if immutable) and is filled
+    in. Returns (requests, bytes, external URLs).
+    """
+    headers = {'Accept-Encoding': 'gzip, br'}
+    page = client.get('/experiment', headers=headers)
+    n_requests, n_bytes = 1, len(page.data)
+    urls = [url for url in ASSET.findall(page.get_data(as_text=True)) if not url.startswith('https://www.janelia')]
+    external = [url for url in urls if url.startswith('http')]
+    for url in urls:
+        if url.startswith('http') or not (url.startswith('/static/') or url.startswith('/assets/')):
+            continue
+        if url in cache and cache[url] is None:
+            # immutable and fresh: no request at all
+            continue
+        request_headers = dict(headers)
+        if cache.get(url):
+            request_headers['If-None-Match'] = cache[url]
+        response = client.get(url, headers=request_headers)
+        n_requests += 1
+        n_bytes += len(response.data)
+        immutable = 'immutable' in response.headers.get('Cache-Control', '')
+        cache[url] = None if immutable else response.headers.get('ETag')
+    trial = client.post('/trial', data={})
+    return n_requests+1, n_bytes+len(trial.data), external
+
+def main():
+    rtt = float(sys.argv[1]) if len(sys.argv) > 1 else 100
+    bandwidth = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    from app.assets import build
+    manifest = build()
+    main_module = load_app()
+    app = main_module.app
+    print('{:<8} {:<7} {:>9} {:>10} {:>9} {:>12}'.format('assets', 'visit', 'requests', 'kB', 'external', 'estimate ms'))
+    for mode, assets in (('plain', {}), ('built', manifest)):
+        main_module.assets.manifest = assets
+        client = app.test_client()
+        client.get('/login?uniqueID=bench{}'.format(mode.ljust(5, '0')))
+        client.get('/')
+        cache = {}
+        for visit_name in ('first', 'repeat'):
+            n_requests, n_bytes, external = visit(client, cache)
+            # page, then the assets in parallel, then the first trial; external hosts add a DNS+TLS handshake
+            waves = 2+(n_requests > 2)+2*len({re.sub(r'^https?://([^/]+).*', r'\1', url) for url in external})
+            estimate = waves*rtt+n_bytes*8/(bandwidth*1e3)
+            print('{:<8} {:<7} {:>9} {:>10.1f} {:>9} {:>12.0f}'.format(
+                mode, visit_name, n_requests, n_bytes/1e3, len(external), estimate))
+        client.get('/logout')
+
+if __name__ == "__main__":
+    main()
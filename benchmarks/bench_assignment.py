@@ -0,0 +1,75 @@
+"""
+Benchmark of task assignment: balance and cost of the old np.random.choice over the valid tasks against the
+schedulers of app.assignment (in memory and in SQLite), for participants arriving one after the other, each finishing
+their session (complete with probability p_complete, abandoned otherwise) before the next few arrive.
+
+Reports the spread of complete sessions per task (min, max, std) and the time per assignment.
+
+Usage: python benchmarks/bench_assignment.py [n_tasks] [n_participants]   (default: 1000 20000)
+"""
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.assignment import MemoryScheduler, SQLiteScheduler
+
+p_complete = 0.8
+# sessions running at the same time
+concurrency = 50
+
+class RandomAssignment:
+    """
+    The old assignment: a random task among the ones not played yet
+    """
+    def __init__(self, task_ids):
+        self.task_ids = task_ids
+        self.complete = dict.fromkeys(task_ids, 0)
+
+    def assign(self, uniqueID, exclude=frozenset()):
+        valid = [task_id for task_id in self.task_ids if task_id not in exclude]
+        return int(np.random.choice(valid)) if valid else None
+
+    def finish(self, uniqueID, task_id, complete):
+        if complete:
+            self.complete[task_id] += 1
+
+    def counts(self):
+        return {task_id: (count, 0) for task_id, count in self.complete.items()}
+
+def run(scheduler, n_participants, rng):
+    running = []
+    elapsed = 0
+    for i in range(n_participants):
+        uniqueID = 'p{:09d}'.format(i)
+        start = time.perf_counter()
+        task_id = scheduler.assign(uniqueID, exclude=frozenset())
+        elapsed += time.perf_counter()-start
+        running.append((uniqueID, task_id))
+        if len(running) >= concurrency:
+            uniqueID, task_id = running.pop(rng.integers(len(running)))
+            scheduler.finish(uniqueID, task_id, complete=bool(rng.random() < p_complete))
+    for uniqueID, task_id in running:
+        scheduler.finish(uniqueID, task_id, complete=bool(rng.random() < p_complete))
+    counts = np.array([complete for complete, _ in scheduler.counts().values()])
+    return counts, elapsed/n_participants
+
+def main():
+    n_tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    n_participants = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    task_ids = list(range(n_tasks))
+    print('{} tasks, {} participants, {} running at a time'.format(n_tasks, n_participants, concurrency))
+    print('{:<10} {:>6} {:>6} {:>8} {:>16}'.format('assignment', 'min', 'max', 'std', 'us per assignment'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, scheduler in (('random', RandomAssignment(task_ids)),
+                                ('memory', MemoryScheduler(task_ids)),
+                                ('sqlite', SQLiteScheduler(task_ids, path=os.path.join(tmp, 'assignment.sqlite3')))):
+            counts, per_assignment = run(scheduler, n_participants, np.random.default_rng(0))
+            print('{:<10} {:>6} {:>6} {:>8.2f} {:>16.1f}'.format(name, counts.min(), counts.max(), counts.std(),
+                                                                 per_assignment*1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Multi-worker consistency and throughput check for the experiment stores.
+
+Several worker processes (as under gunicorn) each run a few threads that record trials for a shared set of
+participants through ExperimentStore.checkout. At the end every participant must have exactly the trials that were
+recorded for it, and its log must replay through the task's transitions.
+
+Usage: python benchmarks/bench_experiment_store.py [workers] [threads] [participants] [trials_per_thread]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.chdir(os.path.join(os.path.dirname(__file__), '..'))
+
+from app.experiments import MultiLevelMarkov
+from app.store import SQLiteStore
+
+task_ids = [3151,13151]
+max_trials = 500
+
+def play(path, uids, n_trials, seed):
+    store = SQLiteStore(None, path)
+    rng = random.Random(seed)
+    for _ in range(n_trials):
+        uid = rng.choice(uids)
+        with store.checkout(uid) as experiment:
+            left_string, left_reward, right_string, right_reward = experiment.get_next_trial()
+            if rng.random() < 0.5:
+                experiment.record_response(left_string, left_reward)
+            else:
+                experiment.record_response(right_string, right_reward)
+
+def worker(path, uids, n_threads, n_trials, seed):
+    with ThreadPoolExecutor(n_threads) as pool:
+        for i in range(n_threads):
+            pool.submit(play, path, uids, n_trials, seed*1000+i)
+
+def check(experiment):
+    """
+    Replay the log of an experiment through its task and return the number of trials
+    """
+    replay = MultiLevelMarkov(experiment.task_id, max_trials, 30, 5, None)
+    assert len(experiment.log) == experiment.current_trial
+    for i, row in enumerate(experiment.log.rows[:len(experiment.log)]):
+        assert row['trial'] == i
+        assert row['state'] == replay.current_state
+        response = row['response'].decode()
+        left_string, left_reward, right_string, right_reward = replay.get_next_trial()
+        assert row['reward'] == (left_reward if response == left_string else right_reward)
+        replay.record_response(response, int(row['reward']))
+    assert replay.current_points == experiment.current_points
+    return experiment.current_trial
+
+if __name__ == "__main__":
+    n_workers, n_threads, n_participants, n_trials = [int(x) for x in sys.argv[1:5]] + [4,4,20,50][len(sys.argv[1:5]):]
+    path = os.path.join(tempfile.mkdtemp(), 'experiments.sqlite3')
+    store = SQLiteStore(None, path)
+    uids = ['participant{:03d}'.format(i) for i in range(n_participants)]
+    for i, uid in enumerate(uids):
+        store[uid] = MultiLevelMarkov(task_ids[i%len(task_ids)], max_trials, 30, 5, None)
+
+    start = time.perf_counter()
+    workers = [mp.Process(target=worker, args=(path, uids, n_threads, n_trials, seed)) for seed in range(n_workers)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+        assert p.exitcode == 0
+    elapsed = time.perf_counter()-start
+
+    total = sum(check(store[uid]) for uid in uids)
+    expected = n_workers*n_threads*n_trials
+    print(f"{n_workers} workers x {n_threads} threads: {total}/{expected} trials recorded for {n_participants} participants "
+          f"in {elapsed:.2f} s ({expected/elapsed:.0f} trials/s), every log replays consistently")
+    assert total == expected
@@ -0,0 +1,80 @@
+"""
+Benchmark of "which tasks has this ID played" and "is this ID taken" lookups: the old scans over
+list_collection_names() against the ParticipantIndex, on a mongomock database with synthetic participant collections.
+
+mongomock has no real indexes (every find is a linear scan in Python), so against it the uncached index lookups are an
+upper bound; set BENCH_MONGO_URL to run against a real mongod (the benchmark database is dropped afterwards).
+
+Usage: python benchmarks/bench_participant_index.py [n_collections ...]   (default: 10000 100000)
+"""
+import os
+import sys
+import time
+import numpy as np
+import mongomock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.index import ParticipantIndex
+
+task_ids = [3151,13151]
+characters = list('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+
+def old_valid_tasks(uniqueID, db, all_task_ids):
+    already_played = []
+    for collection in db.list_collection_names():
+        if uniqueID == collection.split('_')[0]:
+            already_played.append(int(collection.split('_')[1]))
+    return [task_id for task_id in all_task_ids if task_id not in already_played]
+
+def old_is_taken(uniqueID, db):
+    for collection in db.list_collection_names():
+        if uniqueID in collection:
+            return True
+    return False
+
+def timed(function, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        function()
+    return (time.perf_counter()-start)/n*1e3
+
+def run(n_collections, n_lookups=20):
+    if os.environ.get('BENCH_MONGO_URL'):
+        import pymongo
+        client = pymongo.MongoClient(os.environ['BENCH_MONGO_URL'])
+        client.drop_database('bench_participant_index')
+        db = client['bench_participant_index']
+    else:
+        client = None
+        db = mongomock.MongoClient()['bench']
+    rng = np.random.default_rng(0)
+    uids = [''.join(rng.choice(characters, 10)) for _ in range(n_collections)]
+    for i, uid in enumerate(uids):
+        suffix = ['', '_incomplete'][i%2]
+        db[uid+'_'+str(task_ids[i%2])+suffix].insert_one({'trial': 0})
+    # fill the index as the app would have while these participants played
+    db['participants'].insert_many([{'_id': uid} for uid in uids])
+    db['assignments'].insert_many([{'participant': uid, 'task_id': task_ids[i%2]} for i, uid in enumerate(uids)])
+
+    start = time.perf_counter()
+    index = ParticipantIndex(db)
+    index.ensure()
+    build = time.perf_counter()-start
+
+    uid = uids[n_collections//2]
+    old_valid = timed(lambda: old_valid_tasks(uid, db, task_ids), n_lookups)
+    old_taken = timed(lambda: old_is_taken('zzzzzzzzzz', db), n_lookups)
+    index.played_tasks(uid)
+    index_valid = timed(lambda: index.played_tasks(uid), n_lookups)
+    index_valid_cold = timed(lambda: (index.invalidate(uid), index.played_tasks(uid)), n_lookups)
+    index_taken = timed(lambda: index.is_taken('zzzzzzzzzz'), n_lookups)
+    print(f"{n_collections:>7} collections (index ready in {build:.1f} s):")
+    print(f"    played tasks: scan {old_valid:9.3f} ms | index {index_valid_cold:7.3f} ms | cached {index_valid:7.4f} ms")
+    print(f"    ID taken:     scan {old_taken:9.3f} ms | index {index_taken:7.3f} ms")
+    if client is not None:
+        client.drop_database('bench_participant_index')
+
+if __name__ == "__main__":
+    for n_collections in [int(x) for x in sys.argv[1:]] or [10000, 100000]:
+        run(n_collections)
@@ -0,0 +1,76 @@
+"""
+Benchmark of the per-request cost of the session backends: signed cookies (the default) against flask_session's
+filesystem backend (SESSION_BACKEND=filesystem), with a session directory holding n_files other session files as a
+shared /tmp would.
+
+Each request reads the uniqueID from the session, like the trial routes do. Reports the time spent opening and saving
+the session (timed around the session interface) and the total time per request.
+
+Usage: python benchmarks/bench_sessions.py [n_requests] [n_files]   (default: 5000 10000)
+"""
+import os
+import sys
+import tempfile
+import time
+from flask import Flask, session, jsonify
+from flask_session import Session
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.metrics import Histogram, TimedSessionInterface
+
+def make_app(backend, session_dir):
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'bench'
+    app.config['PERMANENT_SESSION_LIFETIME'] = 3600
+    if backend == 'filesystem':
+        app.config['SESSION_TYPE'] = 'filesystem'
+        app.config['SESSION_FILE_DIR'] = session_dir
+        app.config['SESSION_PERMANENT'] = True
+        Session(app)
+    histogram = Histogram('session_seconds', 'session time', ('operation',))
+    app.session_interface = TimedSessionInterface(app.session_interface, histogram)
+
+    @app.route('/login')
+    def login():
+        session['uniqueID'] = 'abcdefghij'
+        session.permanent = True
+        return jsonify(success=True)
+
+    @app.route('/trial')
+    def trial():
+        return jsonify(uniqueID=session.get('uniqueID'))
+
+    return app, histogram
+
+def run(backend, n_requests, session_dir):
+    app, histogram = make_app(backend, session_dir)
+    client = app.test_client()
+    client.get('/login')
+    histogram.values.clear()
+    start = time.perf_counter()
+    for _ in range(n_requests):
+        response = client.get('/trial')
+        assert response.get_json()['uniqueID'] == 'abcdefghij'
+    elapsed = time.perf_counter()-start
+    open_time = histogram.values[('open',)][-1]
+    save_time = histogram.values[('save',)][-1]
+    return open_time/n_requests*1e6, save_time/n_requests*1e6, elapsed/n_requests*1e6
+
+def main():
+    n_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    n_files = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    with tempfile.TemporaryDirectory() as session_dir:
+        # other sessions sharing the directory
+        for i in range(n_files):
+            with open(os.path.join(session_dir, 'other{:08d}'.format(i)), 'wb') as f:
+                f.write(os.urandom(64))
+        print('{} requests, {} other files in the session directory'.format(n_requests, n_files))
+        print('{:<12} {:>12} {:>12} {:>14} {:>14}'.format('backend', 'open us', 'save us', 'session us', 'request us'))
+        for backend in ('filesystem', 'cookie'):
+            open_time, save_time, request_time = run(backend, n_requests, session_dir)
+            print('{:<12} {:>12.1f} {:>12.1f} {:>14.1f} {:>14.1f}'.format(
+                backend, open_time, save_time, open_time+save_time, request_time))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Benchmark of worker startup: the import time of app.main (from python -X importtime, in a fresh interpreter, with the
+modules taking the most cumulative time), and the time to load the tasks from the pickle (pandas) and from the
+precompiled .npz (python -m app.tasks compile), each in a fresh interpreter so that import costs are included.
+
+Usage: python benchmarks/bench_startup.py [n_runs]   (default: 5)
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def run(code, importtime=False):
+    """
+    Run code in a fresh interpreter from the repository root and return its stderr
+    """
+    env = dict(os.environ, SECRET_KEY=os.environ.get('SECRET_KEY', 'bench'),
+               MONGO_DBNAME=os.environ.get('MONGO_DBNAME', 'bench'), LOG_LEVEL='WARNING')
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+    return subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True, check=True).stderr
+
+def import_times():
+    """
+    Cumulative import time in ms of every top-level and first-level module imported by app.main
+    """
+    times = {}
+    for line in run('import app.main', importtime=True).splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # nested imports are indented by two spaces per level
+        depth = (len(name)-len(name.lstrip())-1)//2
+        if depth <= 1:
+            times[name.strip()] = max(times.get(name.strip(), 0), int(cumulative)/1e3)
+    return times
+
+def load_time(path):
+    code = ("import time; start = time.perf_counter(); from app.tasks import TaskRegistry; "
+            "registry = TaskRegistry({!r}); registry.load(); "
+            "import sys; print(len(registry), (time.perf_counter()-start)*1e3, file=sys.stderr)").format(path)
+    n_tasks, elapsed = run(code).split()
+    return int(n_tasks), float(elapsed)
+
+def median(values):
+    values = sorted(values)
+    return values[len(values)//2]
+
+def main():
+    n_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    sys.path.insert(0, ROOT)
+    from app.tasks import TASK_FILE, compile_tasks
+
+    runs = [import_times() for _ in range(n_runs)]
+    print('import app.main: {:.0f} ms (median of {} runs)'.format(median([times['app.main'] for times in runs]), n_runs))
+    slowest = sorted(runs[-1].items(), key=lambda item: -item[1])[1:11]
+    for name, elapsed in slowest:
+        print('  {:<40} {:>8.1f} ms'.format(name, elapsed))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # a copy of the table without a compiled file next to it
+        pickle_path = os.path.join(tmp, 'tasks.pkl')
+        with open(os.path.join(ROOT, TASK_FILE), 'rb') as src, open(pickle_path, 'wb') as dst:
+            dst.write(src.read())
+        pickle_times = [load_time(pickle_path) for _ in range(n_runs)]
+        compile_tasks(pickle_path)
+        compiled_times = [load_time(pickle_path) for _ in range(n_runs)]
+    print('load {} tasks from the pickle:       {:.0f} ms'.format(pickle_times[0][0], median([t for _, t in pickle_times])))
+    print('load {} tasks from the compiled npz: {:.0f} ms'.format(compiled_times[0][0], median([t for _, t in compiled_times])))
+
+if __name__ == "__main__":
+    main()
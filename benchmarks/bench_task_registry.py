@@ -0,0 +1,60 @@
+"""
+Cold-vs-warm benchmark for per-participant experiment setup.
+
+"cold" reproduces the old behaviour of reading df_topset_mirror.pkl for every participant and keeping the
+DataFrame alive on the experiment, "warm" uses the process-wide TaskRegistry.
+
+Usage: python benchmarks/bench_task_registry.py [n_participants]
+"""
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.chdir(os.path.join(os.path.dirname(__file__), '..'))
+
+from app.experiments import MultiLevelMarkov
+from app.tasks import TaskRegistry, TASK_FILE
+
+task_ids = [3151,13151]
+
+def rss_mb():
+    """
+    Current resident set size of this process in MB (Linux)
+    """
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages*os.sysconf('SC_PAGE_SIZE')/1e6
+
+class ColdExperiment:
+    """
+    The old per-participant setup path
+    """
+    def __init__(self, task_id):
+        self.taskDB = pd.read_pickle(TASK_FILE)
+        self.current_task = self.taskDB.loc[task_id]['task']
+        self.state_labels = np.array(self.current_task[0], dtype=np.int32)
+        self.state_transitions = np.array(self.current_task[1],dtype=np.int32)
+
+def run(label, factory, n):
+    experiments = []
+    rss_before = rss_mb()
+    times = []
+    for i in range(n):
+        start = time.perf_counter()
+        experiments.append(factory(task_ids[i%len(task_ids)]))
+        times.append(time.perf_counter()-start)
+    rss_after = rss_mb()
+    times = np.array(times)*1e3
+    print(f"{label:>5}: first {times[0]:8.2f} ms | median {np.median(times):8.3f} ms | "
+          f"total {times.sum():9.1f} ms | RSS +{rss_after-rss_before:7.1f} MB for {n} live experiments")
+    return experiments
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    # warm first so that memory released by the cold run does not hide the warm RSS growth
+    registry = TaskRegistry()
+    warm = run("warm", lambda task_id: MultiLevelMarkov(task_id,500,30,5,None,registry=registry), n)
+    cold = run("cold", ColdExperiment, n)
@@ -0,0 +1,97 @@
+"""
+Benchmark of the replay validator (app.validate) on synthetic sessions: the vectorized check of all sessions of a task
+at once against a replay of each session through MultiLevelMarkov.replay, in trials checked per second.
+
+Sessions play random responses on the real tasks and a few of them are corrupted, so both validators have something
+to find.
+
+Usage: python benchmarks/bench_validate.py [n_sessions_per_task] [n_trials]   (default: 2000 500)
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.chdir(os.path.join(os.path.dirname(__file__), '..'))
+
+from app.experiments import MultiLevelMarkov
+from app.tasks import TASKS
+from app.validate import validate_task
+
+task_ids = [3151,13151]
+naive_trials = 5
+max_trials = 500
+
+def play(state_labels, state_transitions, n_sessions, n_trials, rng):
+    """
+    Trial columns of n_sessions sessions of random responses, as stored by the app
+    """
+    session = np.repeat(np.arange(n_sessions), n_trials)
+    trial = np.tile(np.arange(n_trials), n_sessions)
+    response = rng.integers(0, 2, (n_sessions, n_trials))
+    state = np.full((n_sessions, n_trials), -1)
+    reward = np.zeros((n_sessions, n_trials), dtype=np.int64)
+    current = np.zeros(n_sessions, dtype=np.int64)
+    for t in range(naive_trials, n_trials):
+        state[:, t] = current
+        current = state_transitions[current, response[:, t]]
+        reward[:, t] = state_labels[current]*100
+    return {
+        'sessions': [('p{:09d}'.format(i), 'complete') for i in range(n_sessions)],
+        'session': session, 'trial': trial, 'state': state.ravel(), 'response': response.ravel(), 'reward': reward.ravel(),
+    }
+
+def documents(columns, session):
+    rows = np.flatnonzero(columns['session'] == session)
+    return [{'trial': int(columns['trial'][i]), 'response': 'AB'[columns['response'][i]],
+             'reward': int(columns['reward'][i]), 'time': None} for i in rows]
+
+def replay_all(task_id, columns):
+    """
+    The per-session alternative: replay every session through the experiment and count the ones that stop early
+    """
+    n_mismatched = 0
+    for session in range(len(columns['sessions'])):
+        trials = documents(columns, session)
+        experiment = MultiLevelMarkov(task_id, max_trials, 30, naive_trials, None)
+        if experiment.replay(trials) != len(trials):
+            n_mismatched += 1
+    return n_mismatched
+
+def main():
+    n_sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_trials = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    rng = np.random.default_rng(0)
+    TASKS.load()
+    for task_id in task_ids:
+        state_labels, state_transitions = TASKS.get(task_id)
+        columns = play(state_labels, state_transitions, n_sessions, n_trials, rng)
+        # corrupt the reward of one trial in 1% of the sessions
+        corrupted = rng.choice(n_sessions, n_sessions//100, replace=False)
+        columns['reward'][corrupted*n_trials+n_trials//2] += 100
+        n_total = n_sessions*n_trials
+
+        start = time.perf_counter()
+        summary, issues = validate_task(task_id, state_labels, state_transitions, columns, naive_trials, 30,
+                                        max_trials, 0.0001)
+        vectorized = time.perf_counter()-start
+
+        # the replay is much slower, so time it on a sample of sessions
+        sample = max(1, n_sessions//20)
+        sample_columns = dict(columns, sessions=columns['sessions'][:sample])
+        mask = columns['session'] < sample
+        for name in ('session', 'trial', 'state', 'response', 'reward'):
+            sample_columns[name] = columns[name][mask]
+        start = time.perf_counter()
+        replay_all(task_id, sample_columns)
+        replay = (time.perf_counter()-start)*n_sessions/sample
+
+        print('task {}: {} sessions x {} trials, {} sessions flagged ({} corrupted)'.format(
+            task_id, n_sessions, n_trials, summary['sessions_with_issues'], len(corrupted)))
+        print('  vectorized: {:8.3f} s {:>14,.0f} trials/s'.format(vectorized, n_total/vectorized))
+        print('  replay:     {:8.3f} s {:>14,.0f} trials/s (estimated from {} sessions)'.format(
+            replay, n_total/replay, sample))
+
+if __name__ == "__main__":
+    main()
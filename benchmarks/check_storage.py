@@ -0,0 +1,149 @@
+"""
+Check the trial storages (app.storage) and the write-behind writer against mongomock: writing the same trials twice,
+resuming a session that was never closed (as recorded in the participant index), closing a session, and closing it
+while trials of the session are still queued on the writer of another worker (two WriteBehindQueues on one database),
+for both storage layouts.
+
+Usage: python benchmarks/check_storage.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.chdir(os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('SECRET_KEY', 'check')
+
+import mongomock
+from app.db import DatabaseUnavailable
+from app.experiments import MultiLevelMarkov
+from app.index import ParticipantIndex
+from app.storage import make_storage
+from app.writebehind import WriteBehindQueue
+
+uniqueID = 'abcdefghij'
+task_id = 3151
+max_trials = 500
+min_trials = 30
+naive_trials = 5
+
+failures = []
+
+def check(name, ok):
+    print('  {:<60} {}'.format(name, 'ok' if ok else 'FAILED'))
+    if not ok:
+        failures.append(name)
+
+def play(experiment, n_trials):
+    """
+    Record n_trials responses (always A) and return the documents of the new trials
+    """
+    documents = []
+    for _ in range(n_trials):
+        response, reward, _, _ = experiment.get_next_trial()
+        experiment.record_response(response, reward)
+        documents.append(experiment.log.document(experiment.current_trial-1))
+    return documents
+
+def stored_trials(storage, status):
+    return sorted(document['trial'] for document in storage.iter_trials() if document['status'] == status)
+
+def check_storage(kind):
+    print(kind)
+    db = mongomock.MongoClient().db
+    index = ParticipantIndex(db)
+    storage = make_storage(kind, db, index)
+
+    # the same trial written twice is stored once
+    index.start_session(uniqueID, task_id)
+    experiment = MultiLevelMarkov(task_id, max_trials, min_trials, naive_trials, db)
+    documents = play(experiment, 10)
+    storage.write(uniqueID, task_id, documents)
+    storage.write(uniqueID, task_id, documents[5:])
+    check('trials written twice are stored once', stored_trials(storage, 'live') == list(range(10)))
+
+    # a session that was never closed is resumed from its trials
+    resumed = MultiLevelMarkov(task_id, max_trials, min_trials, naive_trials, db)
+    check('the index returns the running session', index.live_task(uniqueID) == task_id)
+    check('the resumed session replays every trial', resumed.replay(storage.live_trials(uniqueID, task_id)) == 10)
+    check('a running session is not counted as played', task_id not in index.played_tasks(uniqueID))
+
+    # closing the session writes the trials missing from the database
+    writer = WriteBehindQueue(storage, batch_size=10, flush_interval=0.1)
+    for document in play(experiment, 30):
+        writer.put(uniqueID, task_id, document)
+    play(experiment, 5)
+    confirmation = experiment.write_to_database(uniqueID, writer)
+    check('the session is closed as complete', confirmation not in ('no_trials', 'not_enough_trials', 'incomplete'))
+    check('every trial is stored once', stored_trials(storage, 'complete') == list(range(45)))
+    check('no session is left running', index.live_task(uniqueID) is None)
+    check('the closed session is counted as played', task_id in index.played_tasks(uniqueID))
+
+    # trials of a second session still queued on another worker when the session is closed
+    other = 'klmnopqrst'
+    worker_a = WriteBehindQueue(storage, batch_size=1000, flush_interval=0.1)
+    worker_b = WriteBehindQueue(storage, batch_size=1000, flush_interval=3600)
+    index.start_session(other, task_id)
+    experiment = MultiLevelMarkov(task_id, max_trials, min_trials, naive_trials, db)
+    for document in play(experiment, 40):
+        worker_a.put(other, task_id, document)
+    late = play(experiment, 5)
+    for document in late:
+        worker_b.put(other, task_id, document)
+    experiment.write_to_database(other, worker_a)
+    # the writer of the other worker only gets to the trials once the session is closed
+    worker_b.flush()
+    check('late writes do not reopen the session', index.live_task(other) is None)
+    check('the closed session keeps every trial once',
+          sorted(document['trial'] for document in storage.iter_trials()
+                 if document['participant'] == other and document['status'] == 'complete') == list(range(45)))
+    check('no trials are exported as running', stored_trials(storage, 'live') == [])
+
+    # page timings whose update ran on another worker before the trial was written reach the closed session
+    other = 'uvwxyzABCD'
+    experiment = MultiLevelMarkov(task_id, max_trials, min_trials, naive_trials, db)
+    documents = play(experiment, 35)
+    experiment.log.set_timings(3, client_onset=1000.0, client_click=1450.0)
+    storage.update(other, task_id, [{'trial': 3, 'client_onset': 1000.0, 'client_click': 1450.0}])
+    writer = WriteBehindQueue(storage)
+    for document in documents:
+        writer.put(other, task_id, document)
+    experiment.write_to_database(other, writer)
+    stored = [document for document in storage.iter_trials() if document['participant'] == other and document['trial'] == 3]
+    check('page timings are written when the session is closed',
+          len(stored) == 1 and stored[0]['client_click'] == 1450.0)
+
+    # a writer that cannot flush leaves the session open
+    index.start_session(uniqueID, 13151)
+    experiment = MultiLevelMarkov(13151, max_trials, min_trials, naive_trials, db)
+    writer = WriteBehindQueue(storage)
+    for document in play(experiment, 35):
+        writer.put(uniqueID, 13151, document)
+    writer.flush = lambda timeout=30: False
+    try:
+        experiment.write_to_database(uniqueID, writer)
+        raised = False
+    except DatabaseUnavailable:
+        raised = True
+    check('a flush timeout fails the close', raised)
+    check('the session stays open after a flush timeout',
+          not any(document['task_id'] == 13151 and document['status'] != 'live' for document in storage.iter_trials())
+          and index.live_task(uniqueID) == 13151)
+
+    # the index of an existing database is rebuilt with the status of each session
+    WriteBehindQueue.flush(writer)
+    rebuilt = ParticipantIndex(db)
+    db['assignments'].delete_many({})
+    rebuilt.rebuild()
+    check('the rebuilt index finds the running session', rebuilt.live_task(uniqueID) == 13151)
+    check('the rebuilt index counts the closed sessions as played', rebuilt.played_tasks(other) == {task_id})
+
+def main():
+    for kind in ('collections', 'consolidated'):
+        check_storage(kind)
+    if failures:
+        print('{} checks failed'.format(len(failures)))
+        sys.exit(1)
+    print('all checks passed')
+
+if __name__ == "__main__":
+    main()
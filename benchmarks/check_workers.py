@@ -0,0 +1,60 @@
+"""
+Check the MongoDB client lifecycle under a multi-worker gunicorn run: the app is preloaded (and uses the database)
+in the gunicorn master, then every worker must create and use its own client. Runs against mongomock
+(benchmarks/mongomock_wsgi.py) as a stand-in for a local mongod, and prints the pool metrics of each worker.
+
+Usage: python benchmarks/check_workers.py [n_workers] [n_requests]   (default: 3 300)
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def main():
+    n_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    n_requests = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    port = free_port()
+    env = dict(os.environ, LOG_LEVEL='WARNING', EXPERIMENT_STORE='sqlite',
+               EXPERIMENT_STORE_PATH='/tmp/check_workers.sqlite3')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--preload', '-w', str(n_workers),
+                               '-b', '127.0.0.1:{}'.format(port), 'benchmarks.mongomock_wsgi:app'], cwd=ROOT, env=env)
+    try:
+        base_url = 'http://127.0.0.1:{}'.format(port)
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(base_url+'/metrics').read()
+                break
+            except OSError:
+                time.sleep(0.1)
+        workers = {}
+        for _ in range(n_requests):
+            # a new connection per request, so the requests are spread over the workers
+            with urllib.request.urlopen(base_url+'/generateID') as response:
+                worker, client = response.headers['X-Worker-Pid'], response.headers['X-Client-Pid']
+            workers.setdefault(worker, set()).add(client)
+        ok = True
+        print('gunicorn master {}, {} workers answered {} requests'.format(server.pid, len(workers), n_requests))
+        for worker, clients in sorted(workers.items()):
+            own = clients == {worker}
+            ok = ok and own
+            print('  worker {}: client created by {} -> {}'.format(worker, ', '.join(sorted(clients)),
+                                                                  'ok' if own else 'SHARED WITH ANOTHER PROCESS'))
+        metrics = urllib.request.urlopen(base_url+'/metrics').read().decode()
+        print('\n'.join(line for line in metrics.splitlines() if line.startswith('mongodb_')
+                        and not line.startswith('mongodb_command')))
+        sys.exit(0 if ok and len(workers) > 1 else 1)
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""
+End-to-end load test: serves the Flask app from wsgi.py on localhost (against mongomock, so no network or database
+is needed) and drives simulated participants through /login, /, /experiment, the trial loop and /logout.
+
+Reports per-endpoint p50/p95/p99 latency, throughput, and how the experiment store, the session directory and the
+process memory grew during the run.
+
+Usage: python benchmarks/loadtest.py --participants 50 --trials 100 --policy wsls [--prefetch 6] [--think-time 0]
+"""
+import argparse
+import contextlib
+import http.cookiejar
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+def rss_mb():
+    """
+    Current resident set size of this process in MB (Linux)
+    """
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages*os.sysconf('SC_PAGE_SIZE')/1e6
+
+def load_app():
+    """
+    Import the app from wsgi.py with MongoDB replaced by mongomock
+    """
+    import pymongo
+    import mongomock
+    pymongo.MongoClient = mongomock.MongoClient
+    os.environ.setdefault('SECRET_KEY', 'loadtest')
+    os.environ.setdefault('MONGO_DBNAME', 'loadtest')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    import wsgi
+    from app import main
+    return wsgi.app, main
+
+# CHOICE POLICIES
+# each policy gets the participant's state (a dict it can keep notes in) and the last reward and returns 'left' or 'right'
+
+def random_policy(state, reward):
+    return random.choice(['left', 'right'])
+
+def left_policy(state, reward):
+    return 'left'
+
+def alternate_policy(state, reward):
+    state['choice'] = 'right' if state.get('choice') == 'left' else 'left'
+    return state['choice']
+
+def wsls_policy(state, reward):
+    """
+    Win-stay lose-shift: keep the same side unless the reward dropped
+    """
+    choice = state.get('choice', random.choice(['left', 'right']))
+    if reward is not None and reward < state.get('reward', 0):
+        choice = 'right' if choice == 'left' else 'left'
+    state['choice'] = choice
+    state['reward'] = reward or 0
+    return choice
+
+POLICIES = {'random': random_policy, 'left': left_policy, 'alternate': alternate_policy, 'wsls': wsls_policy}
+
+class Participant:
+
+    def __init__(self, base_url, uniqueID, latencies, policy, think_time):
+        """
+        A simulated participant with its own cookie jar
+        """
+        self.base_url = base_url
+        self.uniqueID = uniqueID
+        self.latencies = latencies
+        self.policy = policy
+        self.think_time = think_time
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        self.errors = 0
+
+    def request(self, path, data=None, json_data=None):
+        """
+        Make a request and record its latency under the path (redirects are followed and counted in the first path)
+        """
+        url = self.base_url+path
+        headers = {}
+        body = None
+        if data is not None:
+            body = urllib.parse.urlencode(data).encode()
+        if json_data is not None:
+            body = json.dumps(json_data).encode()
+            headers['Content-Type'] = 'application/json'
+        start = time.perf_counter()
+        try:
+            with self.opener.open(urllib.request.Request(url, data=body, headers=headers)) as response:
+                content = response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            content = e.read()
+            status = e.code
+        self.latencies[path.split('?')[0]].append(time.perf_counter()-start)
+        if status >= 400 and status != 409:
+            self.errors += 1
+        return status, content
+
+    def run(self, n_trials, prefetch):
+        self.request('/login?uniqueID='+self.uniqueID)
+        self.request('/')
+        self.request('/experiment')
+        state = {}
+        reward = None
+        if prefetch:
+            self.run_prefetch(n_trials, prefetch, state)
+        else:
+            _, content = self.request('/trial', data={})
+            trial = json.loads(content)
+            for _ in range(n_trials):
+                if trial['done']:
+                    break
+                time.sleep(self.think_time)
+                choice = self.policy(state, reward)
+                reward = trial[choice+'_reward']
+                _, content = self.request('/trial', data={'choice': choice, 'trial': trial['trial']})
+                trial = json.loads(content)
+        self.request('/logout')
+
+    def run_prefetch(self, n_trials, depth, state):
+        _, content = self.request('/prefetch?depth={}'.format(depth))
+        data = json.loads(content)
+        reward = None
+        remaining = n_trials
+        while remaining > 0 and not data['done'] and data['tree']['levels'] > 0:
+            tree = data['tree']
+            # walk half of the tree, then upload the choices
+            node = 0
+            choices = []
+            for level in range(min(max(1, tree['levels']//2), remaining)):
+                time.sleep(self.think_time)
+                choice = self.policy(state, reward)
+                reward = tree['reward_A' if choice == 'left' else 'reward_B'][node]
+                choices.append({'trial': tree['trial']+level, 'choice': choice, 'state': tree['state'][node], 'reward': reward})
+                node = 2*node+(1 if choice == 'left' else 2)
+            remaining -= len(choices)
+            _, content = self.request('/upload_choices', json_data={'choices': choices, 'depth': depth})
+            data = json.loads(content)
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values)-1, int(round(q/100*(len(values)-1))))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--participants', type=int, default=50)
+    parser.add_argument('--trials', type=int, default=100)
+    parser.add_argument('--policy', choices=sorted(POLICIES), default='random')
+    parser.add_argument('--prefetch', type=int, default=0, help='use the prefetch routes with this depth')
+    parser.add_argument('--think-time', type=float, default=0.0, help='seconds between choices')
+    parser.add_argument('--ramp', type=float, default=0.0, help='seconds over which participants arrive')
+    args = parser.parse_args()
+
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    app, main_module = load_app()
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    session_dir = app.config.get('SESSION_FILE_DIR')
+    sessions_before = len(os.listdir(session_dir)) if session_dir and os.path.isdir(session_dir) else 0
+    rss_before = rss_mb()
+    latencies = defaultdict(list)
+    peak = {'experiments': 0, 'rss': rss_before}
+    participants = [Participant(base_url, 'load{:06d}'.format(i), latencies, POLICIES[args.policy], args.think_time)
+                    for i in range(args.participants)]
+
+    def run(participant, delay):
+        time.sleep(delay)
+        participant.run(args.trials, args.prefetch)
+
+    threads = [threading.Thread(target=run, args=(p, args.ramp*i/max(1, args.participants)))
+               for i, p in enumerate(participants)]
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            peak['experiments'] = max(peak['experiments'], len(main_module.experiments))
+            peak['rss'] = max(peak['rss'], rss_mb())
+            time.sleep(0.05)
+    elapsed = time.perf_counter()-start
+    server.shutdown()
+
+    n_requests = sum(len(values) for values in latencies.values())
+    sessions_after = len(os.listdir(session_dir)) if session_dir and os.path.isdir(session_dir) else 0
+    print('{} participants x {} trials ({} policy{}) in {:.2f} s'.format(
+        args.participants, args.trials, args.policy, ', prefetch depth {}'.format(args.prefetch) if args.prefetch else '', elapsed))
+    print('{:<18} {:>8} {:>10} {:>10} {:>10}'.format('endpoint', 'requests', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for path, values in sorted(latencies.items()):
+        print('{:<18} {:>8} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+            path, len(values), percentile(values, 50)*1e3, percentile(values, 95)*1e3, percentile(values, 99)*1e3))
+    print('throughput: {:.0f} requests/s, {:.0f} trials/s, {} errors'.format(
+        n_requests/elapsed, args.participants*args.trials/elapsed, sum(p.errors for p in participants)))
+    print('experiment store: peak {} running, {} left after logout'.format(peak['experiments'], len(main_module.experiments)))
+    print('session files: {:+d}'.format(sessions_after-sessions_before))
+    print('memory: RSS {:.1f} MB -> peak {:.1f} MB -> {:.1f} MB'.format(rss_before, peak['rss'], rss_mb()))
+
+if __name__ == "__main__":
+    main()
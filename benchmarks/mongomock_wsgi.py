@@ -0,0 +1,24 @@
+"""
+The app served against mongomock, for running it under gunicorn without a database (see check_workers.py).
+The database is used once before the workers fork, as a preloaded app doing work at import would.
+"""
+import os
+import sys
+import pymongo
+import mongomock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+pymongo.MongoClient = mongomock.MongoClient
+os.environ.setdefault('SECRET_KEY', 'check')
+os.environ.setdefault('MONGO_DBNAME', 'check')
+
+from app.main import app, DB
+
+DB.list_collection_names()
+
+@app.after_request
+def add_pids(response):
+    # process serving the request and process that created the MongoDB client it used
+    response.headers['X-Worker-Pid'] = str(os.getpid())
+    response.headers['X-Client-Pid'] = str(DB._pid)
+    return response
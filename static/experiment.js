@@ -3,278 +3,418 @@
 // Global variables
 var timeout = 500; // time between each update in milliseconds
 var debug = false; // set to true to print debug messages to console
+var current_trial = null; // the trial currently shown
+var max_trials = 0;
+if (typeof prefetch_depth === "undefined") {
+    var prefetch_depth = 0; // levels of upcoming trials to prefetch (set by the page, 0 to ask the server every trial)
+}
 
-// UPDATE LEFT STRING
-// this function will get the left string from the server and update the id="left_string" element
-// the data is returned as a JSON object with the key "left_string"
-function update_left_string() {
-    $.ajax({
-        type: "GET",
-        url: "/get_left_string",
-        dataType: "json",
-        success: function (data) {
-            $("#left_string").html(data.left_string);
-            if (debug) {
-                console.log("left option: " + data.left_string);
-            }
-            // check if the left string is 'A' or 'B' and add the appropriate class to the left button
-            if (data.left_string == 'A') {
-                $("#left_button").addClass("button-A");
-                $("#left_button").removeClass("button-B");
-            }
-            else if (data.left_string == 'B') {
-                $("#left_button").addClass("button-B");
-                $("#left_button").removeClass("button-A");
-            }
+// TIMINGS
+// performance.now() timestamps (ms since performance.timeOrigin) of each trial: stimulus onset, click, reward shown,
+// choice sent to the server and answer received. A trial's timings are queued once the reward was shown and the
+// server answered, and uploaded to /timings in batches of timing_batch_size trials (and before logging out).
+var timing_batch_size = 20;
+var timings = {}; // timings of the trials not complete yet, by trial
+var timing_batch = []; // complete timings not uploaded yet
+var uploading_timings = false;
+var time_origin = performance.timeOrigin || performance.timing.navigationStart;
+
+// MARK
+// this function will store the current time as the given event of a trial, or the time of the next frame (when
+// whatever was just drawn is actually shown) if next_frame is set
+function mark(trial, event, next_frame) {
+    if (next_frame && window.requestAnimationFrame) {
+        window.requestAnimationFrame(function () {
+            mark(trial, event, false);
+        });
+        return;
+    }
+    if (!(trial in timings)) {
+        timings[trial] = {trial: trial};
+    }
+    timings[trial][event] = performance.now();
+    if ("reward" in timings[trial] && "received" in timings[trial]) {
+        timing_batch.push(timings[trial]);
+        delete timings[trial];
+        if (timing_batch.length >= timing_batch_size) {
+            upload_timings(null);
         }
-    });
+    }
 }
 
-// UPDATE RIGHT STRING
-// this function will get the right string from the server and update the id="right_string" element
-// the data is returned as a JSON object with the key "right_string"
-function update_right_string() {
+// UPLOAD TIMINGS
+// this function will send the complete timings to the server and call callback (if any) once done
+// timings that could not be sent are kept for the next upload, unless the page is about to leave (callback given)
+function upload_timings(callback) {
+    if (uploading_timings) {
+        if (callback !== null) {
+            // send the rest once the upload in progress is done
+            setTimeout(function () {
+                upload_timings(callback);
+            }, timeout);
+        }
+        return;
+    }
+    if (timing_batch.length == 0) {
+        if (callback !== null) {
+            callback();
+        }
+        return;
+    }
+    uploading_timings = true;
+    var batch = timing_batch;
+    timing_batch = [];
     $.ajax({
-        type: "GET",
-        url: "/get_right_string",
+        type: "POST",
+        url: "/timings",
+        data: JSON.stringify({origin: time_origin, timings: batch}),
+        contentType: "application/json",
         dataType: "json",
         success: function (data) {
-            $("#right_string").html(data.right_string);
+            uploading_timings = false;
             if (debug) {
-                console.log("right option: " + data.right_string);
+                console.log("timings accepted: " + data.accepted);
             }
-            // check if the right string is 'A' or 'B' and add the appropriate class to the right button
-            if (data.right_string == 'A') {
-                $("#right_button").addClass("button-A");
-                $("#right_button").removeClass("button-B");
+            if (callback !== null) {
+                callback();
             }
-            else if (data.right_string == 'B') {
-                $("#right_button").addClass("button-B");
-                $("#right_button").removeClass("button-A");
+        },
+        error: function () {
+            uploading_timings = false;
+            if (callback !== null) {
+                callback();
+            }
+            else {
+                timing_batch = batch.concat(timing_batch);
             }
         }
     });
 }
 
-// UPDATE POINTS AND TRIALS
-// this function will get the points,trials and winnings from the server and update the id="points" and id="trials" and id="winnings" elements
-// the data is returned as a JSON object with the keys "points" and "trials" and "winnings"
-function update_points_and_trial() {
+// SET OPTION
+// this function will show the option string ('A' or 'B') on a button and add the appropriate class to it
+function set_option(side, option) {
+    $("#" + side + "_string").html(option);
+    if (option == 'A') {
+        $("#" + side + "_button").addClass("button-A");
+        $("#" + side + "_button").removeClass("button-B");
+    }
+    else if (option == 'B') {
+        $("#" + side + "_button").addClass("button-B");
+        $("#" + side + "_button").removeClass("button-A");
+    }
+}
+
+// SET REWARD
+// this function will show the reward on a button and add the class matching '0', '100', '200' or '300' to it
+function set_reward(side, reward) {
+    var reward_classes = {0: "button-none", 100: "button-low", 200: "button-med", 300: "button-high"};
+    $("#" + side + "_string").html(reward);
+    $("#" + side + "_button").removeClass("button-none button-low button-med button-high");
+    if (reward in reward_classes) {
+        $("#" + side + "_button").addClass(reward_classes[reward]);
+    }
+}
+
+// SHOW TRIAL
+// this function will update the options, points, trial and winnings from a trial returned by the server
+// the data is a JSON object with the keys "left_string", "right_string", "left_reward", "right_reward",
+// "points", "trial", "winnings" and "done"
+function show_trial(data) {
+    current_trial = data;
+    // max trials reached
+    if (data.done) {
+        finish();
+        return;
+    }
+    set_option("left", data.left_string);
+    set_option("right", data.right_string);
+    $("#points").html(data.points);
+    // add 1 to the trial number
+    $("#trial").html(data.trial + 1);
+    $("#winnings").html(data.winnings);
+    mark(data.trial, "onset", true);
+    if (debug) {
+        console.log("left option: " + data.left_string);
+        console.log("right option: " + data.right_string);
+        console.log("points: " + data.points);
+        console.log("trial: " + (data.trial + 1));
+        console.log("winnings: " + data.winnings);
+    }
+}
+
+// REQUEST TRIAL
+// this function will send the choice for the current trial (if any) to the /trial route and pass the next trial to callback
+function request_trial(choice, callback) {
+    var data = {};
+    var trial = null;
+    if (choice !== null) {
+        trial = current_trial.trial;
+        data = {choice: choice, trial: trial};
+        mark(trial, "sent", false);
+    }
     $.ajax({
-        type: "GET",
-        url: "/get_points_and_trial",
+        type: "POST",
+        url: "/trial",
+        data: data,
         dataType: "json",
         success: function (data) {
-            $("#points").html(data.points);
-            // add 1 to the trial number
-            $("#trial").html(data.trial + 1);
-            $("#winnings").html(data.winnings);
-            if (debug) {
-                console.log("points: " + data.points);
-                console.log("trial: " + (data.trial + 1));
-                console.log("winnings: " + data.winnings);
+            if (trial !== null) {
+                mark(trial, "received", false);
             }
+            if (debug && choice !== null) {
+                console.log(choice + " response recorded: " + data.recorded);
+            }
+            callback(data);
         }
     });
 }
 
-// CALL UPDATE LEFT STRING and UPDATE RIGHT STRING and UPDATE POINTS AND TRIALS on page load
-$(document).ready(function () {
-    update_left_string();
-    update_right_string();
-    update_points_and_trial();
-    // use AJAX to get if it in debug mode and chenge the value of the global variable debug
-    $.ajax({
-        type: "GET",
-        url: "/is_debug_mode",
-        dataType: "json",
-        success: function (data) {
-            debug = data.debug;
-            if (debug) {
-                console.log("debug mode: " + debug);
-            }
+// PREFETCH MODE
+// When prefetch_depth > 0 the server sends a tree of the upcoming trials (see /prefetch) in which the children of
+// node i are 2i+1 (choice A) and 2i+2 (choice B). Trials are shown straight from the tree and the choices are
+// uploaded in the background to /upload_choices, which checks them against the server's own state and sends back a
+// fresh tree, so the participant never has to wait for the server between trials.
+var tree = null; // latest tree of upcoming trials
+var tree_points = 0; // points at the root of the tree
+var unit_winnings = 0;
+var choices = []; // choices made from the root of the tree as {trial, choice, state, reward}
+var pending = []; // choices not uploaded yet
+var uploading = false;
+var waiting = false; // the participant got to the end of the tree before a new one arrived
+var on_flushed = null; // called once every choice has been uploaded
+
+// TREE TRIAL
+// this function will build the trial shown after the choices made so far, in the same format as the /trial route,
+// or return null if it is beyond the end of the tree
+function tree_trial() {
+    var node = 0;
+    var points = tree_points;
+    for (var i = 0; i < choices.length; i++) {
+        node = 2 * node + (choices[i].choice == "left" ? 1 : 2);
+        points += choices[i].reward;
+    }
+    var trial = tree.trial + choices.length;
+    if (trial >= max_trials) {
+        return {trial: trial, points: points, done: true};
+    }
+    if (choices.length >= tree.levels) {
+        return null;
+    }
+    return {
+        left_string: 'A', right_string: 'B',
+        left_reward: tree.reward_A[node], right_reward: tree.reward_B[node],
+        state: tree.state[node], points: points, trial: trial,
+        winnings: Math.round(points * unit_winnings * 100) / 100, done: false
+    };
+}
+
+// RECEIVE TREE
+// this function will store a tree sent by the server and keep only the choices the server has not recorded yet
+function receive_tree(data) {
+    tree = data.tree;
+    tree_points = data.points;
+    unit_winnings = data.unit_winnings;
+    max_trials = data.max_trials;
+    choices = choices.filter(function (c) { return c.trial >= tree.trial; });
+    if (waiting) {
+        var next = tree_trial();
+        if (next !== null) {
+            waiting = false;
+            enable_buttons();
+            show_trial(next);
         }
-    });
-});
+    }
+}
 
-// SHOW LEFT REWARD
-// this function will get the left reward from the server and update the id="left_string" element
-// the data is returned as a JSON object with the key "left_reward"
-function show_left_reward() {
+// UPLOAD CHOICES
+// this function will send the pending choices to the server, one batch at a time
+// if the server rejects them, the page falls back to the server's state
+function upload_choices() {
+    if (uploading) {
+        return;
+    }
+    if (pending.length == 0) {
+        if (on_flushed !== null) {
+            on_flushed();
+        }
+        return;
+    }
+    uploading = true;
+    var batch = pending;
+    pending = [];
+    for (var i = 0; i < batch.length; i++) {
+        mark(batch[i].trial, "sent", false);
+    }
     $.ajax({
-        type: "GET",
-        url: "/get_left_reward",
+        type: "POST",
+        url: "/upload_choices",
+        data: JSON.stringify({choices: batch, depth: prefetch_depth}),
+        contentType: "application/json",
         dataType: "json",
         success: function (data) {
-            $("#left_string").html(data.left_reward);
-            $("#right_string").html("");
-            if (debug) {
-                console.log("left reward: " + data.left_reward);
+            uploading = false;
+            for (var i = 0; i < batch.length; i++) {
+                mark(batch[i].trial, "received", false);
             }
-            // check if the left reward is '0', '100', '200' or '300' and add the appropriate class to the left button
-            if (data.left_reward == '0') {
-                $("#left_button").addClass("button-none");
-                $("#left_button").removeClass("button-low");
-                $("#left_button").removeClass("button-med");
-                $("#left_button").removeClass("button-high");
-            }
-            else if (data.left_reward == '100') {
-                $("#left_button").addClass("button-low");
-                $("#left_button").removeClass("button-none");
-                $("#left_button").removeClass("button-med");
-                $("#left_button").removeClass("button-high");
+            if (debug) {
+                console.log("choices accepted: " + data.accepted);
             }
-            else if (data.left_reward == '200') {
-                $("#left_button").addClass("button-med");
-                $("#left_button").removeClass("button-none");
-                $("#left_button").removeClass("button-low");
-                $("#left_button").removeClass("button-high");
+            receive_tree(data);
+            upload_choices();
+        },
+        error: function (xhr) {
+            uploading = false;
+            if (xhr.status == 409) {
+                if (debug) {
+                    console.log("choices rejected, resyncing with the server");
+                }
+                choices = [];
+                pending = [];
+                receive_tree(xhr.responseJSON);
+                show_trial(tree_trial());
+                upload_choices();
             }
-            else if (data.left_reward == '300') {
-                $("#left_button").addClass("button-high");
-                $("#left_button").removeClass("button-none");
-                $("#left_button").removeClass("button-low");
-                $("#left_button").removeClass("button-med");
+            else {
+                // try again later
+                pending = batch.concat(pending);
+                setTimeout(upload_choices, timeout);
             }
         }
     });
 }
 
-// SHOW RIGHT REWARD
-// this function will get the right reward from the server and update the id="right_string" element
-// the data is returned as a JSON object with the key "right_reward"
-function show_right_reward() {
+// FINISH
+// this function will make sure every choice and the timings reached the server before logging out
+function finish() {
+    var logout = function () {
+        upload_timings(function () {
+            window.location.href = "/logout";
+        });
+    };
+    if (prefetch_depth > 0 && tree !== null) {
+        on_flushed = logout;
+        upload_choices();
+    }
+    else {
+        logout();
+    }
+}
+
+// GET THE FIRST TRIAL on page load
+$(document).ready(function () {
+    if (prefetch_depth > 0) {
+        $.ajax({
+            type: "GET",
+            url: "/prefetch",
+            data: {depth: prefetch_depth},
+            dataType: "json",
+            success: function (data) {
+                receive_tree(data);
+                show_trial(tree_trial());
+            }
+        });
+    }
+    else {
+        request_trial(null, show_trial);
+    }
+    // upload any pending choices before stopping the experiment
+    $("#stop_button").closest("a").click(function (event) {
+        event.preventDefault();
+        finish();
+    });
+    // use AJAX to get if it in debug mode and chenge the value of the global variable debug
     $.ajax({
         type: "GET",
-        url: "/get_right_reward",
+        url: "/is_debug_mode",
         dataType: "json",
         success: function (data) {
-            $("#right_string").html(data.right_reward);
-            $("#left_string").html("");
+            debug = data.debug;
             if (debug) {
-                console.log("right reward: " + data.right_reward);
-            }
-            // check if the right reward is '0', '100', '200' or '300' and add the appropriate class to the right button
-            if (data.right_reward == '0') {
-                $("#right_button").addClass("button-none");
-                $("#right_button").removeClass("button-low");
-                $("#right_button").removeClass("button-med");
-                $("#right_button").removeClass("button-high");
-            }
-            else if (data.right_reward == '100') {
-                $("#right_button").addClass("button-low");
-                $("#right_button").removeClass("button-none");
-                $("#right_button").removeClass("button-med");
-                $("#right_button").removeClass("button-high");
-            }
-            else if (data.right_reward == '200') {
-                $("#right_button").addClass("button-med");
-                $("#right_button").removeClass("button-none");
-                $("#right_button").removeClass("button-low");
-                $("#right_button").removeClass("button-high");
-            }
-            else if (data.right_reward == '300') {
-                $("#right_button").addClass("button-high");
-                $("#right_button").removeClass("button-none");
-                $("#right_button").removeClass("button-low");
-                $("#right_button").removeClass("button-med");
+                console.log("debug mode: " + debug);
             }
         }
     });
-}
+});
 
-// LEFT BUTTON CLICK
-// On left button click, the following happens:
-// 1. The left button is highlighted
-// 2. The left reward is shown
-// 3. A message is sent to the server that the left button was clicked by calling the /left_response route that returns a JSON object with the key "success"
-// 4. The both buttons are disabled for 1 second
-// After 1 second, 
-// 1. The left button is unhighlighted
-// 2. The left string and right string are updated
-// 3. The points and trial are updated
-// 4. The both buttons are enabled
+// BUTTON CLICK
+// On a button click, the following happens:
+// 1. The chosen button is highlighted and its reward is shown
+// 2. The both buttons are disabled
+// After 500 ms,
+// 1. The choice is sent to the server by calling the /trial route, which records it and returns the next trial
+//    (in prefetch mode the choice is uploaded right away in the background and the next trial comes from the tree)
+// After another 500 ms (or once the server has answered, if that takes longer),
+// 1. The chosen button is unhighlighted
+// 2. The options, points and trial are updated
+// 3. The both buttons are enabled
+function button_click(side) {
+    if (current_trial === null) {
+        return;
+    }
+    var other = (side == "left") ? "right" : "left";
+    mark(current_trial.trial, "click", false);
 
-function left_button_click() {
+    set_reward(side, current_trial[side + "_reward"]);
+    $("#" + other + "_string").html("");
+    if (debug) {
+        console.log(side + " reward: " + current_trial[side + "_reward"]);
+    }
 
-    // run the show_left_reward function and wait for 500 ms before sending the message to the server
-    show_left_reward();
-    
-    $("#left_button").addClass("button-chosen");
+    $("#" + side + "_button").addClass("button-chosen");
+    mark(current_trial.trial, "reward", true);
 
     $("#left_button").addClass("button-disabled");
     $("#right_button").addClass("button-disabled");
     $("#left_button").prop("disabled", true);
     $("#right_button").prop("disabled", true);
-    
-    
-    
-    setTimeout(function () {
-        $.ajax({
-            type: "GET",
-            url: "/left_response",
-            dataType: "json",
-            success: function (data) {
-                if (debug) {
-                    console.log("Left response: " + data.success);
-                }
-            }
-        });
-        
-        setTimeout(function () {
-            $("#left_button").removeClass("button-chosen");
-             
-            update_left_string();
-            update_right_string();
-            update_points_and_trial();
 
-            $("#left_button").prop("disabled", false);
-            $("#right_button").prop("disabled", false);
-            $("#left_button").removeClass("button-disabled");
-            $("#right_button").removeClass("button-disabled");
-        }, timeout);
-    }, timeout);
-    
-}
-
-// SAME AS LEFT BUTTON CLICK, BUT FOR RIGHT BUTTON
-function right_button_click() {
+    if (prefetch_depth > 0) {
+        var choice = {trial: current_trial.trial, choice: side, state: current_trial.state, reward: current_trial[side + "_reward"]};
+        choices.push(choice);
+        pending.push(choice);
+        upload_choices();
+        setTimeout(function () {
+            $("#" + side + "_button").removeClass("button-chosen");
+            var next = tree_trial();
+            if (next === null) {
+                // wait for the next tree to arrive
+                waiting = true;
+                return;
+            }
+            show_trial(next);
+            enable_buttons();
+        }, 2 * timeout);
+        return;
+    }
 
-    // run the show_right_reward function and wait for 500 ms before sending the message to the server
-    show_right_reward();
+    setTimeout(function () {
+        var sent = Date.now();
+        request_trial(side, function (data) {
+            setTimeout(function () {
+                $("#" + side + "_button").removeClass("button-chosen");
 
-    $("#right_button").addClass("button-chosen");
+                show_trial(data);
 
-    $("#left_button").addClass("button-disabled");
-    $("#right_button").addClass("button-disabled");
-    $("#left_button").prop("disabled", true);
-    $("#right_button").prop("disabled", true);
+                enable_buttons();
+            }, Math.max(0, timeout - (Date.now() - sent)));
+        });
+    }, timeout);
+}
 
+// ENABLE BUTTONS
+function enable_buttons() {
+    $("#left_button").prop("disabled", false);
+    $("#right_button").prop("disabled", false);
+    $("#left_button").removeClass("button-disabled");
+    $("#right_button").removeClass("button-disabled");
+}
 
-    setTimeout(function () {
-        $.ajax({
-            type: "GET",
-            url: "/right_response",
-            dataType: "json",
-            success: function (data) {
-                if (debug) {
-                    console.log("Right response: " + data.success);
-                }
-            }
-        });
-        
-        setTimeout(function () {
-            $("#right_button").removeClass("button-chosen");
-            
-            update_left_string();
-            update_right_string();
-            update_points_and_trial();
+function left_button_click() {
+    button_click("left");
+}
 
-            $("#left_button").prop("disabled", false);
-            $("#right_button").prop("disabled", false);
-            $("#left_button").removeClass("button-disabled");
-            $("#right_button").removeClass("button-disabled");
-        }, timeout);
-    }, timeout);
-    
-}
\ No newline at end of file
+// SAME AS LEFT BUTTON CLICK, BUT FOR RIGHT BUTTON
+function right_button_click() {
+    button_click("right");
+}